@@ -79,6 +79,22 @@ export const register = (data: { email: string; password: string }) =>
 
 export const getContacts = () => api.get("/api/contacts");
 
+// Incremental contacts sync: follows pages starting after `updatedSince` and
+// returns the changed contacts plus the cursor to pass on the next sync
+export const syncContacts = async <T = unknown>(updatedSince?: string) => {
+  const contacts: T[] = [];
+  let cursor = updatedSince;
+  for (;;) {
+    const response = await api.get("/api/contacts", {
+      params: { limit: 200, ...(cursor ? { updated_since: cursor } : {}) },
+    });
+    contacts.push(...response.data);
+    cursor = response.headers["x-cursor-after"] ?? cursor;
+    if (response.headers["x-has-more"] !== "true") break;
+  }
+  return { contacts, cursor };
+};
+
 export const getMessages = (contactEmail: string) =>
   api.get(`/api/messages/${contactEmail}`);
 
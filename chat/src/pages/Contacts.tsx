@@ -1,9 +1,9 @@
 
 
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import { FiUser, FiCircle } from 'react-icons/fi';
-import api from '../api';
+import { syncContacts } from '../api';
 
 interface Contact {
   _id: string;
@@ -12,14 +12,30 @@ interface Contact {
   avatar?: string; // Added to match updated backend
   status: 'online' | 'offline';
   last_seen: string;
-  last_seen_text?: string; // Added for human-readable last seen
 }
 
+const lastSeenText = (lastSeen: string) => {
+  // Server timestamps are naive UTC ISO strings
+  const utc = /[zZ]|[+-]\d\d:\d\d$/.test(lastSeen) ? lastSeen : `${lastSeen}Z`;
+  const diff = Date.now() - new Date(utc).getTime();
+  const mins = Math.floor(diff / 60000);
+  if (mins < 1) return 'just now';
+  if (mins < 60) return `${mins} min ago`;
+  const hours = Math.floor(mins / 60);
+  if (hours < 24) return `${hours} hour${hours > 1 ? 's' : ''} ago`;
+  const days = Math.floor(hours / 24);
+  return `${days} day${days > 1 ? 's' : ''} ago`;
+};
+
+const byStatus = (a: Contact, b: Contact) =>
+  a.status === b.status ? 0 : a.status === 'online' ? -1 : 1;
+
 const Contacts: React.FC = () => {
   const [contacts, setContacts] = useState<Contact[]>([]);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<string | null>(null);
   const navigate = useNavigate();
+  const cursor = useRef<string | undefined>(undefined);
 
   useEffect(() => {
     const fetchContacts = async () => {
@@ -31,12 +47,16 @@ const Contacts: React.FC = () => {
           return;
         }
 
-        const response = await api.get('/api/contacts', {
-          headers: {
-            Authorization: `Bearer ${token}`,
-          },
-        });
-        setContacts(response.data);
+        // Only contacts changed since the previous poll are returned
+        const { contacts: changed, cursor: next } = await syncContacts<Contact>(cursor.current);
+        cursor.current = next;
+        if (changed.length > 0) {
+          setContacts((prev) => {
+            const merged = new Map(prev.map((c) => [c.email, c]));
+            changed.forEach((c) => merged.set(c.email, c));
+            return [...merged.values()].sort(byStatus);
+          });
+        }
         setError(null); // Clear any previous errors on success
       } catch (err: unknown) {
         console.error('Error fetching contacts:', err);
@@ -132,7 +152,7 @@ const Contacts: React.FC = () => {
                 {contact.status === 'online' ? (
                   <span className="text-green-600 font-medium">Online</span>
                 ) : (
-                  contact.last_seen_text || `Last seen ${new Date(contact.last_seen).toLocaleString()}`
+                  `Last seen ${lastSeenText(contact.last_seen)}`
                 )}
               </p>
             </div>
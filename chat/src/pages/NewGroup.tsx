@@ -5,7 +5,7 @@ import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { motion } from 'framer-motion';
 import { FaUsers, FaPlus, FaArrowLeft, FaCheck, FaSearch } from 'react-icons/fa';
-import api from '../api';
+import api, { syncContacts } from '../api';
 import { User } from '../User';
 
 const NewGroup: React.FC = () => {
@@ -24,9 +24,9 @@ const NewGroup: React.FC = () => {
     const fetchContacts = async () => {
       try {
         setLoading(true);
-        const response = await api.get('/api/contacts');
+        const { contacts: allContacts } = await syncContacts<User>();
         const currentUser = JSON.parse(localStorage.getItem('user') || '{}');
-        const filtered = response.data.filter((user: User) => user.email !== currentUser.email);
+        const filtered = allContacts.filter((user: User) => user.email !== currentUser.email);
         setContacts(filtered);
         setFilteredContacts(filtered);
       } catch (err) {
@@ -2,7 +2,7 @@
 
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
-import api from '../api';
+import api, { syncContacts } from '../api';
 import { FaPaperPlane, FaArrowLeft, FaSmile, FaImage } from 'react-icons/fa';
 import { motion } from 'framer-motion';
 import EmojiPicker, { EmojiClickData } from 'emoji-picker-react';
@@ -92,7 +92,7 @@ const OneToOneChat: React.FC = () => {
     try {
       const [msgRes, contactRes] = await Promise.all([
         api.get(`/api/messages/${contactEmail}`),
-        api.get('/api/contacts'),
+        syncContacts(),
       ]);
       setMessages(msgRes.data);
       if (msgRes.data.length > 0) {
@@ -104,7 +104,7 @@ const OneToOneChat: React.FC = () => {
         status: 'online' | 'offline';
       }
 
-      const contact = (contactRes.data as Contact[]).find((c) => c.email === contactEmail);
+      const contact = (contactRes.contacts as Contact[]).find((c) => c.email === contactEmail);
       if (contact) setContactStatus(contact.status);
     } catch (err) {
       console.error('Failed to fetch data:', err);
@@ -1,6 +1,7 @@
-from flask import Flask, request, jsonify, make_response
-from pymongo import MongoClient
-from flask_bcrypt import Bcrypt
+from flask import Flask, Response, request, jsonify, make_response, g, send_file, url_for
+from flask.json.provider import DefaultJSONProvider
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from flask_cors import CORS
 from datetime import datetime, timedelta
 from bson import ObjectId
@@ -10,11 +11,44 @@ from dotenv import load_dotenv
 import jwt
 from flask_sock import Sock
 import json
+import re
+import atexit
+import hashlib
+import zlib
+import threading
+import time
+import uuid
+from delivery import Outbox, Watchdog, DeliveryStats
+from routing import create_router
+from presence import PresenceRegistry
+from write_pipeline import WritePipeline
+from group_cache import GroupCache
+from auth_cache import TokenCache, UserCache
+from history_cache import HotConversationCache
+from media import MediaStore, UploadError
+from search import SearchIndex
+from hashing import PasswordHasher, HashingBusy
+from read_receipts import ReceiptBatcher
+from subscriptions import SubscriptionIndex
+from throttle import RateLimiter, TypingCoalescer, ThrottleStats, parse_limits
+from serialization import dumps, loads
+from metrics import Registry, MongoCommandTimer, SamplingProfiler, FANOUT_BUCKETS, CONTENT_TYPE
+from wire import SenderTable, Session, FrameTooLarge, COMPACT, codes as wire_codes
 
 # Load environment variables
 load_dotenv()
 
+# jsonify goes through the shared serializer, which encodes ObjectId and
+# datetime itself so routes don't convert documents field by field
+class ChatJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
 app = Flask(__name__)
+app.json = ChatJSONProvider(app)
 sock = Sock(app)  # Initialize WebSocket
 
 # Load allowed origins dynamically from .env
@@ -28,15 +62,699 @@ CORS(app, supports_credentials=True, origins=allowed_origins)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', '2f9d0558e4064086850082bdb6440db0')
 
 
+# Password hashing runs in its own process pool with a bounded queue
+hasher = PasswordHasher(
+    rounds=int(os.getenv('BCRYPT_LOG_ROUNDS', 12)),
+    workers=int(os.getenv('HASH_WORKERS', 2)),
+    max_pending=int(os.getenv('HASH_QUEUE_SIZE', 8))
+)
+
+# Metrics for GET /metrics (Prometheus text format). Each worker process
+# exposes its own; scrape every worker (and the gateway) separately.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # If set, scrapes need "Authorization: Bearer <token>"; else only this host
+metrics = Registry()
+http_request_seconds = metrics.histogram(
+    "chat_http_request_duration_seconds", "REST request latency by route.", ("route", "method", "status"))
+ws_frame_seconds = metrics.histogram(
+    "chat_ws_frame_duration_seconds", "Time to handle one incoming /ws frame by type.", ("type",))
+mongo_command_seconds = metrics.histogram(
+    "chat_mongo_command_duration_seconds", "Mongo command latency by collection and command.",
+    ("collection", "command"))
+mongo_command_failures = metrics.counter(
+    "chat_mongo_command_failures_total", "Mongo commands that failed.", ("collection", "command"))
+fanout_recipients = metrics.histogram(
+    "chat_delivery_fanout_recipients", "Local connections a routed delivery went to.", ("target",),
+    buckets=FANOUT_BUCKETS)
+ws_send_seconds = metrics.histogram(
+    "chat_ws_send_duration_seconds", "Time to write one frame to a socket.")
+
+# Optional sampling profiler over the /ws frame handler; folded stacks are
+# served at /metrics/profile
+profiler = SamplingProfiler(hz=float(os.getenv('PROFILE_SAMPLE_HZ', 0)))
+
 # Database configuration
-bcrypt = Bcrypt(app)
 mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
-client = MongoClient(mongo_uri)
+client = MongoClient(mongo_uri, event_listeners=[MongoCommandTimer(mongo_command_seconds, mongo_command_failures)])
 db = client[os.getenv('DB_NAME', 'chat_app')]
 users_collection = db["users"]
 messages_collection = db["messages"]
 groups_collection = db["groups"]
-active_connections = {}  # Track active WebSocket connections {email: {'ws': ws, 'groups': set()}}
+conversations_collection = db["conversations"]  # Per-conversation sequence counters
+read_cursors_collection = db["read_cursors"]  # Per-user "read up to seq" markers
+media_collection = db["media"]  # One document per stored file, keyed by its sha256
+uploads_collection = db["uploads"]  # Resumable uploads in progress
+search_postings_collection = db["search_postings"]  # Inverted index: {term, conversation, bucket, ids}
+search_state_collection = db["search_state"]  # Backfill progress
+
+# Message writes are optionally group-committed: pending inserts/updates are
+# flushed together once WRITE_BATCH_SIZE are queued or WRITE_BATCH_DELAY_MS passes
+message_writer = WritePipeline(
+    messages_collection,
+    max_batch=int(os.getenv('WRITE_BATCH_SIZE', 100)),
+    max_delay=float(os.getenv('WRITE_BATCH_DELAY_MS', 2)) / 1000,
+    enabled=os.getenv('WRITE_BATCHING', 'False') == 'True'
+)
+group_writer = WritePipeline(
+    groups_collection,
+    max_batch=int(os.getenv('WRITE_BATCH_SIZE', 100)),
+    max_delay=float(os.getenv('WRITE_BATCH_DELAY_MS', 2)) / 1000,
+    enabled=os.getenv('WRITE_BATCHING', 'False') == 'True'
+)
+# Longest a request waits for its message to be flushed before failing
+WRITE_TIMEOUT = float(os.getenv('WRITE_TIMEOUT', 10))
+
+# Group metadata and member sets are cached; membership changes bump the
+# group's version and are invalidated on every worker through the router
+GROUP_FIELDS = {"name": 1, "members": 1, "admins": 1, "version": 1}
+
+def load_group(group_id):
+    return groups_collection.find_one({"_id": ObjectId(group_id)}, GROUP_FIELDS)
+
+def load_user_groups(email):
+    return groups_collection.find({"members": email}, GROUP_FIELDS)
+
+group_cache = GroupCache(
+    load_group, load_user_groups,
+    max_groups=int(os.getenv('GROUP_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('GROUP_CACHE_TTL', 300))
+)
+
+# Verified token claims are cached until the token expires, and user
+# profiles (never password hashes) in an LRU in front of a Bloom filter of
+# every registered email, so authenticating a request and addressing a
+# message normally reads nothing from Mongo
+def verify_token(token):
+    return jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+
+def load_users(emails):
+    return users_collection.find({"email": {"$in": emails}}, {"password": 0, "status": 0, "last_seen": 0})
+
+def load_all_emails():
+    return (user["email"] for user in users_collection.find({}, {"email": 1, "_id": 0}))
+
+token_cache = TokenCache(verify_token, max_size=int(os.getenv('TOKEN_CACHE_SIZE', 50000)))
+user_cache = UserCache(
+    load_users, load_all_emails,
+    max_users=int(os.getenv('USER_CACHE_SIZE', 50000)),
+    ttl=float(os.getenv('USER_CACHE_TTL', 300))
+)
+USER_FILTER_REFRESH = float(os.getenv('USER_FILTER_REFRESH', 600))
+
+# History paging defaults
+DEFAULT_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 200))
+
+# The newest messages of active conversations stay in memory so opening a
+# chat doesn't hit Mongo; only older pages are read from the database
+history_cache = HotConversationCache(
+    capacity=int(os.getenv('HOT_CONVERSATION_MESSAGES', 100)),
+    max_bytes=int(os.getenv('HOT_CONVERSATION_BYTES', 64 * 1024 * 1024)),
+    ttl=float(os.getenv('HOT_CONVERSATION_TTL', 30))
+)
+
+# Full-text search over an inverted index that the message write path keeps
+# current. Postings are written in large unordered batches off the send path;
+# messages stored before the index existed are indexed by a resumable backfill.
+SEARCH_DEFAULT_LIMIT = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+SEARCH_MAX_LIMIT = int(os.getenv('SEARCH_MAX_PAGE_SIZE', 100))
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', 500))  # Deepest result reachable by paging
+search_writer = WritePipeline(
+    search_postings_collection,
+    max_batch=int(os.getenv('SEARCH_WRITE_BATCH', 500)),
+    max_delay=float(os.getenv('SEARCH_WRITE_DELAY_MS', 50)) / 1000,
+    ordered=False
+)
+search_index = SearchIndex(
+    search_postings_collection, messages_collection, search_state_collection, search_writer,
+    max_candidates=int(os.getenv('SEARCH_MAX_CANDIDATES', 20000))
+)
+
+# Media files are stored once per content hash under MEDIA_ROOT. Images get
+# downscaled variants rendered in a process pool (needs Pillow).
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+MEDIA_MAX_SIZE = int(os.getenv('MEDIA_MAX_SIZE', 50 * 1024 * 1024))
+MEDIA_CHUNK_SIZE = int(os.getenv('MEDIA_CHUNK_SIZE', 4 * 1024 * 1024))  # Largest chunk per request
+MEDIA_MAX_AGE = int(os.getenv('MEDIA_MAX_AGE', 7 * 24 * 3600))  # Browser cache lifetime of a file
+UPLOAD_TTL = float(os.getenv('UPLOAD_TTL', 24 * 3600))
+UPLOAD_CHUNK_LEASE = float(os.getenv('UPLOAD_CHUNK_LEASE', 300))  # Longest a chunk may hold its upload
+MEDIA_VARIANTS = {"thumb": int(os.getenv('MEDIA_THUMB_SIZE', 320)), "preview": int(os.getenv('MEDIA_PREVIEW_SIZE', 1280))}
+# Served inline; anything else is sent as an attachment so it can't run as a page
+INLINE_MEDIA_TYPES = ("image/", "audio/", "video/")
+# Let a fronting server send the file (X-Sendfile); otherwise files go out
+# through the WSGI server's file wrapper, which uses sendfile() where it can
+app.config['USE_X_SENDFILE'] = os.getenv('MEDIA_X_SENDFILE', 'False') == 'True'
+
+media_store = MediaStore(
+    MEDIA_ROOT, variants=MEDIA_VARIANTS,
+    workers=int(os.getenv('MEDIA_WORKERS', 1)),
+    max_pending=int(os.getenv('MEDIA_QUEUE_SIZE', 16))
+)
+media_store.start_sweeper(UPLOAD_TTL)
+
+# Normalized key for a 1:1 conversation, identical for both participants
+def conversation_key(a, b):
+    return "|".join(sorted((a, b)))
+
+# Create the indexes the hot query shapes rely on; safe to run on every start
+def ensure_indexes():
+    try:
+        users_collection.create_index("email", unique=True)
+        users_collection.create_index([("updated_at", 1), ("_id", 1)])
+        users_collection.update_many(
+            {"updated_at": {"$exists": False}},
+            [{"$set": {"updated_at": {"$ifNull": ["$last_seen", "$created_at"]}}}]
+        )
+        messages_collection.create_index([("conversation", 1), ("timestamp", 1), ("_id", 1)])
+        messages_collection.create_index([("group_id", 1), ("timestamp", 1), ("_id", 1)])
+        messages_collection.create_index([("conversation", 1), ("seq", 1)])
+        groups_collection.create_index("members")
+        groups_collection.create_index([("members", 1), ("last_activity", -1), ("_id", -1)])
+        # Presence peer lookups use distinct() over these
+        messages_collection.create_index([("sender", 1), ("receiver", 1)])
+        messages_collection.create_index([("receiver", 1), ("sender", 1)])
+        # Backfill the conversation key on 1:1 messages written before it existed
+        messages_collection.update_many(
+            {"receiver": {"$exists": True}, "conversation": {"$exists": False}},
+            [{"$set": {"conversation": {"$cond": [
+                {"$lt": ["$sender", "$receiver"]},
+                {"$concat": ["$sender", "|", "$receiver"]},
+                {"$concat": ["$receiver", "|", "$sender"]}
+            ]}}}]
+        )
+        conversations_collection.create_index("participants")
+        read_cursors_collection.create_index([("user", 1), ("conversation", 1)], unique=True)
+        # Abandoned uploads expire; their partial files are swept from disk
+        uploads_collection.create_index("created_at", expireAfterSeconds=int(UPLOAD_TTL))
+        search_index.ensure_indexes()
+        backfill_group_summaries()
+        # Read state now lives in read_cursors; drop the per-group counters
+        groups_collection.update_many({"unread": {"$exists": True}}, {"$unset": {"unread": ""}})
+    except Exception as e:
+        app.logger.error(f"Index bootstrap failed: {str(e)}")
+
+# One-off fill of last_message/last_activity for groups created before
+# they were maintained by the write path
+def backfill_group_summaries():
+    groups = list(groups_collection.find({"last_activity": {"$exists": False}}, {"created_at": 1, "members": 1}))
+    if not groups:
+        return
+    latest = {
+        row["_id"]: row["last"] for row in messages_collection.aggregate([
+            {"$match": {"group_id": {"$in": [str(g["_id"]) for g in groups]}}},
+            {"$sort": {"group_id": 1, "timestamp": 1}},
+            {"$group": {"_id": "$group_id", "last": {"$last": "$$ROOT"}}}
+        ])
+    }
+    updates = []
+    for group in groups:
+        last = latest.get(str(group["_id"]))
+        fields = {
+            "last_activity": last["timestamp"] if last else group.get("created_at", datetime.utcnow()),
+            "last_message": message_summary(last) if last else None,
+            "seq": last.get("seq", 0) if last else 0
+        }
+        updates.append(UpdateOne({"_id": group["_id"]}, {"$set": fields}))
+    groups_collection.bulk_write(updates, ordered=False)
+
+# Denormalized preview of a group's newest message
+def message_summary(message):
+    summary = {
+        "_id": str(message["_id"]),
+        "sender": message["sender"],
+        "content": message["content"],
+        "timestamp": message["timestamp"]
+    }
+    if message.get("media"):
+        summary["media"] = message["media"]
+    return summary
+
+# Keep the group's last_message, last_activity and latest seq current; unread
+# counts are derived from seq and each member's read cursor
+def record_group_message(group_id, message):
+    # One pipeline update; the preview is guarded so a slower writer can't
+    # replace a newer one
+    timestamp = message["timestamp"]
+    group_writer.update(
+        {"_id": ObjectId(group_id)},
+        [{"$set": {
+            "seq": {"$max": ["$seq", message["seq"]]},
+            "last_message": {"$cond": [
+                {"$lt": ["$last_activity", timestamp]},
+                {"$literal": message_summary(message)},
+                "$last_message"
+            ]},
+            "last_activity": {"$max": ["$last_activity", timestamp]}
+        }}]
+    )
+
+# Allocate the next sequence number in a 1:1 conversation or group
+def next_seq(conversation, participants=None):
+    update = {"$inc": {"seq": 1}}
+    if participants:
+        update["$setOnInsert"] = {"participants": participants}
+    counter = conversations_collection.find_one_and_update(
+        {"_id": conversation},
+        update,
+        projection={"seq": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+# Persist a 1:1 message and return it ready to serialize. ``media`` is a
+# reference from media_reference(); the file itself is fetched separately.
+def save_direct_message(sender, receiver, content, media=None):
+    conversation = conversation_key(sender, receiver)
+    message = {
+        "sender": sender,
+        "receiver": receiver,
+        "conversation": conversation,
+        "seq": next_seq(conversation, [sender, receiver]),
+        "content": content,
+        "timestamp": datetime.utcnow()
+    }
+    if media:
+        message["media"] = media
+    message_id = message_writer.insert(message).result(timeout=WRITE_TIMEOUT)
+    search_index.add(message)
+    message["_id"] = str(message_id)
+    message["timestamp"] = message["timestamp"].isoformat()
+    publish_history_append(message)
+    presence.add_peers(sender, [receiver])
+    presence.add_peers(receiver, [sender])
+    return message
+
+# Persist a group message, update the group summary and return the message
+def save_group_message(sender, group_id, content, media=None):
+    message = {
+        "sender": sender,
+        "group_id": group_id,
+        "conversation": group_id,
+        "seq": next_seq(group_id),
+        "content": content,
+        "timestamp": datetime.utcnow()
+    }
+    if media:
+        message["media"] = media
+    message_id = message_writer.insert(message).result(timeout=WRITE_TIMEOUT)
+    search_index.add(message)
+    message["_id"] = str(message_id)
+    record_group_message(group_id, message)
+    message["timestamp"] = message["timestamp"].isoformat()
+    publish_history_append(message)
+    return message
+
+# Reconnect catch-up: the auth frame may carry {"last_seq": {conversation: seq}}
+# and only messages after those sequence numbers are replayed, in batches
+CATCHUP_BATCH = int(os.getenv('CATCHUP_BATCH', 100))
+CATCHUP_MAX = int(os.getenv('CATCHUP_MAX', 2000))
+CATCHUP_MAX_CONVERSATIONS = int(os.getenv('CATCHUP_MAX_CONVERSATIONS', 200))
+
+def can_access_conversation(email, conversation):
+    if "|" in conversation:
+        return email in conversation.split("|")
+    try:
+        return group_cache.get_for_member(conversation, email) is not None
+    except Exception:
+        return False
+
+def catch_up_frames(email, last_seq):
+    if not isinstance(last_seq, dict):
+        return []
+    wanted = {}
+    for conversation, seq in list(last_seq.items())[:CATCHUP_MAX_CONVERSATIONS]:
+        if isinstance(seq, int) and can_access_conversation(email, str(conversation)):
+            wanted[str(conversation)] = seq
+    if not wanted:
+        return []
+
+    # The counters tell us how much was missed without touching messages
+    latest = {c["_id"]: c["seq"] for c in conversations_collection.find({"_id": {"$in": list(wanted)}})}
+    frames = []
+    budget = CATCHUP_MAX
+    for conversation, seq in wanted.items():
+        missed = latest.get(conversation, 0) - seq
+        if missed <= 0:
+            continue
+        if missed > budget:
+            # Too far behind to replay; the client refetches history instead
+            frames.append(dumps({"type": "refresh", "conversation": conversation}))
+            continue
+        budget -= missed
+        batch = []
+        cursor = messages_collection.find(
+            {"conversation": conversation, "seq": {"$gt": seq}}
+        ).sort("seq", 1).batch_size(CATCHUP_BATCH)
+        for message in cursor:
+            batch.append(message)
+            if len(batch) == CATCHUP_BATCH:
+                frames.append(dumps({"type": "catchup", "conversation": conversation, "messages": batch}))
+                batch = []
+        if batch:
+            frames.append(dumps({"type": "catchup", "conversation": conversation, "messages": batch}))
+    frames.append(dumps({"type": "catchup_done"}))
+    return frames
+
+# Read state is one "read up to seq" cursor per user per conversation. Readers
+# are announced with a coalesced 'read' frame per conversation.
+def emit_read_receipts(conversation, readers, recipients):
+    broadcast(recipients, {"type": "read", "conversation": conversation, "readers": readers})
+
+read_receipts = ReceiptBatcher(emit_read_receipts, interval=float(os.getenv('READ_RECEIPT_INTERVAL', 0.25)))
+
+def latest_seq(conversation):
+    counter = conversations_collection.find_one({"_id": conversation}, {"seq": 1})
+    return counter["seq"] if counter else 0
+
+# Senders have read everything up to their own message. Rather than moving
+# their cursor on every send, unread counts start after the newest message
+# the user sent past their cursor; only conversations with something past
+# the cursor are looked at, and only that tail of each is scanned
+def unread_counts(email, latest, cursors):
+    """{conversation: unread} from {conversation: latest seq} and the user's cursors."""
+    behind = {c: cursors.get(c, 0) for c, seq in latest.items() if seq > cursors.get(c, 0)}
+    if not behind:
+        return {}
+    own = {
+        row["_id"]: row["seq"] for row in messages_collection.aggregate([
+            {"$match": {"sender": email, "$or": [
+                {"conversation": c, "seq": {"$gt": seq}} for c, seq in behind.items()
+            ]}},
+            {"$group": {"_id": "$conversation", "seq": {"$max": "$seq"}}}
+        ])
+    }
+    return {c: latest[c] - max(seq, own.get(c, 0)) for c, seq in behind.items()}
+
+def mark_read(email, conversation, seq, recipients):
+    read_cursors_collection.update_one(
+        {"user": email, "conversation": conversation},
+        {"$max": {"seq": seq}},
+        upsert=True
+    )
+    read_receipts.add(conversation, email, seq, [r for r in recipients if r != email])
+
+def direct_message_frame(message):
+    frame = {
+        "type": "message",
+        "_id": message["_id"],
+        "sender": message["sender"],
+        "content": message["content"],
+        "timestamp": message["timestamp"],
+        "conversation": message["conversation"],
+        "seq": message["seq"]
+    }
+    if message.get("media"):
+        frame["media"] = message["media"]
+    return frame
+
+ensure_indexes()
+user_cache.load()
+if USER_FILTER_REFRESH > 0:
+    user_cache.start_refresher(USER_FILTER_REFRESH)
+if os.getenv('SEARCH_BACKFILL', 'True') == 'True':
+    search_index.start_backfill()
+# A user can have several sockets open at once (the GroupChat page opens its own)
+active_connections = {}  # Track active WebSocket connections {email: set(ClientConnection)}
+connections_lock = threading.Lock()
+
+# Group deliveries go to the connections that joined the group, not to every member
+subscriptions = SubscriptionIndex()
+
+def connections_of(email):
+    with connections_lock:
+        return list(active_connections.get(email, ()))
+
+def count_connections():
+    with connections_lock:
+        return sum(len(conns) for conns in active_connections.values())
+
+def count_connected_users():
+    with connections_lock:
+        return len(active_connections)
+
+metrics.gauge("chat_ws_connections", "Open /ws connections on this worker.", collect=count_connections)
+metrics.gauge("chat_ws_connected_users", "Users with at least one open /ws connection here.",
+              collect=count_connected_users)
+metrics.gauge("chat_group_subscriptions", "Connection subscriptions to groups on this worker.",
+              collect=lambda: subscriptions.snapshot()["subscriptions"])
+metrics.gauge("chat_subscribed_groups", "Groups with at least one subscribed connection here.",
+              collect=lambda: subscriptions.snapshot()["groups"])
+
+# Outbound delivery configuration
+OUTBOX_SIZE = int(os.getenv('WS_OUTBOX_SIZE', 256))
+OUTBOX_OVERFLOW = os.getenv('WS_OVERFLOW_POLICY', 'drop_oldest')
+SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 10))
+delivery_stats = DeliveryStats()
+outbox_watchdog = Watchdog()
+metrics.counter("chat_outbox_frames_total", "Outbound /ws frames by outcome.", ("outcome",),
+                collect=delivery_stats.snapshot)
+
+# Sender ids for compact connections are shared by the whole worker
+sender_table = SenderTable()
+
+def open_outbox(ws, user_email, session):
+    outbox = Outbox(ws, maxsize=OUTBOX_SIZE, overflow=OUTBOX_OVERFLOW,
+                    send_timeout=SEND_TIMEOUT, name=user_email, stats=delivery_stats,
+                    prepare=None if session.passthrough else session.prepare,
+                    send_timer=ws_send_seconds.observe)
+    outbox_watchdog.watch(outbox)
+    return outbox
+
+def close_outbox(outbox):
+    outbox_watchdog.unwatch(outbox)
+    outbox.close()
+
+# Cross-worker routing: every delivery is published and each worker
+# delivers only to the sockets it owns. Workers heartbeat through the broker;
+# users of a worker silent for PRESENCE_WORKER_TIMEOUT seconds go offline.
+ROUTER_HEARTBEAT = float(os.getenv('ROUTER_HEARTBEAT', 5))
+router = create_router(
+    os.getenv('ROUTER_URL', 'local'),
+    heartbeat=ROUTER_HEARTBEAT,
+    max_pending=int(os.getenv('ROUTER_MAX_PENDING', 10000))
+)
+
+# Presence lives in memory; Mongo status/last_seen is written in periodic batches
+PRESENCE_DEBOUNCE = float(os.getenv('PRESENCE_DEBOUNCE', 2))
+PRESENCE_FLUSH_INTERVAL = float(os.getenv('PRESENCE_FLUSH_INTERVAL', 5))
+PRESENCE_WORKER_TIMEOUT = float(os.getenv('PRESENCE_WORKER_TIMEOUT', ROUTER_HEARTBEAT * 3))
+
+# Users who share a 1:1 conversation or a group with this user
+def load_peers(email):
+    peers = set()
+    for group_id in group_cache.groups_of(email):
+        peers.update(group_cache.members(group_id))
+    peers.update(messages_collection.distinct("receiver", {"sender": email}))
+    peers.update(messages_collection.distinct("sender", {"receiver": email}))
+    peers.discard(None)
+    return peers
+
+def announce_presence(email, status, peers):
+    broadcast(peers, {
+        "type": "status",
+        "user": email,
+        "status": status
+    }, kind="status")
+
+def write_presence_batch(updates):
+    now = datetime.utcnow()
+    users_collection.bulk_write(
+        [UpdateOne({"email": email}, {"$set": {**fields, "updated_at": now}}) for email, fields in updates.items()],
+        ordered=False
+    )
+
+presence = PresenceRegistry(load_peers, announce_presence, write_presence_batch,
+                            debounce=PRESENCE_DEBOUNCE, flush_interval=PRESENCE_FLUSH_INTERVAL,
+                            worker_timeout=PRESENCE_WORKER_TIMEOUT)
+atexit.register(presence.flush)
+
+def is_online(email):
+    return presence.is_online(email)
+
+def handle_routed_event(event):
+    event_type = event.get('type')
+    if event_type == 'deliver':
+        exclude = event.get('exclude')
+        conns = []
+        for email in event['users']:
+            if email != exclude:
+                conns.extend(connections_of(email))
+        fanout_recipients.observe(len(conns), "user")
+        deliver_local(conns, event['frame'], event.get('kind'))
+    elif event_type == 'deliver_group':
+        exclude = event.get('exclude')
+        exclude_connection = event.get('exclude_connection')
+        conns = [conn for conn in subscriptions.subscribers(event['group_id'])
+                 if conn.user_email != exclude and conn.id != exclude_connection]
+        fanout_recipients.observe(len(conns), "group")
+        deliver_local(conns, event['frame'], event.get('kind'))
+    elif event_type == 'presence':
+        if event['worker'] != router.worker_id:
+            presence.set_remote(event['user'], event['worker'], event['online'])
+    elif event_type == 'history_append':
+        message = event['message']
+        history_cache.append({
+            **message,
+            "_id": ObjectId(message["_id"]),
+            "timestamp": datetime.fromisoformat(message["timestamp"])
+        })
+    elif event_type == 'user_changed':
+        if event.get('registered'):
+            user_cache.added(event['email'])
+        else:
+            user_cache.invalidate(event['email'])
+            token_cache.invalidate_user(event['email'])
+    elif event_type == 'group_invalidate':
+        group_cache.invalidate(event['group_id'], event.get('version'), event.get('members', ()))
+        unsubscribe_non_members(event['group_id'], event.get('members', ()), event.get('current'))
+        # Peer sets are cached on whichever worker holds each member's socket
+        for member in event.get('current', ()):
+            presence.add_peers(member, event['current'])
+    elif event_type == 'presence_snapshot':
+        if event['worker'] != router.worker_id:
+            presence.set_remote_users(event['worker'], event['users'])
+    elif event_type == 'heartbeat':
+        if event['worker'] != router.worker_id:
+            presence.worker_alive(event['worker'])
+    elif event_type == 'worker_gone':
+        if event['worker'] != router.worker_id:
+            presence.drop_worker(event['worker'])
+        else:
+            # Our previous connection's departure, seen after reconnecting
+            publish_presence_snapshot()
+    elif event_type == 'presence_sync':
+        if event['worker'] != router.worker_id:
+            publish_presence_snapshot()
+
+def deliver_local(conns, frame, kind):
+    encoded = {}  # One encoding per wire format, shared by every recipient
+    for conn in conns:
+        session = conn.session
+        if session.encoding not in encoded:
+            encoded[session.encoding] = session.encode_text(frame)
+        conn.outbox.put(encoded[session.encoding], kind)
+
+# Members removed from a group stop receiving it on every socket they have here.
+# ``current`` is the membership after the change; the cache entry has just been
+# invalidated, so without it the group is reloaded
+def unsubscribe_non_members(group_id, changed, current=None):
+    conns = [conn for email in changed for conn in connections_of(email)
+             if subscriptions.is_subscribed(group_id, conn)]
+    if not conns:
+        return
+    if current is None:
+        group = group_cache.get(group_id)
+        current = group.get("members", ()) if group else ()
+    members = set(current)
+    for conn in conns:
+        if conn.user_email not in members and subscriptions.unsubscribe(group_id, conn):
+            conn.reply({"type": "group_left", "group_id": group_id})
+
+def publish_group_change(group_id, version, members, current):
+    router.publish({"type": "group_invalidate", "group_id": group_id, "version": version,
+                    "members": list(members), "current": list(current)})
+
+# Every worker keeps its hot-conversation buffers in step with all writes
+def publish_history_append(message):
+    router.publish({"type": "history_append", "message": message})
+
+# Registration and profile changes reach the user and token caches of every worker
+def publish_user_change(email, registered=False):
+    router.publish({"type": "user_changed", "email": email, "registered": registered})
+
+def publish_presence(email, online):
+    router.publish({"type": "presence", "user": email, "online": online, "worker": router.worker_id})
+
+# Everyone connected here, replacing what other workers knew about this one
+def publish_presence_snapshot():
+    router.publish({"type": "presence_snapshot", "worker": router.worker_id, "users": presence.local_users()})
+
+# After every (re)connection to the broker: other workers may have dropped
+# this worker's users, and this worker may have missed their changes
+def on_router_connect():
+    # Appends published while disconnected never reached the history buffers
+    history_cache.clear()
+    publish_presence_snapshot()
+    router.publish({"type": "presence_sync", "worker": router.worker_id})
+    if router.stats["reconnects"] > 1:
+        # Registrations published while disconnected never reached the filter
+        reload_user_filter()
+
+def reload_user_filter():
+    threading.Thread(target=user_cache.load, name="user-filter", daemon=True).start()
+
+# Publish a payload for a user; never blocks on the socket
+def send_to_user(email, payload, kind=None):
+    if not email or not is_online(email):
+        return False
+    router.publish({"type": "deliver", "users": [email], "frame": dumps(payload), "kind": kind})
+    return True
+
+# Publish the same payload for several users, encoding it only once
+def broadcast(emails, payload, kind=None, exclude=None):
+    users = [email for email in emails if email != exclude and is_online(email)]
+    if users:
+        router.publish({"type": "deliver", "users": users, "frame": dumps(payload), "kind": kind})
+    return len(users)
+
+# Publish a payload for a group's subscribers. Each worker delivers to the
+# connections that joined the group there, so this never walks the member list
+def broadcast_group(group_id, payload, kind=None, exclude=None, exclude_connection=None):
+    router.publish({
+        "type": "deliver_group",
+        "group_id": group_id,
+        "frame": dumps(payload),
+        "kind": kind,
+        "exclude": exclude,
+        "exclude_connection": exclude_connection
+    })
+
+# Per-connection limits per frame type as "type=rate/burst" (rate per second).
+# Throttled chatter is dropped; throttled messages are answered with an error
+# carrying the client_id so the client can retry.
+WS_RATE_LIMITS = parse_limits(os.getenv(
+    'WS_RATE_LIMITS',
+    'typing=4/8,ping=0.2/2,status_request=5/20,read=10/30,join_group=5/20,leave_group=5/20,'
+    'message=10/30,group_message=10/30'
+))
+SILENTLY_THROTTLED = {"typing", "ping", "status_request", "read"}
+throttle_stats = ThrottleStats()
+metrics.counter("chat_ws_throttled_frames_total", "Incoming /ws frames dropped by the rate limiter.", ("type",),
+                collect=lambda: throttle_stats.snapshot()["throttled"])
+
+# Typing indicators are forwarded as state transitions only, at most once per
+# window per conversation, and expire if the client stops refreshing them
+def emit_typing(sender, target, is_typing):
+    kind, key = target
+    if kind == "group":
+        broadcast_group(key, {
+            "type": "typing",
+            "sender": sender,
+            "group_id": key,
+            "isTyping": is_typing
+        }, kind="typing", exclude=sender)
+    else:
+        send_to_user(key, {
+            "type": "typing",
+            "sender": sender,
+            "isTyping": is_typing
+        }, kind="typing")
+
+typing_coalescer = TypingCoalescer(
+    emit_typing,
+    window=float(os.getenv('TYPING_WINDOW', 1)),
+    expiry=float(os.getenv('TYPING_EXPIRY', 6)),
+    stats=throttle_stats
+)
+
+def on_router_drop(event):
+    # No worker sees the append, so the buffers can no longer be trusted
+    if event["type"] == "history_append":
+        history_cache.clear()
+    elif event["type"] == "user_changed" and event.get("registered"):
+        reload_user_filter()
+
+router.start(handle_routed_event, on_connect=on_router_connect, on_drop=on_router_drop)
 
 # Middleware to handle CORS headers dynamically
 @app.after_request
@@ -45,8 +763,24 @@ def apply_cors_headers(response):
     if origin and origin in allowed_origins:
         response.headers["Access-Control-Allow-Origin"] = origin
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, If-None-Match"
     response.headers["Access-Control-Allow-Credentials"] = "true"
+    response.headers["Access-Control-Expose-Headers"] = "X-Cursor-Before, X-Cursor-After, X-Has-More, ETag"
+    return response
+
+# Per-route latency; the /ws route only returns when its socket closes, so
+# frames are timed in ClientConnection.handle instead
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    rule = request.url_rule
+    started = g.get('request_started')
+    if started is not None and (rule is None or rule.endpoint != 'websocket'):
+        http_request_seconds.observe(time.perf_counter() - started,
+                                     rule.rule if rule else "unmatched", request.method, response.status_code)
     return response
 
 # Preflight response helper
@@ -57,7 +791,7 @@ def options_preflight(path):
     if origin and origin in allowed_origins:
         response.headers["Access-Control-Allow-Origin"] = origin
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, If-None-Match"
     response.headers["Access-Control-Allow-Credentials"] = "true"
     response.headers["Access-Control-Max-Age"] = "86400"
     return response
@@ -68,11 +802,82 @@ def handle_errors(f):
     def wrapper(*args, **kwargs):
         try:
             return f(*args, **kwargs)
+        except HashingBusy:
+            return jsonify({"message": "Server busy, please retry"}), 503, {"Retry-After": "1"}
         except Exception as e:
             app.logger.error(f"Error in {f.__name__}: {str(e)}")
             return jsonify({"error": "Internal server error"}), 500
     return wrapper
 
+# Cursors are "<iso timestamp>_<object id>" and order documents by (timestamp, _id)
+def encode_cursor(timestamp, oid):
+    return f"{timestamp.isoformat()}_{oid}"
+
+def decode_cursor(cursor):
+    timestamp, _, oid = cursor.rpartition("_")
+    return datetime.fromisoformat(timestamp), ObjectId(oid)
+
+# Fetch one page of history for a base query, oldest first. The first page
+# of a conversation comes from the hot-conversation cache when possible.
+def fetch_history_page(query, args, conversation=None):
+    try:
+        limit = min(max(int(args.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        before = decode_cursor(args["before"]) if args.get("before") else None
+        after = decode_cursor(args["after"]) if args.get("after") else None
+    except (ValueError, TypeError):
+        raise ValueError("Invalid pagination parameters")
+
+    if conversation and not before and not after:
+        cached = history_cache.page(conversation, limit)
+        if cached:
+            return cached
+        if limit < history_cache.capacity:
+            return fill_history_cache(query, conversation, limit)
+
+    if after:
+        ts, oid = after
+        query = {**query, "$or": [{"timestamp": {"$gt": ts}}, {"timestamp": ts, "_id": {"$gt": oid}}]}
+        direction = 1
+    else:
+        if before:
+            ts, oid = before
+            query = {**query, "$or": [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "_id": {"$lt": oid}}]}
+        direction = -1
+
+    # Fetch one extra document to know whether another page exists
+    messages = list(messages_collection.find(query).sort(
+        [("timestamp", direction), ("_id", direction)]
+    ).limit(limit + 1))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if direction == -1:
+        messages.reverse()
+    return messages, has_more
+
+# Read a full buffer's worth of the newest messages and serve the page from it
+def fill_history_cache(query, conversation, limit):
+    capacity = history_cache.capacity
+    history_cache.begin_fill(conversation)
+    try:
+        newest = list(messages_collection.find(query).sort(
+            [("timestamp", -1), ("_id", -1)]
+        ).limit(capacity + 1))
+    except Exception:
+        history_cache.cancel_fill(conversation)
+        raise
+    has_older = len(newest) > capacity
+    newest = newest[:capacity]
+    newest.reverse()
+    history_cache.fill(conversation, newest, has_older)
+    return newest[-limit:], len(newest) > limit or has_older
+
+def history_response(messages, has_more):
+    headers = {"X-Has-More": "true" if has_more else "false"}
+    if messages:
+        headers["X-Cursor-Before"] = encode_cursor(messages[0]["timestamp"], messages[0]["_id"])
+        headers["X-Cursor-After"] = encode_cursor(messages[-1]["timestamp"], messages[-1]["_id"])
+    return jsonify(messages), 200, headers
+
 # JWT authentication middleware
 def token_required(f):
     @wraps(f)
@@ -83,7 +888,7 @@ def token_required(f):
         try:
             if token.startswith("Bearer "):
                 token = token.split(" ")[1]
-            payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            payload = token_cache.claims(token)
             request.user_email = payload['email']  # Add user email to request object
         except jwt.ExpiredSignatureError:
             return jsonify({"message": "Token has expired"}), 401
@@ -104,11 +909,13 @@ def login():
         return jsonify({"message": "Email and password are required"}), 400
 
     user = users_collection.find_one({"email": email})
-    if user and bcrypt.check_password_hash(user["password"], password):
-        users_collection.update_one(
-            {"email": email},
-            {"$set": {"status": "online", "last_seen": datetime.utcnow()}}
-        )
+    if user and hasher.check(user["password"], password):
+        presence.touch(email)
+        if hasher.needs_rehash(user["password"]):
+            # Upgrade the stored hash to the configured cost without delaying the login
+            hasher.rehash_later(password, lambda hashed: users_collection.update_one(
+                {"email": email}, {"$set": {"password": hashed}}
+            ))
         
         token = jwt.encode({
             "email": user["email"],
@@ -136,76 +943,86 @@ def register():
     if len(password) < 6:
         return jsonify({"message": "Password must be at least 6 characters long"}), 400
 
-    if users_collection.find_one({"email": email}):
+    # The unique index on email catches what a stale filter lets through
+    if user_cache.exists(email):
         return jsonify({"message": "User already exists"}), 400
 
-    hashed_password = bcrypt.generate_password_hash(password).decode("utf-8")
-    users_collection.insert_one({
-        "email": email, 
-        "password": hashed_password, 
-        "status": "offline",
-        "last_seen": datetime.utcnow(),
-        "created_at": datetime.utcnow()
-    })
+    hashed_password = hasher.hash(password)
+    try:
+        users_collection.insert_one({
+            "email": email, 
+            "password": hashed_password, 
+            "status": "offline",
+            "last_seen": datetime.utcnow(),
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        return jsonify({"message": "User already exists"}), 400
+    publish_user_change(email, registered=True)
     
     return jsonify({"message": "User registered successfully"}), 201
 
+# Contacts are synced incrementally: each page is ordered by (updated_at, _id)
+# and X-Cursor-After is the updated_since value for the next call. Users
+# changed within the settle window are held back so a write that commits
+# late can never land behind a cursor the client already holds.
+CONTACTS_SETTLE_SECONDS = float(os.getenv('CONTACTS_SETTLE_SECONDS', 1))
+
 @app.route("/api/contacts", methods=["GET"])
 @token_required
 @handle_errors
 def get_contacts():
-    contacts = list(users_collection.find(
-        {"email": {"$ne": request.user_email}},
-        {"password": 0}
-    ).sort("status", -1))
-    
-    for contact in contacts:
-        contact["_id"] = str(contact["_id"])
-        for key, value in list(contact.items()):
-            if isinstance(value, bytes):
-                app.logger.info(f"Found bytes in field {key}: {value}")
-                try:
-                    contact[key] = value.decode('utf-8')
-                except UnicodeDecodeError:
-                    app.logger.warning(f"UTF-8 decode failed for {key}: {value}, using hex")
-                    contact[key] = value.hex()
-        
-        last_seen = contact.get("last_seen", datetime.utcnow())
-        time_diff = datetime.utcnow() - last_seen
-        if time_diff < timedelta(minutes=1):
-            contact["last_seen_text"] = "just now"
-        elif time_diff < timedelta(hours=1):
-            mins = int(time_diff.total_seconds() / 60)
-            contact["last_seen_text"] = f"{mins} min ago"
-        elif time_diff < timedelta(days=1):
-            hours = int(time_diff.total_seconds() / 3600)
-            contact["last_seen_text"] = f"{hours} hour{'s' if hours > 1 else ''} ago"
-        else:
-            days = int(time_diff.total_seconds() / 86400)
-            contact["last_seen_text"] = f"{days} day{'s' if days > 1 else ''} ago"
+    try:
+        limit = min(max(int(request.args.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        since = decode_cursor(request.args["updated_since"]) if request.args.get("updated_since") else None
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid pagination parameters"}), 400
+    
+    query = {
+        "email": {"$ne": request.user_email},
+        "updated_at": {"$lte": datetime.utcnow() - timedelta(seconds=CONTACTS_SETTLE_SECONDS)}
+    }
+    if since:
+        ts, oid = since
+        query["$or"] = [{"updated_at": {"$gt": ts}}, {"updated_at": ts, "_id": {"$gt": oid}}]
     
-    return jsonify(contacts), 200
+    contacts = list(users_collection.find(query, {"password": 0})
+                    .sort([("updated_at", 1), ("_id", 1)]).limit(limit + 1))
+    has_more = len(contacts) > limit
+    contacts = contacts[:limit]
+    
+    headers = {"X-Has-More": "true" if has_more else "false"}
+    if contacts:
+        headers["X-Cursor-After"] = encode_cursor(contacts[-1]["updated_at"], contacts[-1]["_id"])
+    elif since:
+        headers["X-Cursor-After"] = request.args["updated_since"]
+    
+    etag = hashlib.sha1("|".join(
+        f"{c['_id']}:{c['updated_at'].isoformat()}" for c in contacts
+    ).encode("utf-8")).hexdigest()
+    if request.if_none_match.contains(etag):
+        return "", 304, {**headers, "ETag": f'"{etag}"'}
+    
+    response = make_response(jsonify(contacts), 200, headers)
+    response.set_etag(etag)
+    return response
 
 # Get messages between users
 @app.route("/api/messages/<contact_email>", methods=["GET"])
 @token_required
 @handle_errors
 def get_messages(contact_email):
-    if not users_collection.find_one({"email": contact_email}):
+    if not user_cache.exists(contact_email):
         return jsonify({"message": "Contact not found"}), 404
     
-    messages = list(messages_collection.find({
-        "$or": [
-            {"sender": request.user_email, "receiver": contact_email},
-            {"sender": contact_email, "receiver": request.user_email}
-        ]
-    }).sort("timestamp", 1))
-    
-    for message in messages:
-        message["_id"] = str(message["_id"])
-        message["timestamp"] = message["timestamp"].isoformat()
+    try:
+        conversation = conversation_key(request.user_email, contact_email)
+        messages, has_more = fetch_history_page({"conversation": conversation}, request.args, conversation)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
     
-    return jsonify(messages), 200
+    return history_response(messages, has_more)
 
 # Send message
 @app.route("/api/messages/send", methods=["POST"])
@@ -215,202 +1032,282 @@ def send_message():
     data = request.get_json()
     receiver = data.get("receiver")
     content = data.get("content")
+    media = media_reference(data.get("media"), data.get("media_name")) if data.get("media") else None
+    
+    if data.get("media") and not media:
+        return jsonify({"message": "Media not found"}), 404
     
-    if not receiver or not content:
+    if not receiver or not (content or media):
         return jsonify({"message": "Receiver and content are required"}), 400
     
-    if not users_collection.find_one({"email": receiver}):
+    if not user_cache.exists(receiver):
         return jsonify({"message": "Receiver not found"}), 404
     
-    message = {
-        "sender": request.user_email,
-        "receiver": receiver,
-        "content": content,
-        "timestamp": datetime.utcnow(),
-        "read": False
-    }
-    result = messages_collection.insert_one(message)
-    message["_id"] = str(result.inserted_id)
-    message["timestamp"] = message["timestamp"].isoformat()
+    message = save_direct_message(request.user_email, receiver, content or "", media)
+    presence.touch(request.user_email)
     
-    users_collection.update_one(
-        {"email": request.user_email},
-        {"$set": {"last_seen": datetime.utcnow()}}
-    )
+    send_to_user(receiver, direct_message_frame(message))
     
-    if receiver in active_connections:
+    return jsonify(message), 201
+
+# Real-time frame protocol. Transport-agnostic: the flask_sock endpoint below
+# and the asyncio gateway (gateway.py) both authenticate with
+# authenticate_client() and then feed every frame to a ClientConnection. All
+# data-layer calls happen here, synchronously; the gateway runs them on a
+# small thread pool instead of holding a thread per socket.
+class AuthFailed(Exception):
+    pass
+
+def authenticate_client(data):
+    """Validate the first frame on a socket. Returns (user_email, auth frame)."""
+    try:
+        token_msg = loads(data)
+    except json.JSONDecodeError:
+        print("Invalid JSON in initial message")
+        raise AuthFailed("Invalid auth format")
+    if not isinstance(token_msg, dict) or token_msg.get('type') != 'auth' or not token_msg.get('token'):
+        print("Invalid initial message: Auth required")
+        raise AuthFailed("Authentication required")
+
+    try:
+        payload = token_cache.claims(token_msg['token'])
+    except jwt.InvalidTokenError as e:
+        raise AuthFailed(str(e))
+    user_email = payload['email']
+
+    if not user_cache.exists(user_email):
+        print(f"User {user_email} not found")
+        raise AuthFailed("User not found")
+    return user_email, token_msg
+
+def auth_error_frame(message):
+    return dumps({"type": "error", "message": message})
+
+# Frame types ClientConnection handles; anything else is timed as "other"
+FRAME_TYPES = {"typing", "message", "status_request", "join_group", "leave_group", "group_message", "read", "ping"}
+
+class ClientConnection:
+    """One authenticated socket: its outbox and wire session. Joined groups
+    live in the subscription index.
+
+    The transport owns the socket and the outbox. It calls ``start`` once,
+    ``handle`` for every incoming frame and ``close`` when the socket goes
+    away.
+    """
+
+    def __init__(self, user_email, session):
+        self.user_email = user_email
+        self.session = session
+        self.id = uuid.uuid4().hex
+        self.outbox = None
+        self.limiter = RateLimiter(WS_RATE_LIMITS, throttle_stats)
+
+    # All writes go through the outbox so only its writer touches the socket
+    def reply(self, payload):
+        self.outbox.put(self.session.encode(payload))
+
+    def start(self, outbox, auth):
+        """Register the connection; returns (handshake frame, missed frames).
+
+        Live deliveries are held until any missed messages have been
+        replayed, so the client sees them in order; frames delivered live and
+        replayed can overlap and are deduped by seq. The caller sends the
+        handshake (always JSON text, so the client can read what was
+        negotiated) and then calls ``outbox.resume(missed)``.
+        """
+        self.outbox = outbox
+        outbox.pause()
+        with connections_lock:
+            active_connections.setdefault(self.user_email, set()).add(self)
+
+        publish_presence(self.user_email, True)
+        presence.connect(self.user_email)
+        missed = []
         try:
-            active_connections[receiver]['ws'].send(json.dumps({
-                "type": "message",
-                "sender": request.user_email,
-                "content": content,
-                "timestamp": message["timestamp"]
-            }))
-            messages_collection.update_one(
-                {"_id": result.inserted_id},
-                {"$set": {"read": True}}
-            )
+            missed = catch_up_frames(self.user_email, auth.get('last_seq'))
         except Exception as e:
-            print(f"Failed to send WebSocket message: {e}")
-    
-    return jsonify(message), 201
+            print(f"Catch-up failed for {self.user_email}: {e}")
+
+        authenticated = {
+            "type": "authenticated",
+            "message": "Connection established",
+            "encoding": self.session.encoding,
+            "compression": self.session.compression
+        }
+        if self.session.encoding == COMPACT:
+            authenticated["codes"] = wire_codes()
+        return dumps(authenticated), [self.session.encode_text(frame) for frame in missed]
+
+    def handle(self, data):
+        started = time.perf_counter()
+        with profiler.section():
+            msg_type = self._handle(data)
+        ws_frame_seconds.observe(time.perf_counter() - started, msg_type if msg_type in FRAME_TYPES else "other")
+
+    def _handle(self, data):
+        """Handle one frame; returns its type for the metrics."""
+        user_email = self.user_email
+        reply = self.reply
+        msg_type = None
+        try:
+            message = self.session.decode(data)
+            msg_type = message.get('type')
+
+            if not self.limiter.allow(msg_type):
+                if msg_type not in SILENTLY_THROTTLED:
+                    reply({"type": "error", "message": "Rate limit exceeded", "frame": msg_type,
+                           "client_id": message.get('client_id')})
+                return msg_type
+
+            if msg_type == 'typing':
+                group_id = message.get('group_id')
+                if group_id:
+                    if subscriptions.is_subscribed(group_id, self):
+                        typing_coalescer.update(user_email, ("group", group_id), message['isTyping'])
+                elif message.get('receiver'):
+                    typing_coalescer.update(user_email, ("user", message['receiver']), message['isTyping'])
+            elif msg_type == 'message':
+                receiver = message.get('receiver')
+                content = message.get('content')
+                media = self.media(message)
+                if media is False:
+                    return msg_type
+                if receiver and (content or media):
+                    msg = save_direct_message(user_email, receiver, content or "", media)
+                    if message.get('client_id'):
+                        reply({"type": "ack", "client_id": message['client_id'], "_id": msg["_id"], "seq": msg["seq"]})
+                    send_to_user(receiver, direct_message_frame(msg))
+            elif msg_type == 'status_request':
+                target = message.get('target')
+                if target:
+                    reply({
+                        "type": "status",
+                        "user": target,
+                        "status": presence.status(target)
+                    })
+            elif msg_type == 'join_group':
+                group_id = message.get('group_id')
+                group = group_cache.get_for_member(group_id, user_email)
+                if group:
+                    subscriptions.subscribe(group_id, self)
+                    print(f"{user_email} joined group {group_id}")
+                    reply({"type": "group_joined", "group_id": group_id})
+                else:
+                    reply({"type": "error", "message": "Group not found or access denied"})
+            elif msg_type == 'leave_group':
+                group_id = message.get('group_id')
+                subscriptions.unsubscribe(group_id, self)
+                reply({"type": "group_left", "group_id": group_id})
+            elif msg_type == 'group_message':
+                group_id = message.get('group_id')
+                content = message.get('content')
+                media = self.media(message)
+                if media is False:
+                    return msg_type
+                if (content or media) and subscriptions.is_subscribed(group_id, self):
+                    group = group_cache.get_for_member(group_id, user_email)
+                    if group:
+                        msg = save_group_message(user_email, group_id, content or "", media)
+                        if message.get('client_id'):
+                            reply({"type": "ack", "client_id": message['client_id'], "_id": msg["_id"], "seq": msg["seq"]})
+                        # The user's other sockets in this group get it too
+                        broadcast_group(group_id, {
+                            "type": "group_message",
+                            "message": msg
+                        }, exclude_connection=self.id)
+            elif msg_type == 'read':
+                conversation = str(message.get('conversation', ''))
+                seq = message.get('seq')
+                if isinstance(seq, int) and can_access_conversation(user_email, conversation):
+                    if "|" in conversation:
+                        recipients = conversation.split("|")
+                    else:
+                        recipients = group_cache.members(conversation)
+                    mark_read(user_email, conversation, seq, recipients)
+            elif msg_type == 'ping':
+                reply({"type": "pong"})
+        except FrameTooLarge:
+            raise  # Closes the socket
+        except json.JSONDecodeError as e:
+            print(f"WebSocket JSON error: {e}")
+        except Exception as e:
+            print(f"WebSocket message error: {e}")
+        return msg_type
+
+    def media(self, message):
+        """The media reference a message frame points at: None without one,
+        False (after answering with an error) if it doesn't exist."""
+        if not message.get('media'):
+            return None
+        media = media_reference(message['media'], message.get('media_name'))
+        if not media:
+            self.reply({"type": "error", "message": "Media not found", "client_id": message.get('client_id')})
+            return False
+        return media
+
+    def fail(self, error):
+        if self.outbox:
+            self.outbox.put(self.session.encode({"type": "error", "message": str(error)}))
+
+    def close(self):
+        if not self.outbox:
+            return
+        subscriptions.drop(self)
+        with connections_lock:
+            conns = active_connections.get(self.user_email)
+            if not conns or self not in conns:
+                return
+            conns.discard(self)
+            last = not conns
+            if last:
+                del active_connections[self.user_email]
+        # Other workers track users, not sockets
+        if last:
+            publish_presence(self.user_email, False)
+            typing_coalescer.drop(self.user_email)
+        presence.disconnect(self.user_email)
 
 # WebSocket endpoint for real-time communication
 @sock.route('/ws')
 def websocket(ws):
-    user_email = None
-    joined_groups = set()  # Track groups this client has joined
-    
+    conn = None
+    outbox = None
+
     try:
         # Expect first message to be auth
-        token_data = ws.receive()
         try:
-            token_msg = json.loads(token_data)
-            if token_msg.get('type') != 'auth' or not token_msg.get('token'):
-                print("Invalid initial message: Auth required")
-                ws.send(json.dumps({"type": "error", "message": "Authentication required"}))
-                ws.close()
-                return
-            token = token_msg['token']
-        except json.JSONDecodeError:
-            print("Invalid JSON in initial message")
-            ws.send(json.dumps({"type": "error", "message": "Invalid auth format"}))
+            user_email, auth = authenticate_client(ws.receive())
+        except AuthFailed as e:
+            ws.send(auth_error_frame(str(e)))
             ws.close()
             return
 
-        payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        user_email = payload['email']
-        
-        user = users_collection.find_one({"email": user_email})
-        if not user:
-            print(f"User {user_email} not found")
-            ws.send(json.dumps({"type": "error", "message": "User not found"}))
-            ws.close()
-            return
-        
-        # Authentication successful
-        users_collection.update_one(
-            {"email": user_email},
-            {"$set": {"status": "online", "last_seen": datetime.utcnow()}}
-        )
-        active_connections[user_email] = {'ws': ws, 'groups': joined_groups}
-        ws.send(json.dumps({"type": "authenticated", "message": "Connection established"}))
+        # The auth frame may ask for the compact encoding and/or deflate;
+        # anything unknown falls back to plain JSON text
+        conn = ClientConnection(user_email, Session.negotiate(sender_table, auth))
+        outbox = open_outbox(ws, user_email, conn.session)
+        handshake, missed = conn.start(outbox, auth)
+        # Nothing else has been sent yet because the outbox is paused
+        ws.send(handshake)
+        outbox.resume(missed)
 
-        notify_contacts(user_email, "online")
-        
         while True:
             data = ws.receive()
             if not data:
                 break
-                
-            try:
-                message = json.loads(data)
-                msg_type = message.get('type')
-                
-                if msg_type == 'typing':
-                    receiver = message.get('receiver')
-                    if receiver in active_connections:
-                        active_connections[receiver]['ws'].send(json.dumps({
-                            "type": "typing",
-                            "sender": user_email,
-                            "isTyping": message['isTyping']
-                        }))
-                elif msg_type == 'message':
-                    receiver = message.get('receiver')
-                    content = message.get('content')
-                    if receiver and content:
-                        msg = {
-                            "sender": user_email,
-                            "receiver": receiver,
-                            "content": content,
-                            "timestamp": datetime.utcnow(),
-                            "read": False
-                        }
-                        result = messages_collection.insert_one(msg)
-                        msg["_id"] = str(result.inserted_id)
-                        msg["timestamp"] = msg["timestamp"].isoformat()
-                        if receiver in active_connections:
-                            active_connections[receiver]['ws'].send(json.dumps({
-                                "type": "message",
-                                "sender": user_email,
-                                "content": content,
-                                "timestamp": msg["timestamp"]
-                            }))
-                elif msg_type == 'status_request':
-                    target = message.get('target')
-                    if target:
-                        target_user = users_collection.find_one({"email": target}, {"status": 1})
-                        if target_user:
-                            ws.send(json.dumps({
-                                "type": "status",
-                                "user": target,
-                                "status": target_user.get("status", "offline")
-                            }))
-                elif msg_type == 'join_group':
-                    group_id = message.get('group_id')
-                    group = groups_collection.find_one({"_id": ObjectId(group_id), "members": user_email})
-                    if group:
-                        joined_groups.add(group_id)
-                        print(f"{user_email} joined group {group_id}")
-                        ws.send(json.dumps({"type": "group_joined", "group_id": group_id}))
-                    else:
-                        ws.send(json.dumps({"type": "error", "message": "Group not found or access denied"}))
-                elif msg_type == 'group_message':
-                    group_id = message.get('group_id')
-                    content = message.get('content')
-                    if group_id in joined_groups and content:
-                        group = groups_collection.find_one({"_id": ObjectId(group_id), "members": user_email})
-                        if group:
-                            msg = {
-                                "sender": user_email,
-                                "group_id": group_id,
-                                "content": content,
-                                "timestamp": datetime.utcnow(),
-                                "read_by": [user_email]
-                            }
-                            result = messages_collection.insert_one(msg)
-                            msg["_id"] = str(result.inserted_id)
-                            msg["timestamp"] = msg["timestamp"].isoformat()
-                            for member in group["members"]:
-                                if member in active_connections and member != user_email:
-                                    active_connections[member]['ws'].send(json.dumps({
-                                        "type": "group_message",
-                                        "message": msg
-                                    }))
-                elif msg_type == 'ping':
-                    ws.send(json.dumps({"type": "pong"}))
-            except json.JSONDecodeError as e:
-                print(f"WebSocket JSON error: {e}")
-            except Exception as e:
-                print(f"WebSocket message error: {e}")
-                
+            conn.handle(data)
+
     except Exception as e:
         print(f"WebSocket error: {e}")
-        if user_email:
-            ws.send(json.dumps({"type": "error", "message": str(e)}))
+        if conn:
+            conn.fail(e)
     finally:
-        if user_email and user_email in active_connections:
-            del active_connections[user_email]
-            users_collection.update_one(
-                {"email": user_email},
-                {"$set": {"status": "offline", "last_seen": datetime.utcnow()}}
-            )
-            notify_contacts(user_email, "offline")
+        if outbox:
+            close_outbox(outbox)
+        if conn:
+            conn.close()
         ws.close()
 
-def notify_contacts(user_email, status):
-    contacts = users_collection.find({"email": {"$ne": user_email}}, {"email": 1})
-    for contact in contacts:
-        if contact['email'] in active_connections:
-            try:
-                active_connections[contact['email']]['ws'].send(json.dumps({
-                    "type": "status",
-                    "user": user_email,
-                    "status": status
-                }))
-            except Exception as e:
-                print(f"Failed to notify {contact['email']}: {e}")
-
 # Mark messages as read
 @app.route("/api/messages/read", methods=["POST"])
 @token_required
@@ -422,12 +1319,28 @@ def mark_as_read():
     if not sender:
         return jsonify({"message": "Sender is required"}), 400
     
-    result = messages_collection.update_many(
-        {"sender": sender, "receiver": request.user_email, "read": False},
-        {"$set": {"read": True}}
-    )
+    conversation = conversation_key(request.user_email, sender)
+    seq = data.get("seq")
+    if not isinstance(seq, int):
+        seq = latest_seq(conversation)
+    mark_read(request.user_email, conversation, seq, [sender])
     
-    return jsonify({"message": f"Marked {result.modified_count} messages as read"}), 200
+    return jsonify({"conversation": conversation, "seq": seq}), 200
+
+# Unread counts for the caller's 1:1 conversations, derived from read cursors
+@app.route("/api/messages/unread", methods=["GET"])
+@token_required
+@handle_errors
+def get_unread_counts():
+    cursors = {
+        c["conversation"]: c["seq"]
+        for c in read_cursors_collection.find({"user": request.user_email}, {"conversation": 1, "seq": 1})
+    }
+    latest = {
+        c["_id"]: c["seq"] for c in conversations_collection.find({"participants": request.user_email}, {"seq": 1})
+    }
+    unread = {c: count for c, count in unread_counts(request.user_email, latest, cursors).items() if count > 0}
+    return jsonify(unread), 200
 
 # Create new group
 @app.route("/api/groups/create", methods=["POST"])
@@ -444,9 +1357,7 @@ def create_group():
     if request.user_email not in members:
         members.append(request.user_email)
     
-    existing_members = list(users_collection.find({"email": {"$in": members}}, {"email": 1}))
-    existing_emails = [m["email"] for m in existing_members]
-    invalid_members = set(members) - set(existing_emails)
+    invalid_members = set(members) - user_cache.existing(members)
     
     if invalid_members:
         return jsonify({"message": f"Invalid members: {', '.join(invalid_members)}"}), 400
@@ -456,20 +1367,24 @@ def create_group():
         "members": members,
         "created_by": request.user_email,
         "created_at": datetime.utcnow(),
-        "admins": [request.user_email]
+        "admins": [request.user_email],
+        "version": 1,
+        "last_message": None,
+        "seq": 0
     }
+    group["last_activity"] = group["created_at"]
     result = groups_collection.insert_one(group)
+    group_cache.put(dict(group))
+    # Other workers may hold the members' group lists without this group
+    publish_group_change(str(result.inserted_id), group["version"], members, members)
     group["_id"] = str(result.inserted_id)
+    group["created_at"] = group["created_at"].isoformat()
+    group["last_activity"] = group["created_at"]
     
-    for member in members:
-        if member in active_connections and member != request.user_email:
-            try:
-                active_connections[member]['ws'].send(json.dumps({
-                    "type": "group_created",
-                    "group": group
-                }))
-            except Exception as e:
-                print(f"Failed to notify {member}: {e}")
+    broadcast(members, {
+        "type": "group_created",
+        "group": group
+    }, exclude=request.user_email)
     
     return jsonify(group), 201
 
@@ -478,58 +1393,142 @@ def create_group():
 @token_required
 @handle_errors
 def get_user_groups():
-    groups = list(groups_collection.find(
-        {"members": request.user_email},
-        {"messages": 0}
-    ).sort("created_at", -1))
+    try:
+        limit = min(max(int(request.args.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        before = decode_cursor(request.args["before"]) if request.args.get("before") else None
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid pagination parameters"}), 400
     
-    for group in groups:
-        group["_id"] = str(group["_id"])
-        group["created_at"] = group["created_at"].isoformat()
-        last_message = messages_collection.find_one(
-            {"group_id": group["_id"]},
-            sort=[("timestamp", -1)]
+    query = {"members": request.user_email}
+    if before:
+        ts, oid = before
+        query["$or"] = [{"last_activity": {"$lt": ts}}, {"last_activity": ts, "_id": {"$lt": oid}}]
+    
+    # Most recently active first; one indexed query, no per-group lookups
+    groups = list(groups_collection.find(query, {
+        "name": 1, "members": 1, "admins": 1, "created_by": 1, "created_at": 1,
+        "last_message": 1, "last_activity": 1, "seq": 1
+    }).sort([("last_activity", -1), ("_id", -1)]).limit(limit + 1))
+    has_more = len(groups) > limit
+    groups = groups[:limit]
+    
+    headers = {"X-Has-More": "true" if has_more else "false"}
+    if groups and groups[-1].get("last_activity"):
+        headers["X-Cursor-Before"] = encode_cursor(groups[-1]["last_activity"], groups[-1]["_id"])
+    
+    # One more indexed query for the page's read cursors
+    cursors = {
+        c["conversation"]: c["seq"] for c in read_cursors_collection.find(
+            {"user": request.user_email, "conversation": {"$in": [str(g["_id"]) for g in groups]}},
+            {"conversation": 1, "seq": 1}
         )
-        if last_message:
-            last_message["_id"] = str(last_message["_id"])
-            last_message["timestamp"] = last_message["timestamp"].isoformat()
-            group["last_message"] = last_message
+    }
     
-    return jsonify(groups), 200
+    unread = unread_counts(request.user_email, {str(g["_id"]): g.get("seq", 0) for g in groups}, cursors)
+    for group in groups:
+        group.pop("seq", None)
+        group["unread_count"] = unread.get(str(group["_id"]), 0)
+    
+    return jsonify(groups), 200, headers
+
+# Move the caller's read cursor for a group
+@app.route("/api/groups/<group_id>/read", methods=["POST"])
+@token_required
+@handle_errors
+def mark_group_read(group_id):
+    group = group_cache.get_for_member(group_id, request.user_email)
+    if not group:
+        return jsonify({"message": "Group not found or access denied"}), 404
+    
+    data = request.get_json(silent=True) or {}
+    seq = data.get("seq")
+    if not isinstance(seq, int):
+        seq = latest_seq(group_id)
+    mark_read(request.user_email, group_id, seq, group["members"])
+    
+    return jsonify({"conversation": group_id, "seq": seq}), 200
 
 # Get group info
 @app.route("/api/groups/<group_id>", methods=["GET"])
 @token_required
 @handle_errors
 def get_group(group_id):
-    group = groups_collection.find_one({"_id": ObjectId(group_id)})
+    group = group_cache.get_for_member(group_id, request.user_email)
+    if not group:
+        return jsonify({"message": "Group not found or access denied"}), 404
+
+    return jsonify({key: group[key] for key in ("_id", "name", "members", "admins")}), 200
+
+# Add members to a group (admins only)
+@app.route("/api/groups/<group_id>/members", methods=["POST"])
+@token_required
+@handle_errors
+def add_group_members(group_id):
+    data = request.get_json()
+    members = data.get("members", [])
+    if not members:
+        return jsonify({"message": "Members are required"}), 400
+    
+    group = group_cache.get_for_member(group_id, request.user_email)
     if not group:
+        return jsonify({"message": "Group not found or access denied"}), 404
+    if request.user_email not in group.get("admins", []):
+        return jsonify({"message": "Only admins can add members"}), 403
+    
+    invalid_members = set(members) - user_cache.existing(members)
+    if invalid_members:
+        return jsonify({"message": f"Invalid members: {', '.join(invalid_members)}"}), 400
+    
+    updated = groups_collection.find_one_and_update(
+        {"_id": ObjectId(group_id)},
+        {"$addToSet": {"members": {"$each": members}}, "$inc": {"version": 1}},
+        projection=GROUP_FIELDS,
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
         return jsonify({"message": "Group not found"}), 404
+    publish_group_change(group_id, updated["version"], members, updated["members"])
     
-    group["_id"] = str(group["_id"])
-    group["created_at"] = group["created_at"].isoformat()
-    return jsonify(group), 200
+    return jsonify({"members": updated["members"]}), 200
+
+# Remove a member from a group (admins, or members leaving themselves)
+@app.route("/api/groups/<group_id>/members/<member_email>", methods=["DELETE"])
+@token_required
+@handle_errors
+def remove_group_member(group_id, member_email):
+    group = group_cache.get_for_member(group_id, request.user_email)
+    if not group:
+        return jsonify({"message": "Group not found or access denied"}), 404
+    if member_email != request.user_email and request.user_email not in group.get("admins", []):
+        return jsonify({"message": "Only admins can remove members"}), 403
+    
+    updated = groups_collection.find_one_and_update(
+        {"_id": ObjectId(group_id)},
+        {"$pull": {"members": member_email, "admins": member_email}, "$inc": {"version": 1}},
+        projection=GROUP_FIELDS,
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
+        return jsonify({"message": "Group not found"}), 404
+    publish_group_change(group_id, updated["version"], [member_email], updated["members"])
+    
+    return jsonify({"members": updated["members"]}), 200
 
 # Get group messages
 @app.route("/api/groups/<group_id>/messages", methods=["GET"])
 @token_required
 @handle_errors
 def get_group_messages(group_id):
-    group = groups_collection.find_one({"_id": ObjectId(group_id), "members": request.user_email})
+    group = group_cache.get_for_member(group_id, request.user_email)
     if not group:
         return jsonify({"message": "Group not found or access denied"}), 404
     
-    messages = list(messages_collection.find(
-        {"group_id": group_id},
-        sort=[("timestamp", -1)],
-        limit=50
-    ))
-    
-    for message in messages:
-        message["_id"] = str(message["_id"])
-        message["timestamp"] = message["timestamp"].isoformat()
+    try:
+        messages, has_more = fetch_history_page({"group_id": group_id}, request.args, group_id)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
     
-    return jsonify(messages), 200
+    return history_response(messages, has_more)
 
 # Send group message
 @app.route("/api/groups/<group_id>/messages", methods=["POST"])
@@ -538,37 +1537,447 @@ def get_group_messages(group_id):
 def send_group_message(group_id):
     data = request.get_json()
     content = data.get("content")
+    media = media_reference(data.get("media"), data.get("media_name")) if data.get("media") else None
     
-    if not content:
+    if data.get("media") and not media:
+        return jsonify({"message": "Media not found"}), 404
+    
+    if not (content or media):
         return jsonify({"message": "Content is required"}), 400
     
-    group = groups_collection.find_one({"_id": ObjectId(group_id), "members": request.user_email})
+    group = group_cache.get_for_member(group_id, request.user_email)
     if not group:
         return jsonify({"message": "Group not found or access denied"}), 404
     
-    message = {
-        "sender": request.user_email,
-        "group_id": group_id,
-        "content": content,
-        "timestamp": datetime.utcnow(),
-        "read_by": [request.user_email]
-    }
-    result = messages_collection.insert_one(message)
-    message["_id"] = str(result.inserted_id)
-    message["timestamp"] = message["timestamp"].isoformat()
+    message = save_group_message(request.user_email, group_id, content or "", media)
     
-    for member in group["members"]:
-        if member in active_connections and member != request.user_email:
-            try:
-                active_connections[member]['ws'].send(json.dumps({
-                    "type": "group_message",
-                    "message": message
-                }))
-            except Exception as e:
-                print(f"Failed to notify {member}: {e}")
+    broadcast_group(group_id, {
+        "type": "group_message",
+        "message": message
+    }, exclude=request.user_email)
 
     return jsonify(message), 201
 
+# History export streams newline-delimited JSON straight off a Mongo cursor, so
+# memory stays flat however long the conversation is. Each line is one
+# message; to resume an interrupted export pass after=<timestamp>_<_id> of
+# the last line received.
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 500))
+EXPORT_MAX_BATCH_SIZE = int(os.getenv('EXPORT_MAX_BATCH_SIZE', 5000))
+
+def export_response(query, filename):
+    try:
+        batch_size = min(max(int(request.args.get("batch_size", EXPORT_BATCH_SIZE)), 1), EXPORT_MAX_BATCH_SIZE)
+        after = decode_cursor(request.args["after"]) if request.args.get("after") else None
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid export parameters"}), 400
+    compress = request.args.get("gzip") in ("1", "true")
+    
+    if after:
+        ts, oid = after
+        query = {**query, "$or": [{"timestamp": {"$gt": ts}}, {"timestamp": ts, "_id": {"$gt": oid}}]}
+    cursor = messages_collection.find(query).sort(
+        [("timestamp", 1), ("_id", 1)]
+    ).batch_size(batch_size)
+    
+    def generate():
+        compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip container
+        lines = []
+        try:
+            for message in cursor:
+                lines.append(dumps(message))
+                if len(lines) == batch_size:
+                    chunk = ("\n".join(lines) + "\n").encode("utf-8")
+                    lines = []
+                    chunk = compressor.compress(chunk) if compressor else chunk
+                    if chunk:
+                        yield chunk
+            chunk = ("\n".join(lines) + "\n").encode("utf-8") if lines else b""
+            if compressor:
+                chunk = compressor.compress(chunk) + compressor.flush()
+            if chunk:
+                yield chunk
+        finally:
+            cursor.close()
+    
+    headers = {
+        "Content-Disposition": f"attachment; filename={filename}.ndjson{'.gz' if compress else ''}",
+        "X-Accel-Buffering": "no"
+    }
+    mimetype = "application/gzip" if compress else "application/x-ndjson"
+    return Response(generate(), mimetype=mimetype, headers=headers)
+
+# Export a full 1:1 conversation
+@app.route("/api/export/messages/<contact_email>", methods=["GET"])
+@token_required
+@handle_errors
+def export_messages(contact_email):
+    conversation = conversation_key(request.user_email, contact_email)
+    return export_response({"conversation": conversation}, f"conversation-{contact_email}")
+
+# Export a full group history
+@app.route("/api/export/groups/<group_id>", methods=["GET"])
+@token_required
+@handle_errors
+def export_group_messages(group_id):
+    if not group_cache.get_for_member(group_id, request.user_email):
+        return jsonify({"message": "Group not found or access denied"}), 404
+    return export_response({"group_id": group_id}, f"group-{group_id}")
+
+# Every conversation a user can search: their groups, and 1:1 conversations
+# from the sequence counters plus any older ones only the messages know about
+def searchable_conversations(email):
+    conversations = set(group_cache.groups_of(email))
+    conversations.update(c["_id"] for c in conversations_collection.find({"participants": email}, {"_id": 1}))
+    peers = set(messages_collection.distinct("receiver", {"sender": email}))
+    peers.update(messages_collection.distinct("sender", {"receiver": email}))
+    peers.discard(None)
+    conversations.update(conversation_key(email, peer) for peer in peers)
+    return conversations
+
+# Ranked search over everything the caller can read, or one conversation with
+# ?conversation=. Each result has the message, a snippet around the first
+# match and the [start, end] offsets of the matches in the snippet. Pages
+# continue from X-Cursor-After.
+@app.route("/api/search", methods=["GET"])
+@token_required
+@handle_errors
+def search_messages():
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"message": "q is required"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_DEFAULT_LIMIT)), 1), SEARCH_MAX_LIMIT)
+        offset = max(int(request.args.get('cursor', 0)), 0)
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+    limit = min(limit, max(SEARCH_MAX_RESULTS - offset, 0))
+
+    conversation = request.args.get('conversation')
+    if conversation:
+        if not can_access_conversation(request.user_email, conversation):
+            return jsonify({"message": "Conversation not found or access denied"}), 404
+        scope = [conversation]
+    else:
+        scope = searchable_conversations(request.user_email)
+
+    results, has_more = search_index.search(scope, query, limit, offset) if limit else ([], False)
+    has_more = has_more and offset + limit < SEARCH_MAX_RESULTS
+    headers = {"X-Has-More": "true" if has_more else "false"}
+    if has_more:
+        headers["X-Cursor-After"] = str(offset + limit)
+    return jsonify(results), 200, headers
+
+# Media. Files are addressed by their sha256, which doubles as the
+# capability to read them: only people who were sent a reference know it, so
+# GET /api/media/<id> works in an <img> tag without a token.
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+CONTENT_TYPE_PATTERN = re.compile(r"^[\w.+-]+/[\w.+-]+$")
+
+def clean_content_type(value):
+    value = str(value or "").lower().split(";")[0].strip()
+    return value if CONTENT_TYPE_PATTERN.match(value) else "application/octet-stream"
+
+def clean_file_name(value):
+    return os.path.basename(str(value or "").replace("\\", "/"))[:255] or "file"
+
+def register_media(digest, size, content_type, name, uploader):
+    """Record a stored file; the first upload of an image renders its variants."""
+    result = media_collection.update_one({"_id": digest}, {"$setOnInsert": {
+        "size": size,
+        "content_type": content_type,
+        "name": name,
+        "uploaded_by": uploader,
+        "created_at": datetime.utcnow()
+    }}, upsert=True)
+    if result.upserted_id is not None and content_type.startswith("image/"):
+        media_store.render(digest, lambda info: record_variants(digest, info))
+
+def record_variants(digest, info):
+    fields = {"rendered": True}
+    if info:
+        fields.update(width=info["width"], height=info["height"], variants=info["variants"])
+    try:
+        media_collection.update_one({"_id": digest}, {"$set": fields})
+    except Exception as e:
+        print(f"Failed to record variants of {digest}: {e}")
+
+# What a message carries instead of the file: enough to lay it out and fetch it
+def media_reference(digest, name=None):
+    if not isinstance(digest, str) or not DIGEST_PATTERN.match(digest):
+        return None
+    media = media_collection.find_one({"_id": digest})
+    if not media:
+        return None
+    reference = {
+        "id": digest,
+        "name": clean_file_name(name) if name else media.get("name"),
+        "size": media["size"],
+        "content_type": media["content_type"],
+        "url": f"/api/media/{digest}"
+    }
+    if media.get("width"):
+        reference["width"] = media["width"]
+        reference["height"] = media["height"]
+    if media.get("variants"):
+        reference["variants"] = sorted(media["variants"])
+    return reference
+
+def store_form_file(file):
+    """Stream a multipart file into the store; returns its media reference."""
+    digest, size, _ = media_store.save_stream(file.stream, MEDIA_MAX_SIZE)
+    name = clean_file_name(file.filename)
+    register_media(digest, size, clean_content_type(file.mimetype), name, request.user_email)
+    return media_reference(digest, name)
+
+def complete_upload(upload):
+    digest, size, _ = media_store.finish(upload["_id"])
+    uploads_collection.delete_one({"_id": upload["_id"]})
+    if size != upload["size"]:
+        return jsonify({"message": "Upload size mismatch"}), 400
+    register_media(digest, size, upload["content_type"], upload["name"], upload["owner"])
+    return jsonify({"complete": True, "offset": size, "media": media_reference(digest, upload["name"])}), 200
+
+# Resumable upload: POST the file's name, size and content_type (and its
+# sha256 to skip sending a file the server already has), then PUT the bytes
+# in chunks at ?offset=<bytes stored so far>. After a disconnect, GET the
+# upload for the offset to resume from. The last chunk returns the media
+# reference to put in a message.
+@app.route("/api/media/uploads", methods=["POST"])
+@token_required
+@handle_errors
+def create_upload():
+    data = request.get_json() or {}
+    size = data.get("size")
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return jsonify({"message": "size is required"}), 400
+    if size > MEDIA_MAX_SIZE:
+        return jsonify({"message": "File too large"}), 413
+    name = clean_file_name(data.get("name"))
+
+    digest = str(data.get("sha256") or "").lower()
+    if DIGEST_PATTERN.match(digest) and media_store.exists(digest):
+        media = media_reference(digest, name)
+        if media and media["size"] == size:
+            return jsonify({"complete": True, "offset": size, "media": media}), 200
+
+    upload = {
+        "_id": uuid.uuid4().hex,
+        "owner": request.user_email,
+        "name": name,
+        "content_type": clean_content_type(data.get("content_type")),
+        "size": size,
+        "offset": 0,
+        "created_at": datetime.utcnow()
+    }
+    media_store.create(upload["_id"])
+    uploads_collection.insert_one(upload)
+    if size == 0:
+        return complete_upload(upload)
+    return jsonify({"upload_id": upload["_id"], "offset": 0, "chunk_size": MEDIA_CHUNK_SIZE}), 201
+
+@app.route("/api/media/uploads/<upload_id>", methods=["GET"])
+@token_required
+@handle_errors
+def get_upload(upload_id):
+    upload = uploads_collection.find_one({"_id": upload_id, "owner": request.user_email})
+    if not upload:
+        return jsonify({"message": "Upload not found"}), 404
+    return jsonify({"upload_id": upload_id, "offset": upload["offset"], "size": upload["size"],
+                    "chunk_size": MEDIA_CHUNK_SIZE}), 200
+
+@app.route("/api/media/uploads/<upload_id>", methods=["PUT"])
+@token_required
+@handle_errors
+def upload_chunk(upload_id):
+    upload = uploads_collection.find_one({"_id": upload_id, "owner": request.user_email})
+    if not upload:
+        return jsonify({"message": "Upload not found"}), 404
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return jsonify({"message": "offset is required"}), 400
+    if offset != upload["offset"]:
+        return jsonify({"message": "Offset mismatch", "offset": upload["offset"]}), 409
+    length = request.content_length
+    if length is None:
+        return jsonify({"message": "Content-Length is required"}), 411
+    if length > MEDIA_CHUNK_SIZE:
+        return jsonify({"message": "Chunk too large", "chunk_size": MEDIA_CHUNK_SIZE}), 413
+    if offset + length > upload["size"]:
+        return jsonify({"message": "Chunk past the declared size"}), 400
+
+    # Claim the offset before touching the file, so a retried PUT on another
+    # worker can't write (or truncate) the same range concurrently. The
+    # lease outlives a crashed writer by at most UPLOAD_CHUNK_LEASE.
+    lease = uuid.uuid4().hex
+    now = datetime.utcnow()
+    claimed = uploads_collection.find_one_and_update(
+        {"_id": upload_id, "offset": offset,
+         "$or": [{"writing_until": {"$exists": False}}, {"writing_until": {"$lt": now}}]},
+        {"$set": {"writer": lease, "writing_until": now + timedelta(seconds=UPLOAD_CHUNK_LEASE)}}
+    )
+    if claimed is None:
+        current = uploads_collection.find_one({"_id": upload_id}, {"offset": 1})
+        return jsonify({"message": "Offset mismatch or another chunk in progress",
+                        "offset": current["offset"] if current else None}), 409
+
+    # The body is copied to disk as it arrives, never buffered whole. The
+    # copy stops well before the lease runs out, so no one else can be
+    # writing by the time it truncates the file.
+    release = {"$unset": {"writer": "", "writing_until": ""}}
+    try:
+        new_offset = media_store.write_chunk(upload_id, offset, request.stream, length,
+                                             timeout=UPLOAD_CHUNK_LEASE / 2)
+    except UploadError as e:
+        uploads_collection.update_one({"_id": upload_id, "writer": lease}, release)
+        return jsonify({"message": str(e)}), e.status
+    except Exception:
+        uploads_collection.update_one({"_id": upload_id, "writer": lease}, release)
+        raise
+    result = uploads_collection.update_one({"_id": upload_id, "writer": lease},
+                                           {**release, "$set": {"offset": new_offset}})
+    if not result.matched_count:
+        # Cancelled meanwhile, or the lease ran out and another chunk took over
+        current = uploads_collection.find_one({"_id": upload_id}, {"offset": 1})
+        if current is None:
+            return jsonify({"message": "Upload not found"}), 404
+        return jsonify({"message": "Offset mismatch", "offset": current["offset"]}), 409
+    if new_offset < upload["size"]:
+        return jsonify({"offset": new_offset}), 200
+    return complete_upload(upload)
+
+@app.route("/api/media/uploads/<upload_id>", methods=["DELETE"])
+@token_required
+@handle_errors
+def cancel_upload(upload_id):
+    result = uploads_collection.delete_one({"_id": upload_id, "owner": request.user_email})
+    if not result.deleted_count:
+        return jsonify({"message": "Upload not found"}), 404
+    media_store.discard(upload_id)
+    return "", 204
+
+# One-shot multipart upload used by the frontend's uploadFile(): stores the
+# file and sends it to `receiver` as a media message
+@app.route("/api/upload", methods=["POST"])
+@token_required
+@handle_errors
+def upload_file():
+    file = request.files.get("file")
+    receiver = request.form.get("receiver")
+    if not file or not receiver:
+        return jsonify({"message": "File and receiver are required"}), 400
+    if not user_cache.exists(receiver):
+        return jsonify({"message": "Receiver not found"}), 404
+    try:
+        media = store_form_file(file)
+    except UploadError as e:
+        return jsonify({"message": str(e)}), e.status
+
+    message = save_direct_message(request.user_email, receiver, request.form.get("content", ""), media)
+    presence.touch(request.user_email)
+    send_to_user(receiver, direct_message_frame(message))
+    return jsonify(message), 201
+
+@app.route("/api/user/avatar", methods=["PUT"])
+@token_required
+@handle_errors
+def upload_avatar():
+    file = request.files.get("avatar")
+    if not file or not clean_content_type(file.mimetype).startswith("image/"):
+        return jsonify({"message": "An image is required"}), 400
+    try:
+        media = store_form_file(file)
+    except UploadError as e:
+        return jsonify({"message": str(e)}), e.status
+
+    avatar = url_for("get_media", digest=media["id"], variant="thumb", _external=True)
+    users_collection.update_one({"email": request.user_email},
+                                {"$set": {"avatar": avatar, "updated_at": datetime.utcnow()}})
+    publish_user_change(request.user_email)
+    return jsonify({"avatar": avatar}), 200
+
+# Files are immutable, so they are cached for MEDIA_MAX_AGE and revalidated by
+# ETag; Range requests (seeking in audio/video, resumed downloads) are
+# answered with 206 by send_file
+@app.route("/api/media/<digest>", methods=["GET"])
+@handle_errors
+def get_media(digest):
+    variant = request.args.get("variant")
+    if variant and variant not in MEDIA_VARIANTS:
+        return jsonify({"message": "Unknown variant"}), 400
+    media = media_collection.find_one({"_id": digest}) if DIGEST_PATTERN.match(digest) else None
+    if not media or not media_store.exists(digest):
+        return jsonify({"message": "Media not found"}), 404
+
+    path, content_type, etag, max_age = media_store.blob_path(digest), media["content_type"], digest, MEDIA_MAX_AGE
+    if variant:
+        rendered = (media.get("variants") or {}).get(variant)
+        if rendered and media_store.exists(digest, variant):
+            path, content_type, etag = media_store.blob_path(digest, variant), rendered["content_type"], f"{digest}.{variant}"
+        elif not media.get("rendered"):
+            max_age = 60  # Still rendering; don't cache the original as the variant
+        # Otherwise the original is already smaller than the variant would be
+
+    inline = content_type.startswith(INLINE_MEDIA_TYPES) and content_type != "image/svg+xml"
+    response = send_file(path, mimetype=content_type, as_attachment=not inline,
+                         download_name=media.get("name") or digest, conditional=True,
+                         etag=etag, max_age=max_age)
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    if max_age == MEDIA_MAX_AGE:
+        response.cache_control.immutable = True
+    return response
+
+# Internal counters for sizing queues, batches and caches
+@app.route("/api/stats", methods=["GET"])
+@handle_errors
+def get_stats():
+    if not metrics_authorized():
+        return jsonify({"message": "Unauthorized"}), 401
+    return jsonify({
+        "delivery": delivery_stats.snapshot(),
+        "presence": dict(presence.stats),
+        "message_writes": message_writer.stats(),
+        "group_cache": dict(group_cache.stats),
+        "read_receipts": dict(read_receipts.stats),
+        "subscriptions": subscriptions.snapshot(),
+        "throttle": throttle_stats.snapshot(),
+        "token_cache": dict(token_cache.stats),
+        "user_cache": user_cache.snapshot(),
+        "history_cache": history_cache.snapshot(),
+        "media": media_store.snapshot(),
+        "search": search_index.snapshot(),
+        "search_writes": search_writer.stats(),
+        "router": router.snapshot()
+    }), 200
+
+# Stats, metrics and the profiler are for operators: the METRICS_TOKEN
+# bearer, or without one, requests from this host
+def metrics_authorized():
+    if METRICS_TOKEN:
+        return request.headers.get('Authorization') == f"Bearer {METRICS_TOKEN}"
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+# Prometheus scrape endpoint
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    if not metrics_authorized():
+        return jsonify({"message": "Unauthorized"}), 401
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+# Folded stacks from the frame-loop profiler (PROFILE_SAMPLE_HZ), for
+# flamegraph.pl or speedscope; ?reset=1 starts a new window
+@app.route("/metrics/profile", methods=["GET"])
+def get_profile():
+    if not metrics_authorized():
+        return jsonify({"message": "Unauthorized"}), 401
+    if not profiler.enabled:
+        return jsonify({"message": "Profiler disabled; set PROFILE_SAMPLE_HZ"}), 404
+    folded = profiler.folded()
+    if request.args.get('reset') == '1':
+        profiler.reset()
+    return Response(folded, mimetype="text/plain")
+
 if __name__ == "__main__":
     app.run(host=os.getenv('HOST', '0.0.0.0'), 
             port=int(os.getenv('PORT', 5000)),
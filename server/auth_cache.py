@@ -0,0 +1,203 @@
+from collections import OrderedDict
+import hashlib
+import math
+import threading
+import time
+
+
+class TokenCache:
+    """Bounded LRU of verified JWT claims, each kept until the token's ``exp``.
+
+    ``verify(token)`` does the real check (signature, expiry) and returns the
+    claims or raises; it only runs on a miss. Tokens without ``exp`` are
+    kept for ``default_ttl`` seconds.
+    """
+
+    def __init__(self, verify, max_size=50000, default_ttl=300):
+        self.verify = verify
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._tokens = OrderedDict()  # {token: (claims, expires_at)}
+        self._by_user = {}            # {email: set(token)}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def claims(self, token):
+        now = time.time()
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry and entry[1] > now:
+                self._tokens.move_to_end(token)
+                self.stats["hits"] += 1
+                return entry[0]
+            if entry:
+                self._remove(token)
+            self.stats["misses"] += 1
+        claims = self.verify(token)
+        expires_at = claims.get("exp", now + self.default_ttl)
+        with self._lock:
+            self._tokens[token] = (claims, expires_at)
+            self._by_user.setdefault(claims.get("email"), set()).add(token)
+            while len(self._tokens) > self.max_size:
+                self._remove(next(iter(self._tokens)))
+                self.stats["evictions"] += 1
+        return claims
+
+    def invalidate_user(self, email):
+        with self._lock:
+            for token in list(self._by_user.get(email, ())):
+                self._remove(token)
+            self.stats["invalidations"] += 1
+
+    def _remove(self, token):
+        # Called with the lock held
+        claims, _ = self._tokens.pop(token)
+        tokens = self._by_user.get(claims.get("email"))
+        if tokens:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_user[claims.get("email")]
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (no false negatives)."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, capacity)
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class UserCache:
+    """Bounded LRU/TTL cache of user profiles with a Bloom filter of known emails.
+
+    ``load_users(emails)`` fetches profiles (never password hashes) for a list
+    of emails; ``load_all_emails()`` streams every registered email to fill
+    the filter. Emails the filter rejects are reported missing without a
+    query. The filter only learns about registrations on other workers from
+    routed events, so it is rebuilt from Mongo periodically with
+    ``start_refresher`` (and by the caller whenever events may have been
+    lost), as well as when it fills past its capacity.
+    """
+
+    def __init__(self, load_users, load_all_emails, max_users=50000, ttl=300, error_rate=0.001):
+        self.load_users = load_users
+        self.load_all_emails = load_all_emails
+        self.max_users = max_users
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._users = OrderedDict()  # {email: (profile, expires_at)}
+        self._filter = None
+        self._added_during_load = None
+        self.stats = {"hits": 0, "misses": 0, "filtered": 0, "false_positives": 0, "evictions": 0, "invalidations": 0}
+
+    def load(self):
+        with self._lock:
+            if self._added_during_load is not None:
+                return  # Already loading
+            self._added_during_load = []
+        try:
+            emails = list(self.load_all_emails())
+            bloom = BloomFilter(max(2 * len(emails), 10000), self.error_rate)
+            for email in emails:
+                bloom.add(email)
+        finally:
+            with self._lock:
+                # Registrations that raced with the scan must not be lost
+                added, self._added_during_load = self._added_during_load, None
+        with self._lock:
+            for email in added:
+                bloom.add(email)
+            self._filter = bloom
+
+    def get(self, email):
+        return self.get_many([email]).get(email)
+
+    def exists(self, email):
+        return email in self.get_many([email])
+
+    def existing(self, emails):
+        return set(self.get_many(emails))
+
+    def get_many(self, emails):
+        """Profiles for the emails that exist, as {email: profile}."""
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for email in set(emails):
+                if not isinstance(email, str):
+                    continue
+                if self._filter is not None and email not in self._filter:
+                    self.stats["filtered"] += 1
+                    continue
+                entry = self._users.get(email)
+                if entry and entry[1] > now:
+                    self._users.move_to_end(email)
+                    self.stats["hits"] += 1
+                    found[email] = entry[0]
+                else:
+                    self.stats["misses"] += 1
+                    missing.append(email)
+        if missing:
+            loaded = {profile["email"]: profile for profile in self.load_users(missing)}
+            with self._lock:
+                self.stats["false_positives"] += len(missing) - len(loaded)
+                for email, profile in loaded.items():
+                    self._users[email] = (profile, now + self.ttl)
+                    self._users.move_to_end(email)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+                    self.stats["evictions"] += 1
+            found.update(loaded)
+        return found
+
+    def added(self, email):
+        """A user registered (here or on another worker)."""
+        with self._lock:
+            self._users.pop(email, None)
+            if self._added_during_load is not None:
+                self._added_during_load.append(email)
+            if self._filter is not None:
+                self._filter.add(email)
+                rebuild = self._filter.count > self._filter.capacity
+            else:
+                rebuild = False
+        if rebuild:
+            threading.Thread(target=self.load, name="user-filter", daemon=True).start()
+
+    def invalidate(self, email):
+        with self._lock:
+            self._users.pop(email, None)
+            self.stats["invalidations"] += 1
+
+    def start_refresher(self, interval):
+        """Rebuild the filter every ``interval`` seconds."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.load()
+                except Exception as e:
+                    print(f"Failed to rebuild the user filter: {e}")
+        threading.Thread(target=run, name="user-filter-refresh", daemon=True).start()
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "cached": len(self._users), "filter_size": self._filter.count if self._filter else 0}
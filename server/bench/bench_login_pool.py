@@ -0,0 +1,95 @@
+"""Login burst benchmark: inline bcrypt vs. the bounded hashing process pool.
+
+Simulates a threaded server (a fixed pool of request threads) hit by a burst
+of logins while ordinary non-auth requests keep arriving. Reports login
+throughput, fast-rejected (503) logins and the latency of the non-auth
+requests, measured from arrival to completion.
+
+    python bench/bench_login_pool.py --logins 200 --threads 16 --rounds 12
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from hashing import PasswordHasher, HashingBusy, _hash_password  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def non_auth_request():
+    # Roughly what a small JSON route costs
+    payload = [{"_id": str(i), "email": f"user{i}@example.com", "status": "online"} for i in range(50)]
+    return json.dumps(payload)
+
+
+def run(mode, hasher, stored_hash, args):
+    server = ThreadPoolExecutor(max_workers=args.threads)
+    ok, busy = [0], [0]
+    lock = threading.Lock()
+
+    def login():
+        try:
+            hasher.check(stored_hash, "secret-password")
+            with lock:
+                ok[0] += 1
+        except HashingBusy:
+            with lock:
+                busy[0] += 1
+
+    latencies = []
+
+    def timed(arrived):
+        non_auth_request()
+        latencies.append(time.perf_counter() - arrived)
+
+    started = time.perf_counter()
+    logins = [server.submit(login) for _ in range(args.logins)]
+    # Non-auth traffic keeps arriving at a steady rate during the burst
+    others = []
+    while not all(f.done() for f in logins):
+        others.append(server.submit(timed, time.perf_counter()))
+        time.sleep(1 / args.rate)
+    elapsed = time.perf_counter() - started
+    for f in others:
+        f.result()
+    server.shutdown()
+
+    print(f"{mode:>7}: {ok[0] / elapsed:8.1f} logins/s  {busy[0]:4d} rejected (503)  "
+          f"non-auth p50 {percentile(latencies, 50) * 1000:7.2f} ms  "
+          f"p99 {percentile(latencies, 99) * 1000:7.2f} ms  "
+          f"mean {statistics.fmean(latencies) * 1000 if latencies else 0:7.2f} ms  ({len(latencies)} requests)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16, help="request threads in the simulated server")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost factor")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--queue", type=int, default=8, help="max pending hashes in pool mode")
+    parser.add_argument("--rate", type=float, default=200, help="non-auth requests per second")
+    args = parser.parse_args()
+
+    stored_hash = _hash_password("secret-password", args.rounds)
+    print(f"{args.logins} logins, bcrypt cost {args.rounds}, {args.threads} request threads, {os.cpu_count()} CPUs")
+
+    run("inline", PasswordHasher(rounds=args.rounds, workers=0, max_pending=args.logins), stored_hash, args)
+    pooled = PasswordHasher(rounds=args.rounds, workers=args.workers, max_pending=args.queue)
+    pooled.check(stored_hash, "warm-up")  # Start the worker processes outside the timing
+    run("pool", pooled, stored_hash, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Message search benchmark: indexing cost and query latency.
+
+Fills a throwaway messages collection with --messages messages spread over
+--conversations conversations, then reports:
+
+  * backfill: time to index everything already stored, in batches
+  * write path: the extra work one send costs (building the posting
+    updates) and the throughput of flushing them in unordered batches
+  * queries: latency percentiles for rare, common and multi-term queries,
+    scoped to the --scope conversations of one user, against the
+    unindexed alternative (a case-insensitive regex over those
+    conversations)
+
+--mongo takes a MongoDB URI (a database named bench_search is created and
+dropped) or "memory" for mongomock, which only shows relative costs.
+
+    python bench/bench_search.py --mongo mongodb://localhost:27017 --messages 200000
+"""
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import re
+import sys
+import time
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from search import SearchIndex  # noqa: E402
+from write_pipeline import WritePipeline  # noqa: E402
+
+COMMON = ["meeting", "tomorrow", "lunch", "thanks", "okay", "later", "call", "home", "work", "today"]
+QUERIES = [
+    ("rare", "quarterly"),
+    ("common", "tomorrow"),
+    ("two terms", "lunch tomorrow"),
+    ("missing", "xylophone"),
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def connect(uri):
+    if uri == "memory":
+        import mongomock
+        return mongomock.MongoClient()
+    from pymongo import MongoClient
+    return MongoClient(uri)
+
+
+def make_messages(count, conversations, seed=1):
+    rng = random.Random(seed)
+    vocabulary = COMMON + [f"word{i}" for i in range(5000)]
+    start = datetime(2026, 1, 1)
+    seqs = [0] * conversations
+    messages = []
+    for i in range(count):
+        c = rng.randrange(conversations)
+        seqs[c] += 1
+        words = [rng.choice(COMMON) if rng.random() < 0.3 else rng.choice(vocabulary) for _ in range(rng.randint(3, 20))]
+        if rng.random() < 0.001:
+            words.append("quarterly")
+        messages.append({
+            "_id": ObjectId(), "sender": f"user{c}@example.com", "group_id": f"group{c}",
+            "conversation": f"group{c}", "seq": seqs[c], "content": " ".join(words),
+            "timestamp": start + timedelta(seconds=i),
+        })
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", default="memory")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--scope", type=int, default=20, help="conversations the searching user is in")
+    parser.add_argument("--queries", type=int, default=50, help="runs per query")
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+
+    client = connect(args.mongo)
+    client.drop_database("bench_search")
+    db = client["bench_search"]
+    try:
+        messages = make_messages(args.messages, args.conversations)
+        db.messages.insert_many(messages)
+        db.messages.create_index([("conversation", 1), ("timestamp", 1), ("_id", 1)])
+        writer = WritePipeline(db.search_postings, max_batch=args.batch, max_delay=0.05, ordered=False)
+        index = SearchIndex(db.search_postings, db.messages, db.search_state, writer)
+        index.ensure_indexes()
+
+        print(f"{args.messages} messages in {args.conversations} conversations ({args.mongo})")
+        started = time.perf_counter()
+        indexed = index.backfill(batch_size=args.batch)
+        elapsed = time.perf_counter() - started
+        print(f"  backfill           {indexed} messages in {elapsed:.2f}s "
+              f"({indexed / elapsed:,.0f} msg/s, {db.search_postings.count_documents({})} posting documents)")
+
+        # What a send pays: building the posting updates and queueing them
+        db.search_postings.drop()
+        index.ensure_indexes()
+        sample = messages[:2000]
+        postings = sum(len(index.updates(message)) for message in sample)
+        target = writer.stats()["operations"] + postings
+        started = time.perf_counter()
+        for message in sample:
+            index.add(message)
+        enqueued = time.perf_counter()
+        while writer.stats()["operations"] < target:
+            time.sleep(0.001)
+        flushed = time.perf_counter()
+        stats = writer.stats()
+        print(f"  write path         {(enqueued - started) / len(sample) * 1e6:.1f} us/message on the send path "
+              f"({postings / len(sample):.1f} postings each)")
+        print(f"  flush              {postings / (flushed - started):,.0f} postings/s, "
+              f"avg batch {stats['avg_batch_size']:.0f}, errors {stats['errors']}")
+
+        db.search_postings.drop()
+        db.search_state.drop()
+        index.ensure_indexes()
+        index.backfill(batch_size=args.batch)
+        scope = [f"group{c}" for c in range(args.scope)]
+        print(f"  queries over {args.scope} conversations, {args.queries} runs each:")
+        for name, query in QUERIES:
+            for label, run in (
+                ("index", lambda q=query: index.search(scope, q, limit=20)),
+                ("regex", lambda q=query: list(db.messages.find(
+                    {"conversation": {"$in": scope},
+                     "content": {"$regex": "|".join(re.escape(t) for t in q.split()), "$options": "i"}}
+                ).sort([("timestamp", -1), ("_id", -1)]).limit(20))),
+            ):
+                timings = []
+                for _ in range(args.queries):
+                    started = time.perf_counter()
+                    run()
+                    timings.append(time.perf_counter() - started)
+                print(f"    {name:<10} {label:<6} p50 {percentile(timings, 50) * 1000:7.2f} ms  "
+                      f"p95 {percentile(timings, 95) * 1000:7.2f} ms  p99 {percentile(timings, 99) * 1000:7.2f} ms")
+    finally:
+        client.drop_database("bench_search")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Serialization micro-benchmarks.
+
+1. Fan-out of one group message to 1,000 members: json.dumps per recipient
+   (the old loops) vs. encoding the frame once.
+2. A 10,000-message history response: converting _id/timestamp per document
+   and then json.dumps (the old routes) vs. the shared serializer, which
+   handles ObjectId/datetime itself.
+
+    python bench/bench_serialization.py --repeat 20
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import sys
+import timeit
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import serialization  # noqa: E402
+
+
+def make_message(i, group_id):
+    return {
+        "_id": ObjectId(),
+        "sender": f"user{i % 50}@example.com",
+        "group_id": group_id,
+        "conversation": group_id,
+        "seq": i,
+        "content": f"message number {i} with a little bit of text in it",
+        "timestamp": datetime(2026, 1, 1) + timedelta(seconds=i),
+    }
+
+
+def bench_broadcast(repeat, members):
+    group_id = str(ObjectId())
+    message = make_message(1, group_id)
+    message["_id"] = str(message["_id"])
+    message["timestamp"] = message["timestamp"].isoformat()
+    payload = {"type": "group_message", "message": message}
+    recipients = [f"user{i}@example.com" for i in range(members)]
+    sink = []
+
+    def per_recipient():
+        sink.clear()
+        for _ in recipients:
+            sink.append(json.dumps(payload))
+
+    def encode_once():
+        sink.clear()
+        frame = serialization.dumps(payload)
+        for _ in recipients:
+            sink.append(frame)
+
+    report(f"broadcast to {members} members", repeat, [
+        ("json.dumps per recipient", per_recipient),
+        (f"encode once ({serialization.backend()})", encode_once),
+    ])
+
+
+def bench_history(repeat, count):
+    group_id = str(ObjectId())
+    source = [make_message(i, group_id) for i in range(count)]
+
+    def convert_loop():
+        messages = [dict(m) for m in source]
+        for message in messages:
+            message["_id"] = str(message["_id"])
+            message["timestamp"] = message["timestamp"].isoformat()
+        return json.dumps(messages)
+
+    def shared_serializer():
+        return serialization.dumps([dict(m) for m in source])
+
+    report(f"history response of {count} messages", repeat, [
+        ("per-document loop + json.dumps", convert_loop),
+        (f"serializer ({serialization.backend()})", shared_serializer),
+    ])
+
+
+def report(title, repeat, cases):
+    print(title)
+    baseline = None
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        baseline = baseline or best
+        print(f"  {name:<36} {best * 1000:9.3f} ms  ({baseline / best:5.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=10000)
+    args = parser.parse_args()
+    bench_broadcast(args.repeat, args.members)
+    bench_history(args.repeat, args.messages)
+
+
+if __name__ == "__main__":
+    main()
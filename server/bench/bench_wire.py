@@ -0,0 +1,102 @@
+"""Wire format benchmark: bytes per frame and CPU per frame for each /ws mode.
+
+Replays a mobile-like stream (mostly typing and status chatter, some direct
+and group messages) through JSON text, JSON + deflate, compact and
+compact + deflate. The payload is encoded once per format, then each of
+--recipients connections prepares it (sender dictionary, deflate context)
+the way the outbox writer does.
+
+    python bench/bench_wire.py --frames 5000 --recipients 20
+"""
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import time
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import wire  # noqa: E402
+from serialization import dumps  # noqa: E402
+
+MODES = [
+    ("json", wire.JSON, None),
+    ("json + deflate", wire.JSON, wire.DEFLATE),
+    ("compact", wire.COMPACT, None),
+    ("compact + deflate", wire.COMPACT, wire.DEFLATE),
+]
+
+
+def make_stream(count, users, seed=1):
+    rng = random.Random(seed)
+    emails = [f"user{i}@example.com" for i in range(users)]
+    group_id = str(ObjectId())
+    start = datetime(2026, 1, 1)
+    frames = []
+    for i in range(count):
+        sender = rng.choice(emails)
+        roll = rng.random()
+        if roll < 0.55:
+            frames.append({"type": "typing", "sender": sender, "isTyping": rng.random() < 0.5})
+        elif roll < 0.75:
+            frames.append({"type": "status", "user": sender, "status": rng.choice(["online", "offline"])})
+        elif roll < 0.9:
+            frames.append({
+                "type": "message", "_id": str(ObjectId()), "sender": sender,
+                "content": "on my way, see you in ten", "timestamp": (start + timedelta(seconds=i)).isoformat(),
+                "conversation": f"{sender}|user0@example.com", "seq": i,
+            })
+        else:
+            frames.append({"type": "group_message", "message": {
+                "_id": str(ObjectId()), "sender": sender, "group_id": group_id,
+                "conversation": group_id, "seq": i, "content": "sounds good to me",
+                "timestamp": (start + timedelta(seconds=i)).isoformat(),
+            }})
+    return [dumps(frame) for frame in frames]
+
+
+def run(name, encoding, compression, stream, recipients):
+    table = wire.SenderTable()
+    sessions = [wire.Session(table, encoding, compression) for _ in range(recipients)]
+    sent = 0
+    encode_time = 0.0
+    prepare_time = 0.0
+    for text in stream:
+        started = time.perf_counter()
+        encoded = wire.encode_text(text, encoding, table)  # once per broadcast
+        encode_time += time.perf_counter() - started
+        started = time.perf_counter()
+        for session in sessions:
+            frame = encoded if session.passthrough else session.prepare(encoded)
+            sent += len(frame.encode("utf-8") if isinstance(frame, str) else frame)
+        prepare_time += time.perf_counter() - started
+    frames = len(stream) * recipients
+    print(f"  {name:<18} {sent / frames:8.1f} B/frame  "
+          f"encode {encode_time / len(stream) * 1e6:7.2f} us/broadcast  "
+          f"send-side {prepare_time / frames * 1e6:6.2f} us/frame  "
+          f"total {(encode_time + prepare_time) / frames * 1e6:6.2f} us/frame")
+    return sent / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=5000)
+    parser.add_argument("--recipients", type=int, default=20, help="connections each frame is delivered to")
+    parser.add_argument("--users", type=int, default=50, help="distinct senders in the stream")
+    args = parser.parse_args()
+
+    stream = make_stream(args.frames, args.users)
+    print(f"{args.frames} frames x {args.recipients} recipients, {args.users} senders, "
+          f"msgpack backend: {'msgpack' if wire.msgpack else 'pure python'}")
+    baseline = None
+    for name, encoding, compression in MODES:
+        size = run(name, encoding, compression, stream, args.recipients)
+        baseline = baseline or size
+        print(f"  {'':<18} {size / baseline * 100:7.1f}% of JSON bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Hold many idle connections open against the asyncio gateway.
+
+Starts gateway.py as a subprocess (or uses --url and --pid for one that is
+already running), upserts --users bench users straight into Mongo, opens
+--connections authenticated sockets spread over them and reports the
+gateway's resident memory before and after, per connection. Every socket
+then sends a ping to check the gateway still answers.
+
+    ulimit -n 20000
+    python bench/gateway_idle.py --connections 10000 --users 10000
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+import json
+import os
+import subprocess
+import sys
+import time
+
+import jwt
+from pymongo import MongoClient, UpdateOne
+from websockets.asyncio.client import connect
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def rss_kib(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def make_tokens(count, secret):
+    client = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+    users = client[os.getenv('DB_NAME', 'chat_app')].users
+    emails = [f"gateway-bench-{i}@example.com" for i in range(count)]
+    now = datetime.utcnow()
+    users.bulk_write([
+        UpdateOne({"email": email}, {"$setOnInsert": {"email": email, "password": "", "status": "offline",
+                                                      "last_seen": now, "updated_at": now}}, upsert=True)
+        for email in emails
+    ], ordered=False)
+    expires = now + timedelta(hours=1)
+    return [jwt.encode({"email": email, "exp": expires}, secret, algorithm="HS256") for email in emails]
+
+
+async def open_client(url, token, sockets, failures):
+    try:
+        ws = await connect(url, compression=None, max_queue=4)
+        await ws.send(json.dumps({"type": "auth", "token": token}))
+        reply = json.loads(await ws.recv())
+        if reply.get("type") != "authenticated":
+            raise RuntimeError(reply)
+        sockets.append(ws)
+    except Exception as e:
+        failures.append(e)
+
+
+async def run(args, pid):
+    tokens = make_tokens(args.users, args.secret)
+    before = rss_kib(pid)
+    sockets, failures = [], []
+    started = time.perf_counter()
+    for i in range(0, args.connections, args.batch):
+        await asyncio.gather(*(open_client(args.url, tokens[n % len(tokens)], sockets, failures)
+                               for n in range(i, min(i + args.batch, args.connections))))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(args.settle)
+    after = rss_kib(pid)
+    print(f"{len(sockets)} connections open ({len(failures)} failed) in {elapsed:.1f}s")
+    if failures:
+        print(f"  first failure: {failures[0]!r}")
+    print(f"gateway RSS {before / 1024:.1f} MiB -> {after / 1024:.1f} MiB, "
+          f"{(after - before) / max(1, len(sockets)):.1f} KiB per connection")
+
+    async def ping(ws):
+        await ws.send(json.dumps({"type": "ping"}))
+        while True:
+            if json.loads(await ws.recv()).get("type") == "pong":
+                return
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(asyncio.wait_for(ping(ws), 30) for ws in sockets), return_exceptions=True)
+    ok = sum(1 for result in results if not isinstance(result, Exception))
+    print(f"{ok}/{len(sockets)} pings answered in {time.perf_counter() - started:.2f}s")
+    await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=500, help="connections opened concurrently")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait before measuring")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--url", help="use an already running gateway (requires --pid)")
+    parser.add_argument("--pid", type=int, help="pid of the running gateway, for memory readings")
+    parser.add_argument("--secret", default=os.getenv('SECRET_KEY', '2f9d0558e4064086850082bdb6440db0'))
+    args = parser.parse_args()
+
+    gateway = None
+    if args.url:
+        if not args.pid:
+            parser.error("--url requires --pid")
+        pid = args.pid
+    else:
+        env = dict(os.environ, GATEWAY_COMPRESSION="none", SECRET_KEY=args.secret)
+        gateway = subprocess.Popen([sys.executable, "gateway.py", "--host", "127.0.0.1", "--port", str(args.port)],
+                                   cwd=SERVER_DIR, env=env)
+        args.url = f"ws://127.0.0.1:{args.port}/ws"
+        pid = gateway.pid
+        time.sleep(3)
+    try:
+        asyncio.run(run(args, pid))
+    finally:
+        if gateway:
+            gateway.terminate()
+            gateway.wait()
+
+
+if __name__ == "__main__":
+    main()
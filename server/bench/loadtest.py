@@ -0,0 +1,528 @@
+"""Load test for the chat server: WebSocket clients plus REST traffic.
+
+Starts the server in a child process against a local mongod (--mongo URI,
+using a throwaway database) or an in-memory stand-in (--mongo memory,
+needs mongomock). It then registers --clients users, creates groups and
+connects one socket per user. For --duration seconds the clients send 1:1
+messages, group messages and typing frames while REST workers call
+get_contacts, get_messages and get_user_groups. Halfway through, a
+reconnect storm drops --storm of the sockets and reconnects them at once
+with last_seq catch-up.
+
+Reported: end-to-end delivery latency percentiles, messages/s sent and
+delivered, REST latency per route, Mongo operations per message, reconnect
+times and the RSS of the server and client processes. Results are written
+as JSON; --baseline compares against an earlier run and flags regressions.
+
+    python bench/loadtest.py --mongo memory --clients 50 --duration 20
+    python bench/loadtest.py --mongo mongodb://localhost:27017/ --clients 200 \\
+        --baseline bench/baselines/loadtest-local.json
+    python bench/loadtest.py ... --save-baseline bench/baselines/loadtest-local.json
+"""
+import argparse
+import asyncio
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RESULTS_DIR = os.path.join(SERVER_DIR, "bench", "results")
+PASSWORD = "bench-password"
+
+# Metrics compared against a baseline, and whether higher is better
+COMPARED = {
+    "delivery_latency_ms.p50": False,
+    "delivery_latency_ms.p99": False,
+    "messages_per_second.delivered": True,
+    "mongo_ops_per_message": False,
+    "reconnect_ms.p99": False,
+    "rest_latency_ms.all.p99": False,
+    "memory_mib.server": False,
+}
+
+
+# -- server side -----------------------------------------------------------------
+
+class OpCounter:
+    """Counts Mongo operations: a CommandListener for pymongo, wrapped
+    collection methods for mongomock (which has no command monitoring)."""
+
+    COLLECTION_METHODS = (
+        "find", "find_one", "insert_one", "insert_many", "update_one", "update_many",
+        "find_one_and_update", "bulk_write", "distinct", "count_documents", "aggregate",
+        "delete_one", "delete_many",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def incr(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    # pymongo.monitoring.CommandListener interface
+    def started(self, event):
+        if event.command_name not in ("getMore", "endSessions", "hello", "isMaster", "ping"):
+            self.incr(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def wrap_mongomock(self, collection_class):
+        for name in self.COLLECTION_METHODS:
+            original = getattr(collection_class, name, None)
+            if original is None:
+                continue
+
+            def wrapped(*args, _original=original, _name=name, **kwargs):
+                self.incr(_name)
+                return _original(*args, **kwargs)
+            setattr(collection_class, name, wrapped)
+
+    def snapshot(self):
+        with self._lock:
+            return {"total": sum(self.counts.values()), "by_command": dict(self.counts)}
+
+
+def serve(args):
+    counter = OpCounter()
+    if args.mongo == "memory":
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        counter.wrap_mongomock(mongomock.collection.Collection)
+    else:
+        from pymongo import MongoClient, monitoring
+        MongoClient(args.mongo).drop_database(args.db)
+        monitoring.register(counter)
+        os.environ["MONGO_URI"] = args.mongo
+        os.environ["DB_NAME"] = args.db
+
+    sys.path.insert(0, SERVER_DIR)
+    os.chdir(SERVER_DIR)
+    import app as chat
+
+    chat.app.add_url_rule("/bench/ops", "bench_ops", lambda: counter.snapshot())
+    if args.gateway:
+        import gateway
+        os.environ["PORT"] = str(args.rest_port)
+        sys.argv = ["gateway.py", "--host", "127.0.0.1", "--port", str(args.ws_port), "--with-api"]
+        gateway.main()
+    else:
+        chat.app.run(host="127.0.0.1", port=args.rest_port, threaded=True, use_reloader=False)
+
+
+def start_server(args):
+    env = dict(
+        os.environ,
+        BCRYPT_LOG_ROUNDS=str(args.bcrypt_rounds),
+        HASH_QUEUE_SIZE="100000",
+        WS_RATE_LIMITS=os.getenv("WS_RATE_LIMITS", "message=1000/1000,group_message=1000/1000"),
+        CONTACTS_SETTLE_SECONDS="0",
+    )
+    command = [sys.executable, os.path.abspath(__file__), "--serve", "--mongo", args.mongo, "--db", args.db,
+               "--rest-port", str(args.rest_port), "--ws-port", str(args.ws_port)]
+    if args.gateway:
+        command.append("--gateway")
+    # Own process group, so stop_server also reaches the bcrypt pool workers
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL if args.quiet else None,
+                              stderr=subprocess.DEVNULL if args.quiet else None, start_new_session=True)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.rest_port), timeout=1).close()
+            if args.gateway:
+                socket.create_connection(("127.0.0.1", args.ws_port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                stop_server(server)
+                raise SystemExit("server exited during startup")
+            time.sleep(0.2)
+    stop_server(server)
+    raise SystemExit("server did not start")
+
+
+def stop_server(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    server.wait()
+
+
+# -- client side -----------------------------------------------------------------
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def at(pct):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 3)
+    return {"count": len(ordered), "p50": at(50), "p90": at(90), "p99": at(99), "max": round(ordered[-1], 3)}
+
+
+def rss_mib(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if pid == "self" else None
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.api = f"http://127.0.0.1:{args.rest_port}"
+        self.ws_url = f"ws://127.0.0.1:{args.ws_port if args.gateway else args.rest_port}/ws"
+        self.users = [f"load{i}@example.com" for i in range(args.clients)]
+        self.tokens = {}
+        self.groups = {}       # {group_id: [members]}
+        self.user_groups = {}  # {email: [group_id]}
+        self.clients = {}
+        self.sent = {"message": 0, "group_message": 0, "typing": 0}
+        self.expected = 0
+        self.latencies = []
+        self.rest = {}
+        self.reconnects = []
+        self.errors = {}
+        self.running = False
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    # REST, on threads so the event loop keeps reading sockets
+    def _http(self, method, path, token=None, body=None):
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.api + path, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as response:
+                return response.status, json.loads(response.read() or b"null")
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+    async def http(self, method, path, token=None, body=None):
+        return await asyncio.to_thread(self._http, method, path, token, body)
+
+    async def setup(self):
+        limit = asyncio.Semaphore(16)
+
+        async def register(email):
+            async with limit:
+                await self.http("POST", "/api/register", body={"email": email, "password": PASSWORD})
+                for _ in range(20):
+                    status, body = await self.http("POST", "/api/login", body={"email": email, "password": PASSWORD})
+                    if status == 200:
+                        self.tokens[email] = body["token"]
+                        return
+                    await asyncio.sleep(0.2)
+                raise RuntimeError(f"login failed for {email}: {status}")
+
+        await asyncio.gather(*(register(email) for email in self.users))
+        for n in range(self.args.groups):
+            members = self.rng.sample(self.users, min(self.args.group_size, len(self.users)))
+            status, body = await self.http("POST", "/api/groups/create", self.tokens[members[0]],
+                                           {"name": f"load group {n}", "members": members})
+            if status != 201:
+                raise RuntimeError(f"group create failed: {status}")
+            self.groups[body["_id"]] = body["members"]
+            for member in body["members"]:
+                self.user_groups.setdefault(member, []).append(body["_id"])
+
+    async def connect(self, email, last_seq=None):
+        from websockets.asyncio.client import connect
+        ws = await connect(self.ws_url, max_size=None, open_timeout=30)
+        auth = {"type": "auth", "token": self.tokens[email]}
+        if last_seq:
+            auth["last_seq"] = last_seq
+        await ws.send(json.dumps(auth))
+        client = self.clients.setdefault(email, {"seqs": {}})
+        client["ws"] = ws
+        pending = set(self.user_groups.get(email, ()))
+        caught_up = not last_seq
+        while True:
+            frame = json.loads(await ws.recv())
+            kind = frame.get("type")
+            if kind == "authenticated":
+                for group_id in pending:
+                    await ws.send(json.dumps({"type": "join_group", "group_id": group_id}))
+            elif kind == "group_joined":
+                pending.discard(frame["group_id"])
+            elif kind == "catchup_done":
+                caught_up = True
+            else:
+                self.on_frame(email, frame)
+            if not pending and caught_up and kind in ("authenticated", "group_joined", "catchup_done"):
+                break
+        client["reader"] = asyncio.create_task(self.read(email, ws))
+
+    async def read(self, email, ws):
+        try:
+            async for data in ws:
+                self.on_frame(email, json.loads(data))
+        except Exception:
+            pass
+
+    def on_frame(self, email, frame):
+        kind = frame.get("type")
+        message = frame.get("message") if kind == "group_message" else frame
+        if kind not in ("message", "group_message") or not isinstance(message, dict):
+            if kind == "error":
+                self.error(frame.get("message", "error"))
+            return
+        self.clients[email]["seqs"][message["conversation"]] = message.get("seq", 0)
+        content = message.get("content", "")
+        if content.startswith("bench|"):
+            self.latencies.append((time.time() - float(content.split("|")[1])) * 1000)
+
+    async def client_loop(self, email):
+        rate = self.args.rate
+        while self.running:
+            await asyncio.sleep(self.rng.expovariate(rate))
+            ws = self.clients[email].get("ws")
+            if ws is None or not self.running:
+                continue
+            roll = self.rng.random()
+            groups = self.user_groups.get(email)
+            try:
+                if roll < self.args.typing_share:
+                    peer = self.rng.choice(self.users)
+                    await ws.send(json.dumps({"type": "typing", "receiver": peer, "isTyping": self.rng.random() < 0.7}))
+                    self.sent["typing"] += 1
+                elif groups and roll < self.args.typing_share + self.args.group_share:
+                    group_id = self.rng.choice(groups)
+                    await ws.send(json.dumps({"type": "group_message", "group_id": group_id,
+                                              "content": f"bench|{time.time()}|group"}))
+                    self.sent["group_message"] += 1
+                    self.expected += len(self.groups[group_id]) - 1
+                else:
+                    peer = self.rng.choice([u for u in self.users if u != email] or [email])
+                    await ws.send(json.dumps({"type": "message", "receiver": peer,
+                                              "content": f"bench|{time.time()}|direct"}))
+                    self.sent["message"] += 1
+                    self.expected += 1
+            except Exception:
+                self.error("send failed")
+
+    async def rest_loop(self):
+        routes = [
+            ("get_contacts", lambda email: "/api/contacts"),
+            ("get_messages", lambda email: f"/api/messages/{self.rng.choice(self.users)}"),
+            ("get_user_groups", lambda email: "/api/groups"),
+        ]
+        while self.running:
+            email = self.rng.choice(self.users)
+            name, path = self.rng.choice(routes)
+            started = time.perf_counter()
+            status, _ = await self.http("GET", path(email), self.tokens[email])
+            elapsed = (time.perf_counter() - started) * 1000
+            self.rest.setdefault(name, []).append(elapsed)
+            if status != 200:
+                self.error(f"{name} {status}")
+            await asyncio.sleep(self.rng.expovariate(self.args.rest_rate))
+
+    async def storm(self):
+        victims = self.rng.sample(self.users, int(len(self.users) * self.args.storm))
+        for email in victims:
+            client = self.clients[email]
+            client["reader"].cancel()
+            ws, client["ws"] = client["ws"], None
+            await ws.close()
+
+        async def reconnect(email):
+            started = time.perf_counter()
+            try:
+                await self.connect(email, dict(self.clients[email]["seqs"]) or None)
+                self.reconnects.append((time.perf_counter() - started) * 1000)
+            except Exception:
+                self.error("reconnect failed")
+        await asyncio.gather(*(reconnect(email) for email in victims))
+
+    async def run(self, server_pid):
+        args = self.args
+        await self.setup()
+        await asyncio.gather(*(self.connect(email) for email in self.users))
+        status, ops_before = await self.http("GET", "/bench/ops")
+
+        self.running = True
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(self.client_loop(email)) for email in self.users]
+        tasks += [asyncio.create_task(self.rest_loop()) for _ in range(args.rest_workers)]
+        await asyncio.sleep(args.duration / 2)
+        if args.storm:
+            await self.storm()
+        await asyncio.sleep(max(0, args.duration - (time.perf_counter() - started)))
+        self.running = False
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(args.drain)
+        status, ops_after = await self.http("GET", "/bench/ops")
+        server_rss = rss_mib(server_pid)
+
+        for client in self.clients.values():
+            if client.get("reader"):
+                client["reader"].cancel()
+            if client.get("ws"):
+                await client["ws"].close()
+
+        messages = self.sent["message"] + self.sent["group_message"]
+        ops = ops_after["total"] - ops_before["total"]
+        rest_all = [v for values in self.rest.values() for v in values]
+        return {
+            "config": {key: value for key, value in vars(args).items() if key not in ("serve", "quiet")},
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "started_at": datetime.utcnow().isoformat(),
+            },
+            "sent": dict(self.sent),
+            "deliveries": {"expected": self.expected, "received": len(self.latencies)},
+            "messages_per_second": {
+                "sent": round(messages / elapsed, 1),
+                "delivered": round(len(self.latencies) / elapsed, 1),
+            },
+            "delivery_latency_ms": percentiles(self.latencies),
+            "rest_latency_ms": {**{name: percentiles(values) for name, values in self.rest.items()},
+                                "all": percentiles(rest_all)},
+            "reconnect_ms": percentiles(self.reconnects),
+            "mongo_ops": ops,
+            "mongo_ops_per_message": round(ops / messages, 2) if messages else None,
+            "mongo_ops_by_command": {
+                name: count - ops_before["by_command"].get(name, 0)
+                for name, count in ops_after["by_command"].items()
+                if count - ops_before["by_command"].get(name, 0)
+            },
+            "memory_mib": {"server": server_rss, "client": rss_mib()},
+            "errors": self.errors,
+        }
+
+
+# -- reporting -------------------------------------------------------------------
+
+def lookup(results, path):
+    value = results
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def report(results):
+    latency = results["delivery_latency_ms"]
+    print(f"sent {results['sent']}, delivered {results['deliveries']['received']}"
+          f"/{results['deliveries']['expected']}")
+    print(f"messages/s: {results['messages_per_second']['sent']} sent, "
+          f"{results['messages_per_second']['delivered']} delivered")
+    print(f"delivery latency ms: p50 {latency.get('p50')}  p90 {latency.get('p90')}  "
+          f"p99 {latency.get('p99')}  max {latency.get('max')}")
+    for name, stats in results["rest_latency_ms"].items():
+        print(f"  {name:<16} n={stats['count']:<6} p50 {stats.get('p50')}  p99 {stats.get('p99')} ms")
+    print(f"reconnect ms: {results['reconnect_ms']}")
+    print(f"mongo ops: {results['mongo_ops']} ({results['mongo_ops_per_message']} per message) "
+          f"{results['mongo_ops_by_command']}")
+    print(f"memory MiB: {results['memory_mib']}")
+    if results["errors"]:
+        print(f"errors: {results['errors']}")
+
+
+def compare(results, baseline, tolerance):
+    print(f"compared with baseline from {lookup(baseline, 'environment.started_at')}:")
+    differing = sorted(key for key in ("mongo", "gateway", "clients", "groups", "group_size", "duration", "rate",
+                                       "typing_share", "group_share", "rest_workers", "rest_rate", "storm")
+                       if lookup(baseline, f"config.{key}") != lookup(results, f"config.{key}"))
+    if differing:
+        print(f"  warning: runs differ in {', '.join(differing)}; numbers are not comparable")
+    regressions = []
+    for path, higher_is_better in COMPARED.items():
+        old, new = lookup(baseline, path), lookup(results, path)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = "REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(path)
+        print(f"  {path:<34} {old:>10} -> {new:<10} {change * 100:+7.1f}% {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", default="memory", help='"memory" (mongomock) or a mongodb:// URI')
+    parser.add_argument("--db", default="chat_loadtest", help="database to use (dropped first) with a real mongod")
+    parser.add_argument("--gateway", action="store_true", help="serve /ws from the asyncio gateway")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--rate", type=float, default=1.0, help="frames per second per client")
+    parser.add_argument("--typing-share", type=float, default=0.4)
+    parser.add_argument("--group-share", type=float, default=0.2)
+    parser.add_argument("--rest-workers", type=int, default=4)
+    parser.add_argument("--rest-rate", type=float, default=20, help="requests per second per REST worker")
+    parser.add_argument("--storm", type=float, default=0.5, help="share of sockets dropped in the reconnect storm")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for deliveries after the run")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4, help="server bcrypt cost (low, to keep setup fast)")
+    parser.add_argument("--rest-port", type=int, default=5071)
+    parser.add_argument("--ws-port", type=int, default=5072)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="results file (default bench/results/loadtest-<time>.json)")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument("--save-baseline", help="also write the results here")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change flagged as a regression")
+    parser.add_argument("--quiet", action="store_true", help="hide server output")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    server = start_server(args)
+    try:
+        results = asyncio.run(LoadTest(args).run(server.pid))
+    finally:
+        stop_server(server)
+
+    report(results)
+    out = args.out or os.path.join(RESULTS_DIR, f"loadtest-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    for path in filter(None, (out, args.save_baseline)):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"results written to {path}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""Start a local broker and N app.py workers and check cross-worker delivery.
+
+Every worker is the real server (app.py on its own port, ROUTER_URL pointing
+at the broker) and owns one user, whose socket connects to that worker only.
+All users share one group. The harness then checks, for every pair of
+workers, that:
+
+  * a 1:1 message sent over REST on one worker reaches the recipient's
+    socket on another
+  * a group message sent over /ws on one worker reaches every other
+    member's socket
+  * presence crosses workers: each user sees the others online, a clean
+    disconnect is announced to the others, and when a worker is killed
+    outright (no disconnect at all) its user goes offline everywhere else
+
+--mongo takes a MongoDB URI (workers share the bench_multiworker database,
+which is dropped first) or "memory", where each worker has its own mongomock
+database seeded with the same users and group; messages are then stored
+only on the sending worker, but everything that crosses workers still goes
+through the router.
+
+    python bench/multiworker_harness.py --workers 3
+    python bench/multiworker_harness.py --workers 4 --mongo mongodb://localhost:27017/
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PASSWORD = "harness-password"
+GROUP_ID = "6500000000000000000000aa"
+DB_NAME = "bench_multiworker"
+
+
+# -- worker side -----------------------------------------------------------------
+
+def serve(args):
+    if args.mongo == "memory":
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    else:
+        os.environ["MONGO_URI"] = args.mongo
+        os.environ["DB_NAME"] = DB_NAME
+
+    sys.path.insert(0, SERVER_DIR)
+    os.chdir(SERVER_DIR)
+    import app as chat
+    from bson import ObjectId
+
+    members = [user(i) for i in range(args.workers)]
+    chat.groups_collection.update_one(
+        {"_id": ObjectId(GROUP_ID)},
+        {"$setOnInsert": {"name": "harness", "members": members, "admins": members[:1],
+                          "created_by": members[0], "created_at": datetime.utcnow(), "version": 1}},
+        upsert=True
+    )
+    chat.app.run(host="127.0.0.1", port=args.port, threaded=True, use_reloader=False)
+
+
+# -- harness side ----------------------------------------------------------------
+
+def user(index):
+    return f"worker{index}@example.com"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def http(port, method, path, token=None, body=None):
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            return response.status, json.loads(response.read() or b"null")
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+
+def wait_for_port(port, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if proc.poll() is not None:
+                raise SystemExit(f"worker on port {port} exited during startup")
+            time.sleep(0.2)
+    raise SystemExit(f"worker on port {port} did not start")
+
+
+def stop(proc, sig=signal.SIGTERM):
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+class Client:
+    """One user's socket on its worker; frames are collected on a thread."""
+
+    def __init__(self, port, token):
+        from websockets.sync.client import connect
+        # Entered by hand: the socket outlives this call and is closed in close()
+        self.ws = connect(f"ws://127.0.0.1:{port}/ws", open_timeout=10).__enter__()
+        self.frames = queue.Queue()
+        self.seen = []
+        self.ws.send(json.dumps({"type": "auth", "token": token}))
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        try:
+            for data in self.ws:
+                self.frames.put(json.loads(data))
+        except Exception:
+            pass
+
+    def send(self, frame):
+        self.ws.send(json.dumps(frame))
+
+    def mark(self):
+        """Position after every frame received so far, for wait_for(since=)."""
+        while True:
+            try:
+                self.seen.append(self.frames.get_nowait())
+            except queue.Empty:
+                return len(self.seen)
+
+    def wait_for(self, match, timeout, since=0):
+        """The first frame (already seen or arriving within ``timeout``) that matches."""
+        for frame in self.seen[since:]:
+            if match(frame):
+                return frame
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                frame = self.frames.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            self.seen.append(frame)
+            if match(frame):
+                return frame
+
+    def close(self):
+        self.ws.close()
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.failures = []
+        self.checks = 0
+
+    def check(self, ok, description):
+        self.checks += 1
+        if not ok:
+            self.failures.append(description)
+            print(f"  FAIL {description}")
+
+    def status_of(self, client, email):
+        since = client.mark()
+        client.send({"type": "status_request", "target": email})
+        frame = client.wait_for(lambda f: f.get("type") == "status" and f.get("user") == email,
+                                self.args.timeout, since)
+        return frame and frame["status"]
+
+    def run(self, ports, workers):
+        args = self.args
+        n = len(ports)
+        tokens = {}
+        for i in range(n):
+            # Memory mode: every worker needs every user in its own database
+            for port in ports:
+                http(port, "POST", "/api/register", body={"email": user(i), "password": PASSWORD})
+            status, body = http(ports[i], "POST", "/api/login", body={"email": user(i), "password": PASSWORD})
+            if status != 200:
+                raise SystemExit(f"login of {user(i)} failed with {status}")
+            tokens[i] = body["token"]
+
+        clients = {i: Client(ports[i], tokens[i]) for i in range(n)}
+        for i, client in clients.items():
+            if not client.wait_for(lambda f: f.get("type") == "authenticated", args.timeout):
+                raise SystemExit(f"{user(i)} was not authenticated")
+            client.send({"type": "join_group", "group_id": GROUP_ID})
+            self.check(client.wait_for(lambda f: f.get("type") == "group_joined", args.timeout) is not None,
+                       f"{user(i)} joins the group on worker {i}")
+        time.sleep(args.settle)
+
+        print("presence across workers")
+        for i in range(n):
+            for j in range(n):
+                if i != j:
+                    self.check(self.status_of(clients[i], user(j)) == "online",
+                               f"worker {i} sees {user(j)} online")
+
+        print("1:1 messages over REST")
+        for i in range(n):
+            for j in range(n):
+                if i == j:
+                    continue
+                content = f"direct {i}->{j}"
+                status, _ = http(ports[i], "POST", "/api/messages/send", tokens[i],
+                                 {"receiver": user(j), "content": content})
+                self.check(status == 201, f"send {content} on worker {i}")
+                frame = clients[j].wait_for(lambda f: f.get("type") == "message" and f.get("content") == content,
+                                            args.timeout)
+                self.check(frame is not None and frame["sender"] == user(i),
+                           f"{content} reaches {user(j)} on worker {j}")
+
+        print("group messages over /ws")
+        for i in range(n):
+            content = f"group from {i}"
+            clients[i].send({"type": "group_message", "group_id": GROUP_ID, "content": content})
+            for j in range(n):
+                if i == j:
+                    continue
+                frame = clients[j].wait_for(lambda f: f.get("type") == "group_message"
+                                            and f["message"].get("content") == content, args.timeout)
+                self.check(frame is not None, f"{content!r} reaches {user(j)} on worker {j}")
+
+        if n < 2:
+            return
+        print("presence changes")
+        last = n - 1
+        clients[last].close()
+
+        def offline(frame):
+            return frame.get("type") == "status" and frame.get("user") == user(last) and frame["status"] == "offline"
+        for i in range(last):
+            self.check(clients[i].wait_for(offline, args.timeout) is not None,
+                       f"{user(i)} is told {user(last)} went offline")
+
+        clients[last] = Client(ports[last], tokens[last])
+        clients[last].wait_for(lambda f: f.get("type") == "authenticated", args.timeout)
+        time.sleep(args.settle)
+        self.check(self.status_of(clients[0], user(last)) == "online", f"{user(last)} is back online")
+
+        # No disconnect is ever sent for sockets of a killed worker
+        stop(workers[last], signal.SIGKILL)
+        deadline = time.monotonic() + args.timeout
+        status = None
+        while time.monotonic() < deadline:
+            status = self.status_of(clients[0], user(last))
+            if status == "offline":
+                break
+            time.sleep(0.2)
+        self.check(status == "offline", f"{user(last)} goes offline after worker {last} is killed")
+
+        for i in range(last):
+            clients[i].close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--mongo", default="memory", help='MongoDB URI or "memory" (mongomock)')
+    parser.add_argument("--timeout", type=float, default=5, help="seconds to wait for each delivery")
+    parser.add_argument("--settle", type=float, default=0.5, help="seconds for presence to propagate")
+    parser.add_argument("--quiet", action="store_true", help="hide the workers' output")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    if args.mongo != "memory":
+        from pymongo import MongoClient
+        MongoClient(args.mongo).drop_database(DB_NAME)
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "router.sock")
+    output = subprocess.DEVNULL if args.quiet else None
+    broker = subprocess.Popen([sys.executable, "routing.py"], cwd=SERVER_DIR,
+                              env={**os.environ, "ROUTER_SOCKET": socket_path},
+                              stdout=output, stderr=output, start_new_session=True)
+    workers = []
+    try:
+        deadline = time.monotonic() + 5
+        while not os.path.exists(socket_path):
+            if time.monotonic() > deadline:
+                raise SystemExit("Broker did not start")
+            time.sleep(0.05)
+
+        env = dict(
+            os.environ,
+            ROUTER_URL=f"unix://{socket_path}",
+            ROUTER_HEARTBEAT="0.5",
+            BCRYPT_LOG_ROUNDS="4",
+            PRESENCE_DEBOUNCE="0.1",
+            CONTACTS_SETTLE_SECONDS="0",
+            SEARCH_BACKFILL="False",
+        )
+        ports = [free_port() for _ in range(args.workers)]
+        for port in ports:
+            # Own process group, so stop() also reaches the bcrypt pool workers
+            workers.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(port),
+                 "--workers", str(args.workers), "--mongo", args.mongo],
+                env=env, stdout=output, stderr=output, start_new_session=True
+            ))
+        for port, proc in zip(ports, workers):
+            wait_for_port(port, proc)
+
+        started = time.monotonic()
+        harness = Harness(args)
+        harness.run(ports, workers)
+        print(f"{args.workers} workers, {harness.checks} checks in {time.monotonic() - started:.2f}s")
+        if harness.failures:
+            raise SystemExit(f"FAILED: {len(harness.failures)} check(s)")
+        print("OK")
+    finally:
+        for proc in workers:
+            stop(proc)
+        stop(broker)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+import asyncio
+from collections import deque
+import threading
+import time
+
+# Overflow policies for a full outbound queue
+DROP_OLDEST = "drop_oldest"
+DROP_TYPING_FIRST = "drop_typing_first"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_TYPING_FIRST, DISCONNECT)
+
+# Frame kinds that are safe to drop when a client falls behind
+DROPPABLE_KINDS = {"typing", "status"}
+
+
+class Outbox:
+    """Bounded outbound queue for one WebSocket with its own writer thread.
+
+    Producers only ever call ``put``; the actual ``ws.send`` happens on the
+    writer thread, so a slow client never blocks the sender. ``prepare``, if
+    given, turns each queued frame into what is sent and runs on the writer
+    thread in send order (after any overflow drops). ``send_timer``, if
+    given, is called with the seconds each successful send took.
+    """
+
+    def __init__(self, ws, maxsize=256, overflow=DROP_OLDEST, send_timeout=10.0, name=None, stats=None,
+                 prepare=None, send_timer=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.ws = ws
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.send_timeout = send_timeout
+        self.name = name
+        self.stats = stats if stats is not None else DeliveryStats()
+        self.prepare = prepare
+        self.send_timer = send_timer
+        self.closed = False
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._sending_since = None
+        self._paused = False
+        self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name=f"outbox-{self.name}", daemon=True)
+        self._thread.start()
+
+    def _wake(self):
+        # Called with the lock held
+        self._cond.notify()
+
+    def put(self, frame, kind=None):
+        """Enqueue an encoded frame. Returns False if the frame was not queued."""
+        with self._cond:
+            if self.closed:
+                return False
+            if self._stalled():
+                self._abort("send timeout")
+                return False
+            if len(self._queue) >= self.maxsize and not self._make_room(kind):
+                return False
+            self._queue.append((frame, kind))
+            self.stats.incr("enqueued")
+            self._wake()
+            return True
+
+    def pause(self):
+        """Hold queued frames back until ``resume``; producers can keep enqueueing."""
+        with self._cond:
+            self._paused = True
+
+    def resume(self, frames=()):
+        """Send ``frames`` ahead of everything queued while paused, then continue."""
+        with self._cond:
+            self._queue.extendleft((frame, None) for frame in reversed(frames))
+            self._paused = False
+            self._wake()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._queue.clear()
+            self._wake()
+
+    def pending(self):
+        return len(self._queue)
+
+    def _make_room(self, kind):
+        # Called with the lock held and the queue full
+        if self.overflow == DISCONNECT:
+            self._abort("outbound queue overflow")
+            return False
+        if self.overflow == DROP_TYPING_FIRST:
+            if kind in DROPPABLE_KINDS:
+                # Never evict a real message to make room for typing chatter
+                self.stats.incr("dropped")
+                return False
+            for i, (_, queued_kind) in enumerate(self._queue):
+                if queued_kind in DROPPABLE_KINDS:
+                    del self._queue[i]
+                    self.stats.incr("dropped")
+                    return True
+        self._queue.popleft()
+        self.stats.incr("dropped")
+        return True
+
+    def _stalled(self):
+        started = self._sending_since
+        return started is not None and time.monotonic() - started > self.send_timeout
+
+    def _abort(self, reason):
+        # Called with the lock held
+        print(f"Disconnecting {self.name}: {reason}")
+        self.closed = True
+        self._queue.clear()
+        self._wake()
+        self.stats.incr("disconnected")
+        try:
+            # Closing from here unblocks a writer stuck in send()
+            self._close_socket()
+        except Exception:
+            pass
+
+    def _close_socket(self):
+        self.ws.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while (not self._queue or self._paused) and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+                frame, _ = self._queue.popleft()
+                self._sending_since = time.monotonic()
+            try:
+                if self.prepare:
+                    frame = self.prepare(frame)
+                started = time.perf_counter()
+                self.ws.send(frame)
+                self.stats.incr("sent")
+                if self.send_timer:
+                    self.send_timer(time.perf_counter() - started)
+            except Exception as e:
+                print(f"Failed to deliver to {self.name}: {e}")
+                with self._cond:
+                    self.closed = True
+                    self._queue.clear()
+                self.stats.incr("failed")
+                return
+            finally:
+                self._sending_since = None
+
+
+class AsyncOutbox(Outbox):
+    """Outbox for an asyncio WebSocket: the writer is a task, not a thread.
+
+    ``put`` is still safe to call from any thread (routed deliveries arrive on
+    the router thread, replies on the gateway's worker threads); it only
+    appends to the bounded queue and wakes the writer on the event loop. A
+    send that takes longer than ``send_timeout`` aborts the connection, so no
+    watchdog is needed.
+    """
+
+    def __init__(self, ws, loop, **kwargs):
+        self.loop = loop
+        super().__init__(ws, **kwargs)
+
+    def _start(self):
+        self._ready = asyncio.Event()
+        self._task = self.loop.create_task(self._run_async())
+
+    def _wake(self):
+        self.loop.call_soon_threadsafe(self._ready.set)
+
+    def _close_socket(self):
+        asyncio.run_coroutine_threadsafe(self.ws.close(), self.loop)
+
+    def _next(self):
+        with self._cond:
+            if self.closed:
+                return None, True
+            if not self._queue or self._paused:
+                self._ready.clear()
+                return None, False
+            frame, _ = self._queue.popleft()
+            self._sending_since = time.monotonic()
+            return frame, False
+
+    async def _run_async(self):
+        while True:
+            frame, closed = self._next()
+            if closed:
+                return
+            if frame is None:
+                await self._ready.wait()
+                continue
+            try:
+                if self.prepare:
+                    frame = self.prepare(frame)
+                started = time.perf_counter()
+                await asyncio.wait_for(self.ws.send(frame), self.send_timeout)
+                self.stats.incr("sent")
+                if self.send_timer:
+                    self.send_timer(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                with self._cond:
+                    self._abort("send timeout")
+                return
+            except Exception as e:
+                print(f"Failed to deliver to {self.name}: {e}")
+                with self._cond:
+                    self.closed = True
+                    self._queue.clear()
+                self.stats.incr("failed")
+                return
+            finally:
+                self._sending_since = None
+
+
+class DeliveryStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"enqueued": 0, "sent": 0, "dropped": 0, "failed": 0, "disconnected": 0}
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class Watchdog:
+    """Periodically aborts outboxes whose writer has been stuck in send() too long."""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._outboxes = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="outbox-watchdog", daemon=True)
+        self._thread.start()
+
+    def watch(self, outbox):
+        with self._lock:
+            self._outboxes.add(outbox)
+
+    def unwatch(self, outbox):
+        with self._lock:
+            self._outboxes.discard(outbox)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                outboxes = list(self._outboxes)
+            for outbox in outboxes:
+                with outbox._cond:
+                    if not outbox.closed and outbox._stalled():
+                        outbox._abort("send timeout")
@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import os
+import threading
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+import app as chat
+from app import AuthFailed, ClientConnection, authenticate_client, auth_error_frame
+from delivery import AsyncOutbox
+from wire import Session
+
+# asyncio WebSocket gateway speaking the same /ws protocol as the flask_sock
+# endpoint. An idle client costs a couple of small tasks and its buffers
+# instead of a blocked thread; the synchronous data layer (pymongo, the
+# caches) runs on a bounded thread pool, one frame at a time per connection
+# so frames are still handled in order.
+#
+# Run it next to the REST API, sharing deliveries through the broker:
+#   ROUTER_URL=unix:///tmp/chat-router.sock python routing.py
+#   ROUTER_URL=unix:///tmp/chat-router.sock python app.py
+#   ROUTER_URL=unix:///tmp/chat-router.sock python gateway.py
+# or in one process with the REST API on a background thread:
+#   python gateway.py --with-api
+
+GATEWAY_HOST = os.getenv('GATEWAY_HOST', '0.0.0.0')
+GATEWAY_PORT = int(os.getenv('GATEWAY_PORT', 8765))
+# Threads for data-layer calls; bounds concurrent Mongo work, not connections
+GATEWAY_WORKERS = int(os.getenv('GATEWAY_WORKERS', 32))
+AUTH_TIMEOUT = float(os.getenv('GATEWAY_AUTH_TIMEOUT', 10))
+
+# Per-connection memory bounds: the largest frame accepted from a client,
+# how many received frames may be buffered before reading stops, and the
+# high-water mark of the kernel-side write buffer. Outbound frames are
+# bounded by the outbox (WS_OUTBOX_SIZE).
+MAX_MESSAGE_SIZE = int(os.getenv('GATEWAY_MAX_MESSAGE_SIZE', 64 * 1024))
+MAX_QUEUE = int(os.getenv('GATEWAY_MAX_QUEUE', 4))
+WRITE_LIMIT = int(os.getenv('GATEWAY_WRITE_LIMIT', 32 * 1024))
+# permessage-deflate keeps a zlib context per connection (tens of KiB);
+# set to "none" when holding very many mostly idle sockets
+COMPRESSION = os.getenv('GATEWAY_COMPRESSION', 'deflate')
+
+executor = ThreadPoolExecutor(max_workers=GATEWAY_WORKERS, thread_name_prefix="gateway")
+
+
+async def offload(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def reject_other_paths(connection, request):
+    path = request.path.split("?")[0]
+    if path == "/metrics":
+        return serve_metrics(connection, request)
+    if path != "/ws":
+        return connection.respond(HTTPStatus.NOT_FOUND, "Not found\n")
+
+
+# A standalone gateway has no Flask app to scrape, so it answers /metrics on
+# its own port with the same registry and the same access rule
+def serve_metrics(connection, request):
+    if chat.METRICS_TOKEN:
+        authorized = request.headers.get("Authorization") == f"Bearer {chat.METRICS_TOKEN}"
+    else:
+        authorized = connection.remote_address[0] in ("127.0.0.1", "::1")
+    if not authorized:
+        return connection.respond(HTTPStatus.UNAUTHORIZED, "Unauthorized\n")
+    response = connection.respond(HTTPStatus.OK, chat.metrics.render())
+    del response.headers["Content-Type"]
+    response.headers["Content-Type"] = chat.CONTENT_TYPE
+    return response
+
+
+async def handle_socket(ws):
+    # Expect first message to be auth
+    try:
+        data = await asyncio.wait_for(ws.recv(), AUTH_TIMEOUT)
+        user_email, auth = await offload(authenticate_client, data)
+    except AuthFailed as e:
+        await ws.send(auth_error_frame(str(e)))
+        return
+    except (asyncio.TimeoutError, ConnectionClosed):
+        return
+
+    conn = ClientConnection(user_email, Session.negotiate(chat.sender_table, auth))
+    outbox = AsyncOutbox(ws, asyncio.get_running_loop(), maxsize=chat.OUTBOX_SIZE,
+                         overflow=chat.OUTBOX_OVERFLOW, send_timeout=chat.SEND_TIMEOUT,
+                         name=user_email, stats=chat.delivery_stats,
+                         prepare=None if conn.session.passthrough else conn.session.prepare,
+                         send_timer=chat.ws_send_seconds.observe)
+    try:
+        handshake, missed = await offload(conn.start, outbox, auth)
+        # Nothing else has been sent yet because the outbox is paused
+        await ws.send(handshake)
+        outbox.resume(missed)
+
+        async for data in ws:
+            await offload(conn.handle, data)
+    except ConnectionClosed:
+        pass
+    except Exception as e:
+        print(f"WebSocket error: {e}")
+        conn.fail(e)
+    finally:
+        outbox.close()
+        await offload(conn.close)
+
+
+async def serve_gateway(host, port):
+    async with serve(
+        handle_socket, host, port,
+        process_request=reject_other_paths,
+        max_size=MAX_MESSAGE_SIZE,
+        max_queue=MAX_QUEUE,
+        write_limit=WRITE_LIMIT,
+        compression=None if COMPRESSION == "none" else COMPRESSION,
+    ) as server:
+        print(f"Gateway listening on ws://{host}:{port}/ws")
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio WebSocket gateway for the chat /ws protocol")
+    parser.add_argument("--host", default=GATEWAY_HOST)
+    parser.add_argument("--port", type=int, default=GATEWAY_PORT)
+    parser.add_argument("--with-api", action="store_true", help="also serve the Flask REST API in this process")
+    args = parser.parse_args()
+
+    if args.with_api:
+        threading.Thread(target=chat.app.run, daemon=True, kwargs={
+            "host": os.getenv('HOST', '0.0.0.0'),
+            "port": int(os.getenv('PORT', 5000)),
+            "threaded": True,
+            "use_reloader": False
+        }).start()
+    asyncio.run(serve_gateway(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class GroupCache:
+    """Bounded LRU/TTL cache of group documents with a user -> group IDs index.
+
+    ``load_group(group_id)`` fetches one group document (or None);
+    ``load_user_groups(email)`` fetches every group a user belongs to. Entries
+    carry the document's ``version`` so invalidations that arrive from other
+    workers out of order never resurrect stale membership. A user's cached
+    group list also expires after ``ttl``, so a missed invalidation (a group
+    created or joined on another worker) is only stale for that long.
+    """
+
+    def __init__(self, load_group, load_user_groups, max_groups=10000, ttl=300):
+        self.load_group = load_group
+        self.load_user_groups = load_user_groups
+        self.max_groups = max_groups
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._groups = OrderedDict()  # {group_id: (group, members, expires_at)}
+        self._user_groups = {}        # {email: set(group_id)} for cached groups
+        self._indexed_users = {}      # {email: expires_at} for users whose full group list is cached
+        self._min_versions = {}       # Newest version seen in an invalidation
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, group_id):
+        with self._lock:
+            entry = self._groups.get(group_id)
+            if entry and entry[2] > time.monotonic():
+                self._groups.move_to_end(group_id)
+                self.stats["hits"] += 1
+                return entry[0]
+            if entry:
+                self._evict(group_id)
+            self.stats["misses"] += 1
+        group = self.load_group(group_id)
+        if group:
+            self.put(group)
+        return group
+
+    def get_for_member(self, group_id, email):
+        group = self.get(group_id)
+        if group and email in self.members(group_id):
+            return group
+        return None
+
+    def members(self, group_id):
+        with self._lock:
+            entry = self._groups.get(group_id)
+            return entry[1] if entry else frozenset()
+
+    def groups_of(self, email):
+        with self._lock:
+            if self._indexed_users.get(email, 0) > time.monotonic():
+                return set(self._user_groups.get(email, ()))
+        groups = list(self.load_user_groups(email))
+        for group in groups:
+            self.put(group)
+        with self._lock:
+            self._indexed_users[email] = time.monotonic() + self.ttl
+            return {str(group["_id"]) for group in groups}
+
+    def put(self, group):
+        group_id = str(group["_id"])
+        version = group.get("version", 0)
+        with self._lock:
+            if version < self._min_versions.get(group_id, 0):
+                return
+            if group_id in self._groups:
+                self._evict(group_id, count=False)
+            members = frozenset(group.get("members", ()))
+            self._groups[group_id] = (group, members, time.monotonic() + self.ttl)
+            for email in members:
+                self._user_groups.setdefault(email, set()).add(group_id)
+            while len(self._groups) > self.max_groups:
+                self._evict(next(iter(self._groups)))
+
+    def invalidate(self, group_id, version=None, members=()):
+        """Drop a group after a membership change. ``members`` lists users
+        whose group list changed, so their reverse-index entry is rebuilt."""
+        with self._lock:
+            self.stats["invalidations"] += 1
+            if version is not None:
+                self._min_versions[group_id] = max(version, self._min_versions.get(group_id, 0))
+            entry = self._groups.get(group_id)
+            if entry and (version is None or entry[0].get("version", 0) < version):
+                self._evict(group_id, count=False)
+            for email in members:
+                self._indexed_users.pop(email, None)
+
+    def _evict(self, group_id, count=True):
+        # Called with the lock held
+        group, members, _ = self._groups.pop(group_id)
+        for email in members:
+            ids = self._user_groups.get(email)
+            if ids is not None:
+                ids.discard(group_id)
+                if not ids:
+                    del self._user_groups[email]
+            # The user's cached group list is no longer complete
+            self._indexed_users.pop(email, None)
+        if count:
+            self.stats["evictions"] += 1
@@ -0,0 +1,76 @@
+import bcrypt
+
+from process_pool import BoundedProcessPool
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full; callers should answer 503."""
+
+
+# Module-level so they can be pickled into the worker processes
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _check_password(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+    except ValueError:
+        return False
+
+
+def hash_rounds(hashed):
+    """Cost factor of a bcrypt hash such as ``$2b$12$...``."""
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Runs bcrypt in a dedicated process pool so CPU-bound hashing never
+    competes with request and WebSocket threads.
+
+    At most ``max_pending`` hashes may be queued or running; beyond that
+    ``HashingBusy`` is raised immediately instead of queueing more work.
+    With ``workers=0`` hashing runs inline on the calling thread.
+    """
+
+    def __init__(self, rounds=12, workers=2, max_pending=8, timeout=30):
+        self.rounds = rounds
+        self.timeout = timeout
+        self._pool = BoundedProcessPool(workers, max_pending)
+        self.stats = {"hashed": 0, "checked": 0, "rejected": 0, "rehashed": 0}
+
+    def hash(self, password):
+        self.stats["hashed"] += 1
+        return self._call(_hash_password, password, self.rounds).result(self.timeout)
+
+    def check(self, hashed, password):
+        self.stats["checked"] += 1
+        return self._call(_check_password, hashed, password).result(self.timeout)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def rehash_later(self, password, on_done):
+        """Hash ``password`` at the configured cost in the background and pass
+        the result to ``on_done``; silently skipped when the pool is busy."""
+        try:
+            future = self._call(_hash_password, password, self.rounds)
+        except HashingBusy:
+            return
+
+        def done(f):
+            if f.exception() is None:
+                self.stats["rehashed"] += 1
+                on_done(f.result())
+
+        future.add_done_callback(done)
+
+    def _call(self, fn, *args):
+        future = self._pool.try_submit(fn, *args)
+        if future is None:
+            self.stats["rejected"] += 1
+            raise HashingBusy()
+        return future
@@ -0,0 +1,182 @@
+from collections import OrderedDict, deque
+import threading
+import time
+
+# Rough per-message overhead (dict, ObjectId, datetime, fixed fields) on top
+# of the content and addresses, for the byte budget
+MESSAGE_OVERHEAD = 400
+
+
+def message_size(message):
+    return MESSAGE_OVERHEAD + sum(len(value) for value in message.values() if isinstance(value, str))
+
+
+def contiguous(messages):
+    seqs = [message.get("seq") for message in messages]
+    if None in seqs:
+        return False
+    return not seqs or seqs == list(range(seqs[0], seqs[0] + len(seqs)))
+
+
+class _Buffer:
+    __slots__ = ("messages", "bytes", "has_older", "last_seq", "pending", "expires")
+
+    def __init__(self, capacity, ttl):
+        self.messages = deque(maxlen=capacity)  # Oldest -> newest by seq
+        self.bytes = 0
+        self.has_older = False
+        self.last_seq = 0
+        self.pending = None  # Appends that arrive while the buffer is being filled
+        self.expires = time.monotonic() + ttl
+
+
+class HotConversationCache:
+    """Newest ``capacity`` messages of recently active conversations.
+
+    A buffer is only kept when it is known to be exactly the tail of the
+    conversation: it is seeded from Mongo on a first-page miss (or created
+    by the first message of a new conversation) and then extended by every
+    write. Messages carry a per-conversation ``seq``, so a gap (a write this
+    worker never saw) drops the buffer instead of serving a stale page.
+    A lost write is only noticed when the next one arrives, so buffers are
+    also re-read from Mongo every ``ttl`` seconds, and ``clear`` drops them
+    all when writes may have been lost (the router reconnected or dropped
+    an event). Conversations are evicted least recently used once the
+    buffers together exceed ``max_bytes``.
+    """
+
+    def __init__(self, capacity=100, max_bytes=64 * 1024 * 1024, ttl=30.0):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._buffers = OrderedDict()  # {conversation: _Buffer}
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "fills": 0, "appends": 0, "resets": 0, "evictions": 0,
+                      "expired": 0, "clears": 0}
+
+    def page(self, conversation, limit):
+        """The newest ``limit`` messages as (messages, has_more), or None."""
+        with self._lock:
+            buffer = self._buffers.get(conversation)
+            if buffer is None or buffer.pending is not None or limit >= self.capacity:
+                self.stats["misses"] += 1
+                return None
+            if buffer.expires <= time.monotonic():
+                self._replace(conversation, None)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            if len(buffer.messages) <= limit and buffer.has_older:
+                self.stats["misses"] += 1
+                return None
+            self._buffers.move_to_end(conversation)
+            self.stats["hits"] += 1
+            messages = list(buffer.messages)[-limit:]
+            has_more = len(buffer.messages) > limit or buffer.has_older
+        # Same order as the Mongo query, (timestamp, _id)
+        messages.sort(key=lambda m: (m["timestamp"], m["_id"]))
+        return messages, has_more
+
+    def begin_fill(self, conversation):
+        """Mark a conversation as being seeded; writes meanwhile are kept aside."""
+        with self._lock:
+            if conversation not in self._buffers:
+                buffer = self._buffers[conversation] = _Buffer(self.capacity, self.ttl)
+                buffer.pending = []
+
+    def fill(self, conversation, messages, has_older):
+        """Install the newest messages (oldest first) read from Mongo."""
+        with self._lock:
+            old = self._buffers.get(conversation)
+            if old is None or old.pending is None:
+                return  # Someone else filled it first, or it was cleared meanwhile
+            if not contiguous(messages):
+                # A concurrent write isn't visible yet (or legacy messages
+                # without seq); serve this read from Mongo and try again later
+                self._replace(conversation, None)
+                return
+            buffer = _Buffer(self.capacity, self.ttl)
+            buffer.has_older = has_older
+            for message in messages:
+                self._push(buffer, message)
+            self._replace(conversation, buffer)
+            for message in sorted(old.pending, key=lambda m: m["seq"]):
+                self._append(conversation, buffer, message)
+            self.stats["fills"] += 1
+            self._evict()
+
+    def cancel_fill(self, conversation):
+        with self._lock:
+            buffer = self._buffers.get(conversation)
+            if buffer is not None and buffer.pending is not None:
+                self._replace(conversation, None)
+
+    def append(self, message):
+        conversation = message["conversation"]
+        with self._lock:
+            buffer = self._buffers.get(conversation)
+            if buffer is None:
+                if message["seq"] != 1:
+                    return  # Not cached; the first read will seed it
+                buffer = _Buffer(self.capacity, self.ttl)
+                self._replace(conversation, buffer)
+            elif buffer.pending is not None:
+                buffer.pending.append(message)
+                return
+            self._append(conversation, buffer, message)
+            self._evict()
+
+    def clear(self):
+        """Drop every buffer, including ones being filled; the next reads reseed them."""
+        with self._lock:
+            self._buffers.clear()
+            self._bytes = 0
+            self.stats["clears"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "conversations": len(self._buffers), "bytes": self._bytes}
+
+    # Called with the lock held from here on
+
+    def _append(self, conversation, buffer, message):
+        seq = message["seq"]
+        if seq <= buffer.last_seq:
+            return  # Already in the seeded page
+        if buffer.last_seq and seq != buffer.last_seq + 1:
+            self.stats["resets"] += 1
+            self._replace(conversation, None)
+            return
+        self._bytes += self._push(buffer, message)
+        self._buffers.move_to_end(conversation)
+        self.stats["appends"] += 1
+
+    def _push(self, buffer, message):
+        # Returns the change in the buffer's size
+        delta = message_size(message)
+        if len(buffer.messages) == buffer.messages.maxlen:
+            delta -= message_size(buffer.messages[0])
+            buffer.has_older = True
+        buffer.messages.append(message)
+        buffer.bytes += delta
+        buffer.last_seq = max(buffer.last_seq, message["seq"])
+        return delta
+
+    def _replace(self, conversation, buffer):
+        old = self._buffers.pop(conversation, None)
+        if old is not None:
+            self._bytes -= old.bytes
+        if buffer is not None:
+            self._buffers[conversation] = buffer
+            self._bytes += buffer.bytes
+
+    def _evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        # Buffers still being filled are empty and must keep collecting writes
+        for conversation in [c for c, b in self._buffers.items() if b.pending is None]:
+            if self._bytes <= self.max_bytes or len(self._buffers) <= 1:
+                break
+            self._replace(conversation, None)
+            self.stats["evictions"] += 1
@@ -0,0 +1,229 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it images get no variants
+    Image = None
+
+from process_pool import BoundedProcessPool
+
+COPY_BUFFER = 64 * 1024
+
+
+class UploadError(Exception):
+    """A chunk or upload the store refuses; ``status`` is the HTTP answer."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _make_variants(source, targets):
+    """Downscale an image into each of ``targets`` ({name: (path, max side)}).
+
+    Variants are only written when smaller than the original; returns the
+    original's size and {name: {"width", "height", "content_type"}}.
+    """
+    with Image.open(source) as image:
+        width, height = image.size
+        variants = {}
+        for name, (path, side) in targets.items():
+            if max(width, height) <= side:
+                continue
+            copy = image.copy()
+            copy.thumbnail((side, side))
+            if copy.mode in ("RGBA", "LA", "P"):
+                content_type, fmt = "image/png", "PNG"
+            else:
+                content_type, fmt = "image/jpeg", "JPEG"
+                copy = copy.convert("RGB")
+            tmp = f"{path}.tmp"
+            copy.save(tmp, fmt, optimize=True)
+            os.replace(tmp, path)
+            variants[name] = {"width": copy.width, "height": copy.height, "content_type": content_type}
+    return {"width": width, "height": height, "variants": variants}
+
+
+class MediaStore:
+    """Content-addressed media files on local disk.
+
+    Each distinct file is stored once as ``blobs/<aa>/<sha256>``, so the same
+    picture sent a hundred times takes the space of one. Uploads in progress
+    live in ``partial/<upload id>`` and are written at the offset the client
+    sends, which is what lets an interrupted upload resume; nothing is held
+    in memory beyond one copy buffer. Image variants (thumbnails, downscaled
+    previews) are rendered in a process pool next to the blob as
+    ``<sha256>.<variant>``.
+    """
+
+    def __init__(self, root, variants=None, workers=1, max_pending=16):
+        self.root = root
+        self.variants = variants or {}  # {name: max side in pixels}
+        self._pool = BoundedProcessPool(workers, max_pending)
+        self.stats = {"uploads": 0, "deduplicated": 0, "bytes_written": 0, "variants": 0, "variant_failures": 0}
+        for directory in ("blobs", "partial"):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    @property
+    def can_render(self):
+        return Image is not None and bool(self.variants)
+
+    def blob_path(self, digest, variant=None):
+        name = f"{digest}.{variant}" if variant else digest
+        return os.path.join(self.root, "blobs", digest[:2], name)
+
+    def partial_path(self, upload_id):
+        return os.path.join(self.root, "partial", upload_id)
+
+    def exists(self, digest, variant=None):
+        return os.path.isfile(self.blob_path(digest, variant))
+
+    # Resumable uploads
+
+    def create(self, upload_id):
+        open(self.partial_path(upload_id), "wb").close()
+
+    def write_chunk(self, upload_id, offset, stream, length, timeout=None):
+        """Copy ``length`` bytes from ``stream`` to the upload at ``offset``.
+
+        Returns the new offset. A client that disconnects mid-chunk (or is
+        still sending after ``timeout`` seconds) keeps what arrived, so it
+        resumes from the returned (or queried) offset. The caller must hold
+        the upload's write lease: nothing here stops two writers.
+        """
+        path = self.partial_path(upload_id)
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            f = open(path, "r+b")
+        except FileNotFoundError:
+            raise UploadError("Upload not found", 404)
+        with f:
+            if os.fstat(f.fileno()).st_size < offset:
+                raise UploadError("Offset past the end of the upload", 409)
+            f.seek(offset)
+            written = 0
+            try:
+                while written < length and (deadline is None or time.monotonic() < deadline):
+                    try:
+                        data = stream.read(min(COPY_BUFFER, length - written))
+                    except Exception:
+                        data = None  # Client went away mid-chunk
+                    if not data:
+                        break
+                    f.write(data)
+                    written += len(data)
+            finally:
+                f.truncate(offset + written)
+                self.stats["bytes_written"] += written
+        return offset + written
+
+    def finish(self, upload_id):
+        """Hash a complete upload and move it into place; returns (digest, size, deduplicated)."""
+        path = self.partial_path(upload_id)
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(COPY_BUFFER), b""):
+                digest.update(data)
+                size += len(data)
+        digest, deduplicated = self._store(path, digest.hexdigest())
+        return digest, size, deduplicated
+
+    def discard(self, upload_id):
+        try:
+            os.remove(self.partial_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def save_stream(self, stream, max_size):
+        """Store a whole file read from ``stream`` (e.g. a form upload) in one pass.
+
+        Returns (digest, size, deduplicated); raises UploadError past ``max_size``.
+        """
+        fd, path = tempfile.mkstemp(dir=os.path.join(self.root, "partial"))
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for data in iter(lambda: stream.read(COPY_BUFFER), b""):
+                    size += len(data)
+                    if size > max_size:
+                        raise UploadError("File too large", 413)
+                    digest.update(data)
+                    f.write(data)
+            self.stats["bytes_written"] += size
+            digest, deduplicated = self._store(path, digest.hexdigest())
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return digest, size, deduplicated
+
+    def sweep(self, max_age):
+        """Delete uploads untouched for ``max_age`` seconds."""
+        directory = os.path.join(self.root, "partial")
+        cutoff = time.time() - max_age
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def start_sweeper(self, max_age, interval=3600):
+        def run():
+            while True:
+                try:
+                    self.sweep(max_age)
+                except Exception as e:
+                    print(f"Failed to sweep uploads: {e}")
+                time.sleep(interval)
+        threading.Thread(target=run, name="upload-sweeper", daemon=True).start()
+
+    # Image variants
+
+    def render(self, digest, on_done):
+        """Render the configured variants of an image in the process pool.
+
+        ``on_done(info)`` gets the dimensions and variants, or None if the
+        file isn't an image Pillow can read. Returns False (and renders
+        nothing) when Pillow is missing or the pool is saturated.
+        """
+        if not self.can_render:
+            return False
+        targets = {name: (self.blob_path(digest, name), side) for name, side in self.variants.items()}
+        future = self._pool.try_submit(_make_variants, self.blob_path(digest), targets)
+        if future is None:
+            return False
+
+        def done(f):
+            if f.exception() is not None:
+                self.stats["variant_failures"] += 1
+                print(f"Failed to render variants of {digest}: {f.exception()}")
+                info = None
+            else:
+                info = f.result()
+                self.stats["variants"] += len(info["variants"])
+            on_done(info)
+
+        future.add_done_callback(done)
+        return True
+
+    def snapshot(self):
+        return dict(self.stats)
+
+    def _store(self, path, digest):
+        target = self.blob_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        self.stats["uploads"] += 1
+        if os.path.exists(target):
+            os.remove(path)
+            self.stats["deduplicated"] += 1
+            return digest, True
+        os.replace(path, target)
+        return digest, False
@@ -0,0 +1,316 @@
+from bisect import bisect_left
+from collections import Counter as Tally
+import os
+import sys
+import threading
+import time
+
+from pymongo import monitoring
+
+# Prometheus text exposition format, version 0.0.4
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; from sub-millisecond cache hits to a send stuck near WS_SEND_TIMEOUT
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Recipients of one delivery
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base of counters and gauges: values set by the code, or read from
+    ``collect()`` at scrape time.
+
+    ``collect`` returns a number, or {label values: number} for a labelled
+    metric, so counts that already live elsewhere (open sockets, the stats
+    dicts) cost nothing until someone scrapes.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._lock = threading.Lock()
+        self._values = {}  # {label values: value}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(label) for label in labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        if self.collect is None:
+            with self._lock:
+                items = list(self._values.items())
+        else:
+            try:
+                value = self.collect()
+            except Exception as e:
+                print(f"Failed to collect {self.name}: {e}")
+                return []
+            if not isinstance(value, dict):
+                value = {(): value}
+            items = [(key if isinstance(key, tuple) else (key,), v) for key, v in value.items()]
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [count per bucket (+Inf last), sum, count]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=(), collect=None):
+        return self._add(Counter(name, help, labelnames, collect))
+
+    def gauge(self, name, help, labelnames=(), collect=None):
+        return self._add(Gauge(name, help, labelnames, collect))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """pymongo command listener timing every command by collection and name.
+
+    The collection is only in the started event, so it is remembered per
+    (connection, request id) until the command finishes.
+    """
+
+    def __init__(self, durations, failures):
+        self.durations = durations
+        self.failures = failures
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def started(self, event):
+        command = event.command
+        if event.command_name == "getMore":
+            collection = command.get("collection")
+        else:
+            collection = command.get(event.command_name)
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def _finish(self, event):
+        with self._lock:
+            return self._pending.pop((event.connection_id, event.request_id), "")
+
+    def succeeded(self, event):
+        self.durations.observe(event.duration_micros / 1e6, self._finish(event), event.command_name)
+
+    def failed(self, event):
+        collection = self._finish(event)
+        self.durations.observe(event.duration_micros / 1e6, collection, event.command_name)
+        self.failures.inc(collection, event.command_name)
+
+
+class SamplingProfiler:
+    """Statistical profiler for marked sections of code (the /ws frame loop).
+
+    Threads enter a section with ``with profiler.section():``; a background
+    thread looks at their stacks ``hz`` times a second and counts each one
+    in folded form ("outer;inner;leaf"), the input of flamegraph.pl and
+    speedscope. Nothing is sampled while no thread is inside a section.
+    Distinct stacks are capped at ``max_stacks``; the rest count as
+    "(other)".
+    """
+
+    def __init__(self, hz=0, max_stacks=5000, depth=24):
+        self.hz = hz
+        self.max_stacks = max_stacks
+        self.depth = depth
+        self._lock = threading.Lock()
+        self._active = {}  # {thread id: nesting depth}
+        self._stacks = Tally()
+        self.samples = 0
+        if hz > 0:
+            threading.Thread(target=self._run, name="profiler", daemon=True).start()
+
+    @property
+    def enabled(self):
+        return self.hz > 0
+
+    def section(self):
+        return _Section(self) if self.enabled else _NO_SECTION
+
+    def folded(self):
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def _enter(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._active[ident] = self._active.get(ident, 0) + 1
+
+    def _exit(self):
+        ident = threading.get_ident()
+        with self._lock:
+            if self._active[ident] == 1:
+                del self._active[ident]
+            else:
+                self._active[ident] -= 1
+
+    def _run(self):
+        interval = 1 / self.hz
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                active = set(self._active)
+            if not active:
+                continue
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident in active:
+                    stacks.append(self._fold(frame))
+            with self._lock:
+                for stack in stacks:
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] += 1
+                    else:
+                        self._stacks["(other)"] += 1
+                self.samples += len(stacks)
+
+    def _fold(self, frame):
+        names = []
+        while frame is not None and len(names) < self.depth:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+
+class _Section:
+    __slots__ = ("profiler",)
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __enter__(self):
+        self.profiler._enter()
+
+    def __exit__(self, *exc):
+        self.profiler._exit()
+
+
+class _NoSection:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SECTION = _NoSection()
@@ -0,0 +1,208 @@
+from datetime import datetime
+import threading
+import time
+
+
+class PresenceRegistry:
+    """In-memory online state and last_seen for every user this worker knows about.
+
+    ``load_peers(email)`` returns the users who share a conversation or group
+    with ``email``; only they are told about status changes. ``announce(email,
+    status, peers)`` sends the status frame. ``write_batch({email: fields})``
+    persists dirty status/last_seen values in one round trip.
+
+    Users on other workers are tracked per worker. A worker that hasn't been
+    heard from for ``worker_timeout`` seconds (heartbeats count) is presumed
+    dead and its users go offline here.
+    """
+
+    def __init__(self, load_peers, announce, write_batch, debounce=2.0, flush_interval=5.0, tick=0.25,
+                 worker_timeout=None):
+        self.load_peers = load_peers
+        self.announce = announce
+        self.write_batch = write_batch
+        self.debounce = debounce
+        self.flush_interval = flush_interval
+        self.worker_timeout = worker_timeout
+        self._lock = threading.RLock()
+        self._local = {}    # {email: number of sockets on this worker}
+        self._remote = {}   # {email: set(worker_id)} for sockets on other workers
+        self._workers = {}  # {worker_id: when it was last heard from}
+        self._last_seen = {}
+        self._peers = {}    # Peer sets cached for users that are online
+        self._pending = {}  # {email: (status before the flap window, deadline)}
+        self._dirty = {}
+        self._last_flush = time.monotonic()
+        self.stats = {"announced": 0, "coalesced": 0, "flushes": 0, "flushed_users": 0}
+        self._thread = threading.Thread(target=self._run, args=(tick,), name="presence", daemon=True)
+        self._thread.start()
+
+    def status(self, email):
+        with self._lock:
+            return "online" if self._local.get(email) or self._remote.get(email) else "offline"
+
+    def is_online(self, email):
+        return self.status(email) == "online"
+
+    def last_seen(self, email):
+        return self._last_seen.get(email)
+
+    def connect(self, email):
+        with self._lock:
+            before = self.status(email)
+            self._local[email] = self._local.get(email, 0) + 1
+            self._changed(email, before)
+
+    def disconnect(self, email):
+        with self._lock:
+            before = self.status(email)
+            count = self._local.get(email, 0) - 1
+            if count > 0:
+                self._local[email] = count
+            else:
+                self._local.pop(email, None)
+            self._changed(email, before)
+
+    def set_remote(self, email, worker, online):
+        # Other workers announce their own users, so no broadcast from here
+        with self._lock:
+            self._workers[worker] = time.monotonic()
+            workers = self._remote.setdefault(email, set())
+            if online:
+                workers.add(worker)
+            else:
+                workers.discard(worker)
+                if not workers:
+                    del self._remote[email]
+
+    def set_remote_users(self, worker, emails):
+        """Replace everything known about ``worker`` with its own snapshot."""
+        with self._lock:
+            self._forget(worker)
+            self._workers[worker] = time.monotonic()
+            for email in emails:
+                self._remote.setdefault(email, set()).add(worker)
+
+    def worker_alive(self, worker):
+        with self._lock:
+            self._workers[worker] = time.monotonic()
+
+    def drop_worker(self, worker):
+        """Forget a worker that is gone; its users are offline unless seen elsewhere."""
+        with self._lock:
+            offline = self._forget(worker)
+            self._workers.pop(worker, None)
+            now = datetime.utcnow()
+            for email in offline:
+                if not self._local.get(email):
+                    self._dirty[email] = {"status": "offline", "last_seen": now}
+        return offline
+
+    def expire_workers(self):
+        if not self.worker_timeout:
+            return
+        cutoff = time.monotonic() - self.worker_timeout
+        with self._lock:
+            stale = [worker for worker, seen in self._workers.items() if seen < cutoff]
+        for worker in stale:
+            print(f"Presence: no heartbeat from worker {worker}, dropping its users")
+            self.drop_worker(worker)
+
+    def local_users(self):
+        with self._lock:
+            return list(self._local)
+
+    def touch(self, email):
+        with self._lock:
+            now = datetime.utcnow()
+            self._last_seen[email] = now
+            self._dirty.setdefault(email, {})["last_seen"] = now
+
+    def add_peers(self, email, peers):
+        # Keep cached peer sets current when a new conversation or group appears
+        with self._lock:
+            cached = self._peers.get(email)
+            if cached is not None:
+                cached.update(p for p in peers if p != email)
+
+    def peers(self, email):
+        with self._lock:
+            cached = self._peers.get(email)
+        if cached is None:
+            cached = set(self.load_peers(email))
+            cached.discard(email)
+            with self._lock:
+                self._peers[email] = cached
+        return cached
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._last_flush = time.monotonic()
+        if not dirty:
+            return
+        try:
+            self.write_batch(dirty)
+            self.stats["flushes"] += 1
+            self.stats["flushed_users"] += len(dirty)
+        except Exception as e:
+            print(f"Presence flush failed: {e}")
+            with self._lock:
+                for email, fields in dirty.items():
+                    # Values recorded since the failed flush are newer and win
+                    self._dirty[email] = {**fields, **self._dirty.get(email, {})}
+
+    def _forget(self, worker):
+        # Called with the lock held; returns the users no worker has any more
+        offline = []
+        for email, workers in list(self._remote.items()):
+            if worker in workers:
+                workers.discard(worker)
+                if not workers:
+                    del self._remote[email]
+                    offline.append(email)
+        return offline
+
+    def _changed(self, email, before):
+        # Called with the lock held after a local connect/disconnect
+        after = self.status(email)
+        now = datetime.utcnow()
+        self._last_seen[email] = now
+        self._dirty[email] = {"status": after, "last_seen": now}
+        if after == before:
+            return
+        if email in self._pending:
+            self.stats["coalesced"] += 1
+        else:
+            self._pending[email] = (before, time.monotonic() + self.debounce)
+
+    def _due_announcements(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for email, (before, deadline) in list(self._pending.items()):
+                if deadline > now:
+                    continue
+                del self._pending[email]
+                status = self.status(email)
+                if status != before:
+                    due.append((email, status))
+                else:
+                    self.stats["coalesced"] += 1
+        return due
+
+    def _run(self, tick):
+        while True:
+            time.sleep(tick)
+            for email, status in self._due_announcements():
+                try:
+                    self.announce(email, status, self.peers(email))
+                    self.stats["announced"] += 1
+                except Exception as e:
+                    print(f"Failed to announce presence for {email}: {e}")
+                if status == "offline":
+                    with self._lock:
+                        self._peers.pop(email, None)
+            self.expire_workers()
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
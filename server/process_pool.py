@@ -0,0 +1,44 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+import threading
+
+
+class BoundedProcessPool:
+    """A process pool for CPU-bound work that refuses to queue without bound.
+
+    At most ``max_pending`` calls may be queued or running; ``try_submit``
+    returns None beyond that, so callers can shed load instead of letting
+    requests pile up behind the pool. The pool is started on first use, after
+    any pre-fork. Functions and arguments must be picklable (module-level
+    functions). With ``workers=0`` calls run inline on the calling thread.
+    """
+
+    def __init__(self, workers=1, max_pending=8):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def try_submit(self, fn, *args):
+        """A future for ``fn(*args)``, or None when the pool is saturated."""
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            if not self.workers:
+                future = Future()
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future = self._get_pool().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+class ReceiptBatcher:
+    """Coalesces read receipts into at most one frame per conversation per window.
+
+    ``add`` records that ``reader`` has read ``conversation`` up to ``seq``;
+    repeated marks inside the window collapse to the highest seq. Every
+    ``interval`` seconds ``emit(conversation, {reader: seq}, recipients)`` is
+    called once for each conversation with pending receipts.
+    """
+
+    def __init__(self, emit, interval=0.25):
+        self.emit = emit
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}  # {conversation: ({reader: seq}, recipients)}
+        self.stats = {"marks": 0, "frames": 0}
+        threading.Thread(target=self._run, name="read-receipts", daemon=True).start()
+
+    def add(self, conversation, reader, seq, recipients):
+        with self._lock:
+            self.stats["marks"] += 1
+            readers, _ = self._pending.get(conversation, ({}, None))
+            readers[reader] = max(seq, readers.get(reader, 0))
+            self._pending[conversation] = (readers, recipients)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for conversation, (readers, recipients) in pending.items():
+                try:
+                    self.emit(conversation, readers, recipients)
+                    self.stats["frames"] += 1
+                except Exception as e:
+                    print(f"Failed to send read receipts for {conversation}: {e}")
@@ -0,0 +1,291 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+# Routing events are plain dicts that travel between workers:
+#   {"type": "deliver", "users": [...], "exclude": email, "frame": str, "kind": str}
+#   {"type": "deliver_group", "group_id": id, "exclude": email, "exclude_connection": id,
+#    "frame": str, "kind": str}  -- to the connections subscribed to the group
+#   {"type": "presence", "user": email, "online": bool, "worker": id}
+#   {"type": "heartbeat", "worker": id}  -- every few seconds from each worker
+#   {"type": "worker_gone", "worker": id}  -- from the broker when a worker disconnects
+# Every worker receives every event and delivers only to the sockets it owns.
+
+
+class Router:
+    def __init__(self):
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._handler = None
+        self._on_connect = None
+        self._on_drop = None
+        self.stats = {"published": 0, "dropped": 0, "reconnects": 0}
+
+    def start(self, handler, on_connect=None, on_drop=None):
+        """``on_connect()`` runs after every (re)connection to the other
+        workers, to re-announce state they may have missed; ``on_drop(event)``
+        runs when an event is dropped instead of published."""
+        self._handler = handler
+        self._on_connect = on_connect
+        self._on_drop = on_drop
+
+    def publish(self, event):
+        raise NotImplementedError
+
+    def snapshot(self):
+        return dict(self.stats)
+
+    def close(self):
+        pass
+
+    def _dispatch(self, event):
+        if self._handler:
+            try:
+                self._handler(event)
+            except Exception as e:
+                print(f"Routing handler error: {e}")
+
+
+class LocalRouter(Router):
+    """Single-process routing: publishing dispatches straight to this worker."""
+
+    def publish(self, event):
+        self.stats["published"] += 1
+        self._dispatch(event)
+
+
+class BrokerRouter(Router):
+    """Routes events through a local broker over a Unix socket.
+
+    Frames are newline-delimited JSON. The broker echoes every event to every
+    connected worker (including the publisher), so delivery goes through the
+    same path whether the recipient is local or not.
+
+    ``publish`` only queues the event: a sender thread writes the queue to the
+    broker, so a request (or the reader thread, answering an event) never
+    waits on the socket. While the broker is unreachable up to ``max_pending``
+    events are kept; beyond that new events are dropped and counted. The
+    sender also publishes a heartbeat every ``heartbeat`` seconds so the other
+    workers can tell this one is alive.
+    """
+
+    def __init__(self, path, reconnect_delay=0.5, heartbeat=5.0, max_pending=10000):
+        super().__init__()
+        self.path = path
+        self.reconnect_delay = reconnect_delay
+        self.heartbeat = heartbeat
+        self._sock = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._connected = threading.Event()
+        self._closed = False
+
+    def start(self, handler, on_connect=None, on_drop=None):
+        super().start(handler, on_connect, on_drop)
+        threading.Thread(target=self._run, name="router-reader", daemon=True).start()
+        threading.Thread(target=self._send_loop, name="router-sender", daemon=True).start()
+        self._connected.wait(timeout=5)
+
+    def publish(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            if self._on_drop:
+                self._on_drop(event)
+            return
+        self.stats["published"] += 1
+
+    def snapshot(self):
+        return {**self.stats, "pending": self._queue.qsize(), "connected": self._connected.is_set()}
+
+    def close(self):
+        self._closed = True
+        if self._sock:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+
+    def _run(self):
+        while not self._closed:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+                # Tells the broker whose connection this is, so it can
+                # announce worker_gone when it drops
+                sock.sendall(self._encode({"type": "hello", "worker": self.worker_id}))
+            except OSError as e:
+                print(f"Router cannot reach broker at {self.path}: {e}")
+                time.sleep(self.reconnect_delay)
+                continue
+            self._sock = sock
+            self._connected.set()
+            self.stats["reconnects"] += 1
+            if self._on_connect:
+                try:
+                    self._on_connect()
+                except Exception as e:
+                    print(f"Router on_connect error: {e}")
+            try:
+                for line in sock.makefile("rb"):
+                    self._dispatch(json.loads(line))
+            except (OSError, ValueError) as e:
+                print(f"Router connection lost: {e}")
+            finally:
+                self._connected.clear()
+                sock.close()
+            time.sleep(self.reconnect_delay)
+
+    def _send_loop(self):
+        pending = b""  # Written after a reconnect if the socket failed mid-batch
+        next_heartbeat = time.monotonic()
+        while not self._closed:
+            if not pending:
+                timeout = max(0.0, next_heartbeat - time.monotonic())
+                try:
+                    events = [self._queue.get(timeout=timeout)]
+                except queue.Empty:
+                    events = []
+                # Send everything that is already waiting in one write
+                while len(events) < 1000:
+                    try:
+                        events.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if time.monotonic() >= next_heartbeat:
+                    events.append({"type": "heartbeat", "worker": self.worker_id})
+                    next_heartbeat = time.monotonic() + self.heartbeat
+                pending = b"".join(self._encode(event) for event in events)
+            if not self._connected.wait(timeout=self.heartbeat):
+                continue
+            try:
+                self._sock.sendall(pending)
+                pending = b""
+            except OSError as e:
+                print(f"Router publish failed: {e}")
+                time.sleep(self.reconnect_delay)
+
+    @staticmethod
+    def _encode(event):
+        return (json.dumps(event) + "\n").encode("utf-8")
+
+
+class _BrokerClient:
+    """One worker's connection to the broker, with its own writer thread so a
+    slow worker neither corrupts nor holds up writes to the others."""
+
+    def __init__(self, conn, max_pending):
+        self.conn = conn
+        self.worker = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def send(self, line):
+        try:
+            self._queue.put_nowait(line)
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        self._queue.put(None)
+
+    def _write(self):
+        while True:
+            line = self._queue.get()
+            if line is None:
+                break
+            lines = [line]
+            while len(lines) < 1000:
+                try:
+                    line = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if line is None:
+                    self._queue.put(None)
+                    break
+                lines.append(line)
+            try:
+                self.conn.sendall(b"".join(lines))
+            except OSError:
+                # The reader sees the closed socket and cleans up
+                self.conn.close()
+                break
+
+
+def serve_broker(path, max_pending=100000):
+    """Run a minimal fan-out broker on a Unix socket until interrupted.
+
+    A worker that falls ``max_pending`` lines behind is disconnected; it
+    reconnects and re-announces its state.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    clients = set()
+    lock = threading.Lock()
+
+    def fan_out(line):
+        with lock:
+            targets = list(clients)
+        for target in targets:
+            if not target.send(line):
+                print(f"Broker dropping worker {target.worker}: too far behind")
+                try:
+                    target.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def handle(conn):
+        client = _BrokerClient(conn, max_pending)
+        with lock:
+            clients.add(client)
+        first = True
+        try:
+            for line in conn.makefile("rb"):
+                if first:
+                    first = False
+                    event = json.loads(line)
+                    if event.get("type") == "hello":
+                        client.worker = event.get("worker")
+                        continue
+                fan_out(line)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with lock:
+                clients.discard(client)
+            client.close()
+            conn.close()
+            if client.worker:
+                fan_out((json.dumps({"type": "worker_gone", "worker": client.worker}) + "\n").encode("utf-8"))
+
+    print(f"Broker listening on {path}")
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def create_router(url, **options):
+    """Build a router from a URL: ``local`` or ``unix:///path/to/broker.sock``.
+
+    ``options`` are passed to BrokerRouter.
+    """
+    if not url or url == "local":
+        return LocalRouter()
+    if url.startswith("unix://"):
+        return BrokerRouter(url[len("unix://"):], **options)
+    raise ValueError(f"Unsupported router URL: {url}")
+
+
+if __name__ == "__main__":
+    serve_broker(os.getenv("ROUTER_SOCKET", "/tmp/chat-router.sock"))
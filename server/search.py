@@ -0,0 +1,248 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+import math
+import re
+import threading
+import unicodedata
+import uuid
+
+from pymongo import UpdateOne
+
+WORD = re.compile(r"\w+")
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 40
+MAX_TERMS_PER_MESSAGE = 200  # Bounds the postings written for one long message
+# Messages stored before seqs existed are bucketed by day instead, below every
+# seq bucket and in time order: LEGACY_BUCKET_BASE + days since the epoch
+LEGACY_BUCKET_BASE = -10_000_000
+EPOCH = datetime(1970, 1, 1)
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i if in is it its me my no not of on or our "
+    "she so that the their them they this to was we were what when which who will with you your".split()
+)
+
+
+def normalize(word):
+    """Casefold and strip accents, so "Café" and "cafe" are the same term."""
+    decomposed = unicodedata.normalize("NFKD", word.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """Terms of ``text`` with their spans, as [(term, start, end)]."""
+    tokens = []
+    for match in WORD.finditer(text or ""):
+        term = normalize(match.group())
+        if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH and term not in STOPWORDS:
+            tokens.append((term, match.start(), match.end()))
+    return tokens
+
+
+def terms(text):
+    seen = {}
+    for term, _, _ in tokenize(text):
+        seen.setdefault(term, None)
+    return list(seen)[:MAX_TERMS_PER_MESSAGE]
+
+
+def snippet(text, query_terms, width=120):
+    """A window of ``text`` around the first match and the matched spans in it.
+
+    Returns (snippet, [[start, end], ...]); offsets are into the snippet, so
+    the client can highlight without parsing markup out of message text.
+    """
+    text = text or ""
+    matches = [(start, end) for term, start, end in tokenize(text) if term in query_terms]
+    if not matches:
+        return text[:width], []
+    start = max(0, matches[0][0] - width // 3)
+    if start:
+        # Don't cut a word in half
+        space = text.rfind(" ", 0, start)
+        start = space + 1 if space >= 0 and matches[0][0] - space <= width // 2 else start
+    end = min(len(text), start + width)
+    prefix = "…" if start else ""
+    suffix = "…" if end < len(text) else ""
+    highlights = [[s - start + len(prefix), e - start + len(prefix)] for s, e in matches if s >= start and e <= end]
+    return prefix + text[start:end] + suffix, highlights
+
+
+def message_conversation(message):
+    if message.get("conversation"):
+        return message["conversation"]
+    if message.get("group_id"):
+        return message["group_id"]
+    return "|".join(sorted((message.get("sender", ""), message.get("receiver", ""))))
+
+
+class SearchIndex:
+    """Inverted index of message text, kept in Mongo next to the messages.
+
+    A posting document holds the ids of the messages in one conversation
+    that contain one term, ``bucket_size`` consecutive seqs (or, for legacy
+    messages without a seq, one day) per document:
+    {term, conversation, bucket, ids, newest}, where ``newest`` is the
+    largest (latest) id in the posting. Scoping a query to the caller's
+    conversations is then part of the index lookup, so its cost follows the
+    size of the caller's chats, not of the whole collection. New messages
+    are indexed through ``writer`` (a WritePipeline), off the send path.
+
+    Results are ranked by the summed rarity (idf) of the query terms a
+    message contains, newest first among equals.
+    """
+
+    def __init__(self, postings, messages, state, writer, bucket_size=500, max_candidates=20000):
+        self.postings = postings
+        self.messages = messages
+        self.state = state
+        self.writer = writer
+        self.bucket_size = bucket_size
+        self.max_candidates = max_candidates
+        self.stats = {"indexed": 0, "postings": 0, "queries": 0, "backfilled": 0}
+
+    def ensure_indexes(self):
+        self.postings.create_index([("term", 1), ("conversation", 1), ("bucket", -1)], unique=True)
+        self.postings.create_index([("term", 1), ("conversation", 1), ("newest", -1)])
+
+    def bucket(self, message):
+        seq = message.get("seq")
+        if isinstance(seq, int):
+            return seq // self.bucket_size
+        timestamp = message.get("timestamp")
+        if not isinstance(timestamp, datetime):
+            timestamp = message["_id"].generation_time.replace(tzinfo=None)
+        return LEGACY_BUCKET_BASE + (timestamp - EPOCH).days
+
+    def updates(self, message):
+        """Posting upserts for a stored message (with its ObjectId ``_id``), as (filter, update)."""
+        bucket = self.bucket(message)
+        conversation = message_conversation(message)
+        return [
+            ({"term": term, "conversation": conversation, "bucket": bucket},
+             {"$addToSet": {"ids": message["_id"]}, "$max": {"newest": message["_id"]}})
+            for term in terms(message.get("content"))
+        ]
+
+    def add(self, message):
+        updates = self.updates(message)
+        for filter, update in updates:
+            self.writer.update(filter, update, upsert=True)
+        self.stats["indexed"] += 1
+        self.stats["postings"] += len(updates)
+
+    def search(self, conversations, query, limit=20, offset=0):
+        """Rank messages in ``conversations`` matching ``query``.
+
+        Returns (results, has_more) with results as
+        [{"message", "score", "snippet", "highlights"}], or ([], False) for a
+        query without searchable terms.
+        """
+        self.stats["queries"] += 1
+        query_terms = terms(query)[:10]
+        if not query_terms or not conversations:
+            return [], False
+        conversations = list(conversations)
+
+        # Postings of every term within the caller's conversations, the one
+        # holding the newest message first, across all conversations. Very
+        # common terms stop at max_candidates ids; every match newer than
+        # the last posting read has been seen by then
+        matches = defaultdict(set)  # {message id: matched terms}
+        frequency = {}
+        for term in query_terms:
+            found = 0
+            cursor = self.postings.find(
+                {"term": term, "conversation": {"$in": conversations}},
+                {"ids": 1, "_id": 0}
+            ).sort("newest", -1)
+            for posting in cursor:
+                for message_id in posting["ids"]:
+                    matches[message_id].add(term)
+                found += len(posting["ids"])
+                if found >= self.max_candidates:
+                    break
+            frequency[term] = found
+        if not matches:
+            return [], False
+
+        total = max(len(matches), sum(frequency.values()))
+        idf = {term: math.log(1 + total / (1 + count)) for term, count in frequency.items()}
+        ranked = sorted(
+            matches.items(),
+            key=lambda item: (sum(idf[t] for t in item[1]), item[0]),
+            reverse=True
+        )
+        page = ranked[offset:offset + limit]
+        has_more = len(ranked) > offset + limit
+
+        stored = {m["_id"]: m for m in self.messages.find({"_id": {"$in": [message_id for message_id, _ in page]}})}
+        results = []
+        for message_id, matched in page:
+            message = stored.get(message_id)
+            if message is None:
+                continue
+            text, highlights = snippet(message.get("content"), set(query_terms))
+            results.append({
+                "message": message,
+                "score": round(sum(idf[t] for t in matched), 4),
+                "snippet": text,
+                "highlights": highlights
+            })
+        return results, has_more
+
+    def snapshot(self):
+        return dict(self.stats)
+
+    # Indexing messages written before the index existed
+
+    def backfill(self, batch_size=500, lease=60):
+        """Index every stored message, resumably; returns how many were indexed.
+
+        Progress lives in ``state`` so a restart continues where it stopped,
+        and a lease keeps several workers from scanning at the same time.
+        """
+        owner = uuid.uuid4().hex
+        if not self._claim(owner, lease):
+            return 0
+        done = 0
+        while True:
+            state = self.state.find_one({"_id": "backfill"})
+            if state.get("done"):
+                return done
+            query = {"_id": {"$gt": state["last_id"]}} if state.get("last_id") else {}
+            batch = list(self.messages.find(query, {"content": 1, "conversation": 1, "group_id": 1,
+                                                    "sender": 1, "receiver": 1, "seq": 1, "timestamp": 1})
+                         .sort("_id", 1).limit(batch_size))
+            updates = [UpdateOne(filter, update, upsert=True)
+                       for message in batch for filter, update in self.updates(message)]
+            if updates:
+                self.postings.bulk_write(updates, ordered=False)
+            fields = {"lease_until": datetime.utcnow() + timedelta(seconds=lease)}
+            if batch:
+                fields["last_id"] = batch[-1]["_id"]
+            else:
+                fields["done"] = True
+            if not self.state.update_one({"_id": "backfill", "owner": owner}, {"$set": fields}).matched_count:
+                return done  # Lost the lease
+            done += len(batch)
+            self.stats["backfilled"] += len(batch)
+
+    def start_backfill(self, batch_size=500):
+        def run():
+            try:
+                count = self.backfill(batch_size)
+                if count:
+                    print(f"Search index backfilled {count} messages")
+            except Exception as e:
+                print(f"Search backfill failed: {e}")
+        threading.Thread(target=run, name="search-backfill", daemon=True).start()
+
+    def _claim(self, owner, lease):
+        now = datetime.utcnow()
+        self.state.update_one({"_id": "backfill"}, {"$setOnInsert": {"done": False}}, upsert=True)
+        claimed = self.state.find_one_and_update(
+            {"_id": "backfill", "done": False,
+             "$or": [{"lease_until": {"$exists": False}}, {"lease_until": {"$lt": now}}]},
+            {"$set": {"owner": owner, "lease_until": now + timedelta(seconds=lease)}}
+        )
+        return claimed is not None
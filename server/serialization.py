@@ -0,0 +1,49 @@
+from datetime import date, datetime
+import json
+
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+
+# ObjectId and datetime are encoded the same way the routes always formatted
+# them by hand: str(_id) and naive isoformat() timestamps. Binary fields on
+# user documents are sent as UTF-8 text, or hex when they are not valid UTF-8
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        try:
+            return obj.decode("utf-8")
+        except UnicodeDecodeError:
+            return obj.hex()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def dumps_bytes(obj):
+        return orjson.dumps(obj, default=_default)
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default).decode("utf-8")
+
+    loads = orjson.loads
+else:
+    _encoder = json.JSONEncoder(default=_default, separators=(", ", ": "))
+
+    def dumps(obj):
+        return _encoder.encode(obj)
+
+    def dumps_bytes(obj):
+        return _encoder.encode(obj).encode("utf-8")
+
+    loads = json.loads
+
+
+def backend():
+    return "orjson" if orjson is not None else "json"
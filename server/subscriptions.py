@@ -0,0 +1,70 @@
+import threading
+
+
+class SubscriptionIndex:
+    """Live map of group id -> connections on this worker subscribed to it.
+
+    Connections subscribe with ``join_group`` and drop out on ``leave_group``,
+    on disconnect and when they stop being members, so delivering to a group
+    costs the number of subscribed sockets, not the size of the group.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = {}  # {group_id: set(connection)}
+        self._joined = {}  # {connection: set(group_id)}
+        self.stats = {"joins": 0, "leaves": 0, "deliveries": 0, "delivered": 0}
+
+    def subscribe(self, group_id, conn):
+        with self._lock:
+            self._groups.setdefault(group_id, set()).add(conn)
+            self._joined.setdefault(conn, set()).add(group_id)
+            self.stats["joins"] += 1
+
+    def unsubscribe(self, group_id, conn):
+        with self._lock:
+            return self._remove(group_id, conn)
+
+    def drop(self, conn):
+        """Remove a connection from every group; returns the groups it left."""
+        with self._lock:
+            groups = self._joined.pop(conn, set())
+            for group_id in groups:
+                self._remove(group_id, conn, forget=False)
+            return groups
+
+    def is_subscribed(self, group_id, conn):
+        with self._lock:
+            return group_id in self._joined.get(conn, ())
+
+    def subscribers(self, group_id):
+        with self._lock:
+            conns = list(self._groups.get(group_id, ()))
+            self.stats["deliveries"] += 1
+            self.stats["delivered"] += len(conns)
+            return conns
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                **self.stats,
+                "groups": len(self._groups),
+                "subscriptions": sum(len(conns) for conns in self._groups.values())
+            }
+
+    def _remove(self, group_id, conn, forget=True):
+        # Called with the lock held
+        conns = self._groups.get(group_id)
+        if not conns or conn not in conns:
+            return False
+        conns.discard(conn)
+        if not conns:
+            del self._groups[group_id]
+        if forget:
+            joined = self._joined.get(conn)
+            if joined:
+                joined.discard(group_id)
+                if not joined:
+                    del self._joined[conn]
+        self.stats["leaves"] += 1
+        return True
@@ -0,0 +1,154 @@
+import threading
+import time
+
+
+def parse_limits(spec):
+    """Parse "typing=5/10,ping=0.2/3" into {frame type: (rate per second, burst)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        frame_type, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        rate = float(rate)
+        limits[frame_type.strip()] = (rate, float(burst) if burst else max(rate, 1.0))
+    return limits
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def allow(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter:
+    """Per-connection token buckets, one per limited frame type.
+
+    Buckets are created lazily, so an idle connection costs nothing. Frame
+    types without a configured limit are always allowed.
+    """
+
+    def __init__(self, limits, stats=None):
+        self.limits = limits
+        self.stats = stats if stats is not None else ThrottleStats()
+        self._buckets = {}
+
+    def allow(self, frame_type):
+        limit = self.limits.get(frame_type)
+        if limit is None:
+            return True
+        bucket = self._buckets.get(frame_type)
+        if bucket is None:
+            bucket = self._buckets[frame_type] = TokenBucket(*limit)
+        if bucket.allow():
+            return True
+        self.stats.incr("throttled", frame_type)
+        return False
+
+
+class TypingCoalescer:
+    """Turns keystroke-level typing frames into state transitions.
+
+    ``update(sender, target, is_typing)`` records what the client says; only
+    changes of state are forwarded, at most one per ``window`` seconds for
+    each (sender, target), always ending on the latest state. A "typing"
+    state that isn't refreshed within ``expiry`` seconds is ended with an
+    ``emit(sender, target, False)``, so a client that vanishes mid-word
+    doesn't leave the indicator on.
+    """
+
+    def __init__(self, emit, window=1.0, expiry=6.0, tick=0.25, stats=None):
+        self.emit = emit
+        self.window = window
+        self.expiry = expiry
+        self.stats = stats if stats is not None else ThrottleStats()
+        self._lock = threading.Lock()
+        self._states = {}  # {(sender, target): [sent, wanted, last emit, last update]}
+        self._thread = threading.Thread(target=self._run, args=(tick,), name="typing", daemon=True)
+        self._thread.start()
+
+    def update(self, sender, target, is_typing):
+        is_typing = bool(is_typing)
+        now = time.monotonic()
+        with self._lock:
+            self.stats.incr("typing", "received")
+            state = self._states.get((sender, target))
+            if state is None:
+                if not is_typing:
+                    self.stats.incr("typing", "coalesced")
+                    return
+                state = self._states[(sender, target)] = [False, True, 0.0, now]
+            state[1] = is_typing
+            state[3] = now
+            if state[0] == is_typing or now - state[2] < self.window:
+                # Same state as the client last saw, or too soon; the ticker
+                # sends the final state once the window is over
+                self.stats.incr("typing", "coalesced")
+                return
+            due = self._take(sender, target, state, now)
+        self._send(due)
+
+    def drop(self, sender):
+        """End every typing state of a sender (e.g. on disconnect)."""
+        with self._lock:
+            keys = [key for key in self._states if key[0] == sender]
+            due = [(key[0], key[1], False) for key in keys if self._states.pop(key)[0]]
+        self._send(due)
+
+    def _take(self, sender, target, state, now):
+        # Called with the lock held
+        state[0] = state[1]
+        state[2] = now
+        if not state[0]:
+            del self._states[(sender, target)]
+        return [(sender, target, state[0])]
+
+    def _send(self, due):
+        for sender, target, is_typing in due:
+            try:
+                self.emit(sender, target, is_typing)
+                self.stats.incr("typing", "emitted")
+            except Exception as e:
+                print(f"Failed to send typing state for {sender}: {e}")
+
+    def _run(self, tick):
+        while True:
+            time.sleep(tick)
+            now = time.monotonic()
+            due = []
+            with self._lock:
+                for (sender, target), state in list(self._states.items()):
+                    if state[1] and now - state[3] > self.expiry:
+                        state[1] = False
+                        self.stats.incr("typing", "expired")
+                    if state[0] != state[1]:
+                        if now - state[2] >= self.window:
+                            due.extend(self._take(sender, target, state, now))
+                    elif not state[0]:
+                        # Started and stopped inside one window; nothing to send
+                        del self._states[(sender, target)]
+            self._send(due)
+
+
+class ThrottleStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"throttled": {}, "typing": {"received": 0, "emitted": 0, "coalesced": 0, "expired": 0}}
+
+    def incr(self, group, key, amount=1):
+        with self._lock:
+            counters = self.counters[group]
+            counters[key] = counters.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {group: dict(counters) for group, counters in self.counters.items()}
@@ -0,0 +1,386 @@
+import struct
+import threading
+import zlib
+
+from serialization import _default, dumps, loads
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional speedup
+    msgpack = None
+
+# Wire encodings a client can ask for in its auth frame. JSON text is the
+# default; "compact" is MessagePack with short integer field codes and
+# sender emails replaced by ids from a per-connection dictionary.
+JSON = "json"
+COMPACT = "compact"
+ENCODINGS = (JSON, COMPACT)
+
+# Optional compression, also negotiated in the auth frame. Browsers already
+# get permessage-deflate from the WebSocket upgrade; this is the same
+# algorithm (raw deflate, shared context, RFC 7692 framing) for clients whose
+# WebSocket stack doesn't offer the extension.
+DEFLATE = "deflate"
+COMPRESSIONS = (DEFLATE,)
+
+FIELD_CODES = {
+    "type": 0, "_id": 1, "sender": 2, "receiver": 3, "content": 4,
+    "timestamp": 5, "conversation": 6, "seq": 7, "message": 8, "messages": 9,
+    "user": 10, "status": 11, "isTyping": 12, "group_id": 13, "client_id": 14,
+    "readers": 15, "read": 16, "token": 17, "last_seq": 18, "target": 19,
+    "senders": 20, "media": 21,
+}
+TYPE_CODES = {
+    "message": 0, "typing": 1, "status": 2, "group_message": 3, "ack": 4,
+    "read": 5, "catchup": 6, "catchup_done": 7, "refresh": 8, "group_joined": 9,
+    "join_group": 10, "status_request": 11, "ping": 12, "pong": 13, "error": 14,
+    "group_update": 15,
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Fields whose value is a user's email and goes through the sender dictionary
+SENDER_FIELDS = {"sender", "receiver", "user"}
+
+_SENDERS = FIELD_CODES["senders"]
+_RFC7692_TAIL = b"\x00\x00\xff\xff"
+
+# Largest client frame after inflating; a few hundred bytes of deflate can
+# otherwise expand to hundreds of megabytes
+MAX_FRAME_BYTES = 1024 * 1024
+
+
+class FrameTooLarge(ValueError):
+    """A client frame that inflates past MAX_FRAME_BYTES; the socket is closed."""
+
+
+def codes():
+    """The code tables, sent to compact clients in the authenticated frame."""
+    return {"fields": FIELD_CODES, "types": TYPE_CODES}
+
+
+class SenderTable:
+    """Process-wide email <-> id table behind every connection's dictionary.
+
+    Ids are assigned once per worker, so a compact frame encodes identically
+    for every recipient; each connection only tracks which ids it has been
+    told about.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._emails = []
+
+    def id(self, email):
+        sender_id = self._ids.get(email)
+        if sender_id is None:
+            with self._lock:
+                sender_id = self._ids.get(email)
+                if sender_id is None:
+                    sender_id = len(self._emails)
+                    self._emails.append(email)
+                    self._ids[email] = sender_id
+        return sender_id
+
+    def email(self, sender_id):
+        try:
+            return self._emails[sender_id]
+        except (IndexError, TypeError):
+            return None
+
+    def __len__(self):
+        return len(self._emails)
+
+
+# -- compact field/sender mapping --------------------------------------------
+
+def _compact(obj, table, ids):
+    if isinstance(obj, dict):
+        out = {}
+        for key, value in obj.items():
+            if key in SENDER_FIELDS and isinstance(value, str):
+                value = table.id(value)
+                ids.add(value)
+            elif key == "type" and value in TYPE_CODES:
+                value = TYPE_CODES[value]
+            else:
+                value = _compact(value, table, ids)
+            out[FIELD_CODES.get(key, key)] = value
+        return out
+    if isinstance(obj, (list, tuple)):
+        return [_compact(value, table, ids) for value in obj]
+    return obj
+
+
+def _expand(obj, table):
+    if isinstance(obj, dict):
+        out = {}
+        for key, value in obj.items():
+            key = FIELD_NAMES.get(key, key)
+            if key in SENDER_FIELDS and isinstance(value, int):
+                value = table.email(value)
+            elif key == "senders":
+                pass  # {id: email}; the ids aren't field codes
+            elif key == "type" and isinstance(value, int):
+                value = TYPE_NAMES.get(value, value)
+            else:
+                value = _expand(value, table)
+            out[key] = value
+        return out
+    if isinstance(obj, list):
+        return [_expand(value, table) for value in obj]
+    return obj
+
+
+def encode_compact(payload, table):
+    """Encode a payload once for every compact connection.
+
+    Returns ``(body, ids)``: the MessagePack bytes and the sender ids they
+    reference, which each connection resolves against its own dictionary.
+    """
+    ids = set()
+    return packb(_compact(payload, table, ids)), frozenset(ids)
+
+
+def encode(payload, encoding, table):
+    if encoding == COMPACT:
+        return encode_compact(payload, table)
+    return dumps(payload)
+
+
+def encode_text(text, encoding, table):
+    """Re-encode an already serialized JSON frame (as routed between workers)."""
+    if encoding == COMPACT:
+        return encode_compact(loads(text), table)
+    return text
+
+
+class Session:
+    """Per-connection wire state: the negotiated encoding, the ids this client
+    knows and the deflate contexts.
+
+    ``prepare`` turns a queued frame into what goes on the socket. It must run
+    on the connection's writer thread, in send order: the deflate context and
+    the sender dictionary both depend on exactly which frames the client got.
+    """
+
+    def __init__(self, table, encoding=JSON, compression=None):
+        self.table = table
+        self.encoding = encoding if encoding in ENCODINGS else JSON
+        self.compression = compression if compression in COMPRESSIONS else None
+        self._known = set()
+        self._compressor = None
+        self._decompressor = None
+        if self.compression == DEFLATE:
+            self._compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+            self._decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+
+    @classmethod
+    def negotiate(cls, table, auth):
+        return cls(table, auth.get("encoding"), auth.get("compression"))
+
+    @property
+    def passthrough(self):
+        """True when queued frames can go on the socket unchanged."""
+        return self.encoding == JSON and self.compression is None
+
+    def encode(self, payload):
+        return encode(payload, self.encoding, self.table)
+
+    def encode_text(self, text):
+        return encode_text(text, self.encoding, self.table)
+
+    def prepare(self, frame):
+        if self.encoding == COMPACT:
+            body, ids = frame
+            new = ids - self._known
+            if new:
+                # Definitions travel in the same message, ahead of the body,
+                # so they can't be dropped separately by the outbox
+                self._known |= new
+                body = packb({_SENDERS: {i: self.table.email(i) for i in new}}) + body
+            frame = body
+        if self._compressor:
+            if isinstance(frame, str):
+                frame = frame.encode("utf-8")
+            data = self._compressor.compress(frame) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            frame = data[:-4] if data.endswith(_RFC7692_TAIL) else data
+        return frame
+
+    def decode(self, data):
+        """Decode a frame from the client, which may use either encoding."""
+        if isinstance(data, str):
+            return loads(data)
+        if self._decompressor:
+            data = self._decompressor.decompress(data + _RFC7692_TAIL, MAX_FRAME_BYTES)
+            if self._decompressor.unconsumed_tail:
+                raise FrameTooLarge(f"Frame exceeds {MAX_FRAME_BYTES} bytes")
+        if self.encoding == JSON or data[:1] in (b"{", b"["):
+            return loads(data)
+        return _expand(unpackb(data), self.table)
+
+
+# -- MessagePack ---------------------------------------------------------------
+
+if msgpack is not None:
+    def packb(obj):
+        return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+    def unpackb(data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+else:
+    def packb(obj):
+        out = bytearray()
+        _pack(obj, out)
+        return bytes(out)
+
+    def unpackb(data):
+        obj, offset = _unpack(memoryview(data), 0)
+        if offset != len(data):
+            raise ValueError("Trailing data after MessagePack object")
+        return obj
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj <= 0xff:
+            out += b"\xcc" + struct.pack(">B", obj)
+        elif 0 <= obj <= 0xffff:
+            out += b"\xcd" + struct.pack(">H", obj)
+        elif 0 <= obj <= 0xffffffff:
+            out += b"\xce" + struct.pack(">I", obj)
+        elif obj > 0:
+            out += b"\xcf" + struct.pack(">Q", obj)
+        elif obj >= -0x80:
+            out += b"\xd0" + struct.pack(">b", obj)
+        elif obj >= -0x8000:
+            out += b"\xd1" + struct.pack(">h", obj)
+        elif obj >= -0x80000000:
+            out += b"\xd2" + struct.pack(">i", obj)
+        else:
+            out += b"\xd3" + struct.pack(">q", obj)
+    elif isinstance(obj, float):
+        out += b"\xcb" + struct.pack(">d", obj)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        n = len(data)
+        if n < 32:
+            out.append(0xa0 | n)
+        elif n <= 0xff:
+            out += b"\xd9" + struct.pack(">B", n)
+        elif n <= 0xffff:
+            out += b"\xda" + struct.pack(">H", n)
+        else:
+            out += b"\xdb" + struct.pack(">I", n)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        n = len(obj)
+        if n <= 0xff:
+            out += b"\xc4" + struct.pack(">B", n)
+        elif n <= 0xffff:
+            out += b"\xc5" + struct.pack(">H", n)
+        else:
+            out += b"\xc6" + struct.pack(">I", n)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16:
+            out.append(0x90 | n)
+        elif n <= 0xffff:
+            out += b"\xdc" + struct.pack(">H", n)
+        else:
+            out += b"\xdd" + struct.pack(">I", n)
+        for value in obj:
+            _pack(value, out)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n <= 0xffff:
+            out += b"\xde" + struct.pack(">H", n)
+        else:
+            out += b"\xdf" + struct.pack(">I", n)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        _pack(_default(obj), out)
+
+
+_FIXED = {
+    0xcc: ">B", 0xcd: ">H", 0xce: ">I", 0xcf: ">Q",
+    0xd0: ">b", 0xd1: ">h", 0xd2: ">i", 0xd3: ">q",
+    0xca: ">f", 0xcb: ">d",
+}
+_LENGTHS = {
+    0xd9: ">B", 0xda: ">H", 0xdb: ">I",  # str
+    0xc4: ">B", 0xc5: ">H", 0xc6: ">I",  # bin
+    0xdc: ">H", 0xdd: ">I",              # array
+    0xde: ">H", 0xdf: ">I",              # map
+}
+
+
+def _unpack(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag < 0x80:
+        return tag, offset
+    if tag >= 0xe0:
+        return tag - 0x100, offset
+    if 0xa0 <= tag <= 0xbf:
+        n = tag & 0x1f
+        return str(data[offset:offset + n], "utf-8"), offset + n
+    if 0x90 <= tag <= 0x9f:
+        return _unpack_array(data, offset, tag & 0x0f)
+    if 0x80 <= tag <= 0x8f:
+        return _unpack_map(data, offset, tag & 0x0f)
+    if tag == 0xc0:
+        return None, offset
+    if tag == 0xc2:
+        return False, offset
+    if tag == 0xc3:
+        return True, offset
+    if tag in _FIXED:
+        fmt = _FIXED[tag]
+        size = struct.calcsize(fmt)
+        return struct.unpack_from(fmt, data, offset)[0], offset + size
+    if tag in _LENGTHS:
+        fmt = _LENGTHS[tag]
+        n = struct.unpack_from(fmt, data, offset)[0]
+        offset += struct.calcsize(fmt)
+        if tag in (0xd9, 0xda, 0xdb):
+            return str(data[offset:offset + n], "utf-8"), offset + n
+        if tag in (0xc4, 0xc5, 0xc6):
+            return bytes(data[offset:offset + n]), offset + n
+        if tag in (0xdc, 0xdd):
+            return _unpack_array(data, offset, n)
+        return _unpack_map(data, offset, n)
+    raise ValueError(f"Unsupported MessagePack type 0x{tag:02x}")
+
+
+def _unpack_array(data, offset, n):
+    items = []
+    for _ in range(n):
+        value, offset = _unpack(data, offset)
+        items.append(value)
+    return items, offset
+
+
+def _unpack_map(data, offset, n):
+    items = {}
+    for _ in range(n):
+        key, offset = _unpack(data, offset)
+        value, offset = _unpack(data, offset)
+        items[key] = value
+    return items, offset
@@ -0,0 +1,134 @@
+from concurrent.futures import Future
+from collections import deque
+import threading
+import time
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+class WritePipeline:
+    """Group-commit writer for one collection.
+
+    ``insert``/``update`` return a Future resolved once the operation has been
+    flushed. Pending operations are written with a single ordered
+    ``bulk_write`` when ``max_batch`` operations are waiting or the oldest has
+    waited ``max_delay`` seconds. A single flusher thread and ordered writes
+    keep every conversation in submission order.
+
+    With ``enabled=False`` each operation is written immediately on the
+    caller's thread, which keeps call sites identical either way. With
+    ``ordered=False`` batches are written unordered, for independent
+    operations where one failure shouldn't hold back the rest.
+    """
+
+    def __init__(self, collection, max_batch=100, max_delay=0.002, enabled=True, ordered=True):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.enabled = enabled
+        self.ordered = ordered
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "batches": 0,
+            "operations": 0,
+            "max_batch_size": 0,
+            "flush_seconds_total": 0.0,
+            "flush_seconds_max": 0.0,
+            "errors": 0,
+        }
+        if enabled:
+            threading.Thread(target=self._run, name="write-pipeline", daemon=True).start()
+
+    def insert(self, doc):
+        doc.setdefault("_id", ObjectId())
+        return self._submit(InsertOne(doc), doc["_id"])
+
+    def update(self, filter, update, array_filters=None, upsert=False):
+        return self._submit(UpdateOne(filter, update, array_filters=array_filters, upsert=upsert), None)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["pending"] = len(self._queue)
+        stats["avg_batch_size"] = stats["operations"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    def _submit(self, op, result):
+        future = Future()
+        if not self.enabled:
+            self._flush([(op, result, future, time.monotonic())])
+            return future
+        with self._cond:
+            self._queue.append((op, result, future, time.monotonic()))
+            if len(self._queue) == 1 or len(self._queue) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # Wait for the batch to fill or the oldest entry's deadline
+                deadline = self._queue[0][3] + self.max_delay
+                while len(self._queue) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+            # The flusher must outlive any failure, or every later write hangs
+            try:
+                self._flush(batch)
+            except Exception as e:
+                print(f"Write pipeline flush failed: {e}")
+                self._fail(batch, e)
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            self.collection.bulk_write([op for op, _, _, _ in batch], ordered=self.ordered)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", ())}
+            if not failed:
+                # Only a write concern error: nothing says which ops are durable
+                self._fail(batch, e)
+                self._record(len(batch), started, error=True)
+                return
+            first_failed = min(failed)
+            for i, (_, result, future, _) in enumerate(batch):
+                # Ordered writes stop at the first error: earlier ops succeeded,
+                # the failing op and everything after it did not run
+                if i < first_failed or (not self.ordered and i not in failed):
+                    future.set_result(result)
+                else:
+                    future.set_exception(e)
+            self._record(len(batch), started, error=True)
+            return
+        except Exception as e:
+            self._fail(batch, e)
+            self._record(len(batch), started, error=True)
+            return
+        for _, result, future, _ in batch:
+            future.set_result(result)
+        self._record(len(batch), started)
+
+    def _fail(self, batch, error):
+        for _, _, future, _ in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def _record(self, size, started, error=False):
+        elapsed = time.monotonic() - started
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["operations"] += size
+            self._stats["max_batch_size"] = max(self._stats["max_batch_size"], size)
+            self._stats["flush_seconds_total"] += elapsed
+            self._stats["flush_seconds_max"] = max(self._stats["flush_seconds_max"], elapsed)
+            if error:
+                self._stats["errors"] += 1